@@ -0,0 +1,135 @@
+"""导出任务的准入：归档大小估算与压缩线程分配
+
+- CompressionRatios：按导出方式（压缩格式族、是否使用层缓存）记录最近导出的压缩率（归档大小/未压缩 tar 大小），
+  估算时取较高的分位数，宁可多预留空间也不在导出途中写满磁盘。启动时从归档元数据中的 tar_size 恢复历史。
+- CpuBudget：同时运行的压缩进程共享 CPU 核心。每个压缩开始时按当时正在运行与等待的压缩数平分核心数，
+  主机上其他进程（如其他 worker 的压缩）的负载较高时相应减少线程数；本进程的压缩线程已占满核心时等待，
+  分配出的线程总数不超过核心数。平均负载有滞后，只用于减少线程数，不会因此让任务等待。
+
+下载目录的空间预留见 storage.StorageManager.admission。
+"""
+import asyncio
+import logging
+import math
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 每种导出方式保留的压缩率样本数，以及开始使用历史数据所需的最少样本数
+RATIO_WINDOW = 50
+RATIO_MIN_SAMPLES = 3
+# 估算时使用的分位数
+RATIO_QUANTILE = 0.9
+
+
+class CompressionRatios:
+    """历史压缩率，default_ratio 为样本不足时使用的压缩率"""
+
+    def __init__(self, default_ratio: float):
+        self.default_ratio = default_ratio
+        self._samples: Dict[Tuple[str, bool], Deque[float]] = {}
+
+    def record(self, codec_family: str, layer_cache: bool, tar_size: int, archive_size: int) -> None:
+        if tar_size <= 0 or archive_size <= 0:
+            return
+        samples = self._samples.setdefault((codec_family, bool(layer_cache)), deque(maxlen=RATIO_WINDOW))
+        samples.append(archive_size / tar_size)
+
+    def load(self, metas: Iterable[Optional[Dict]]) -> None:
+        """从归档元数据恢复历史（按创建时间排序，较新的样本保留在窗口中）
+
+        只使用 docker 引擎的完整归档：registry 引擎按各层大小估算，增量归档的 tar 不含基础中的层。
+        """
+        metas = sorted((meta for meta in metas if meta and meta.get("tar_size") and meta.get("engine") == "docker"
+                        and not meta.get("delta_base")),
+                       key=lambda meta: meta.get("created_at", 0))
+        for meta in metas:
+            self.record(meta.get("codec_family", ""), meta.get("layer_cache", False), meta["tar_size"], meta["size"])
+
+    def ratio(self, codec_family: str, layer_cache: bool) -> float:
+        samples = sorted(self._samples.get((codec_family, bool(layer_cache))) or ())
+        if len(samples) < RATIO_MIN_SAMPLES:
+            return self.default_ratio
+        return samples[min(len(samples) - 1, math.ceil(RATIO_QUANTILE * len(samples)) - 1)]
+
+    def stats(self) -> Dict:
+        return {
+            f"{family}/{'layer_cache' if layer_cache else 'stream'}": {
+                "samples": len(samples),
+                "ratio": round(self.ratio(family, layer_cache), 4),
+            }
+            for (family, layer_cache), samples in self._samples.items()
+        }
+
+
+class CpuBudget:
+    """压缩线程的分配，只在事件循环中使用
+
+    cores 为可用的核心数，分配出的线程总数不超过它。压缩线程数在开始时确定（pigz/zstd 运行中无法调整），
+    每个压缩分到 cores // (运行中 + 等待中的压缩数) 个线程，且不超过尚未分配的核心数。
+    load_aware 时用 1 分钟平均负载估计本进程之外的 CPU 占用，据此减少分配的线程数。
+    """
+
+    def __init__(self, cores: int, load_aware: bool = True, poll_interval: float = 5):
+        self.cores = max(1, cores)
+        self.load_aware = load_aware and hasattr(os, "getloadavg")
+        self.poll_interval = poll_interval
+        self.allocated = 0
+        self.compressions = 0
+        self.waiting = 0
+        self._released: Optional[asyncio.Event] = None
+
+    def external_load(self) -> float:
+        """本进程分配的压缩线程之外的负载"""
+        if not self.load_aware:
+            return 0.0
+        return max(0.0, os.getloadavg()[0] - self.allocated)
+
+    def share(self) -> int:
+        """新开始的压缩应分到的线程数（调用方已计入 waiting）"""
+        return max(1, self.cores // max(1, self.compressions + self.waiting))
+
+    @asynccontextmanager
+    async def allocate(self, multithreaded: bool = True, on_wait: Optional[Callable[[], None]] = None):
+        """分配压缩线程，yield 线程数；单线程的编解码器只占用一个核心"""
+        if self._released is None:
+            self._released = asyncio.Event()
+        waited = False
+        self.waiting += 1
+        try:
+            while True:
+                free = self.cores - self.allocated
+                if free >= 1:
+                    wanted = self.share() if multithreaded else 1
+                    threads = max(1, min(wanted, free, int(free - self.external_load())))
+                    break
+                if not waited and on_wait:
+                    on_wait()
+                waited = True
+                self._released.clear()
+                try:
+                    await asyncio.wait_for(self._released.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiting -= 1
+        self.allocated += threads
+        self.compressions += 1
+        try:
+            yield threads
+        finally:
+            self.allocated -= threads
+            self.compressions -= 1
+            self._released.set()
+
+    def stats(self) -> Dict:
+        return {
+            "cores": self.cores,
+            "allocated_threads": self.allocated,
+            "compressions": self.compressions,
+            "waiting": self.waiting,
+            "external_load": round(self.external_load(), 2),
+        }
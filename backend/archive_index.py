@@ -0,0 +1,193 @@
+"""下载目录的归档索引
+
+在内存中维护下载目录中全部归档的大小、时间、校验和与镜像名，列表接口直接查询索引，
+不再每次对整个目录 listdir + stat。本进程写入或删除归档时显式刷新对应条目；
+其他进程或手工造成的变化通过目录 mtime 发现（新增、删除、重命名都会更新目录 mtime），
+此外每隔 full_rescan_interval 秒对全部文件重新 stat 一次，发现原地改写的文件。
+"""
+import base64
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from archive_meta import read_archive_meta
+from checksum import read_checksums
+
+logger = logging.getLogger(__name__)
+
+# 支持的排序字段
+SORT_FIELDS = ("created_at", "mtime", "size", "name")
+
+
+class ArchiveIndex:
+    """下载目录的归档索引，可在多个线程中使用
+
+    generation 在索引内容变化时递增，与进程内随机的 instance 组成列表接口的 ETag。
+    """
+
+    def __init__(self, root: str, extensions: Tuple[str, ...], revalidate_interval: float = 2.0,
+                 full_rescan_interval: float = 300.0):
+        self.root = root
+        self.extensions = extensions
+        self.revalidate_interval = revalidate_interval
+        self.full_rescan_interval = full_rescan_interval
+        self.instance = uuid.uuid4().hex[:8]
+        self.generation = 0
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._dir_mtime_ns: Optional[int] = None
+        self._last_check = 0.0
+        self._last_full_scan = 0.0
+        self._sorted: Dict[str, List[Dict]] = {}
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.instance}-{self.generation}"'
+
+    def _is_archive(self, filename: str) -> bool:
+        return filename.endswith(self.extensions)
+
+    def _load_entry(self, filename: str) -> Optional[Dict]:
+        path = os.path.join(self.root, filename)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        meta = read_archive_meta(path) or {}
+        checksums = read_checksums(path)
+        return {
+            "name": filename,
+            "path": path,
+            "size": stat.st_size,
+            "created_at": stat.st_ctime,
+            "mtime": stat.st_mtime,
+            "image_name": meta.get("image_name"),
+            "sha256": checksums.get("sha256"),
+            "blake3": checksums.get("blake3"),
+        }
+
+    def _changed(self):
+        """调用方持有锁"""
+        self.generation += 1
+        self._sorted.clear()
+
+    def refresh(self, path: str) -> None:
+        """重新读取一个归档（或其 sidecar 对应的归档）的信息，文件不存在时从索引中移除"""
+        filename = os.path.basename(path)
+        if not self._is_archive(filename):
+            return
+        entry = self._load_entry(filename)
+        with self._lock:
+            if entry is None:
+                if self._entries.pop(filename, None) is not None:
+                    self._changed()
+            elif self._entries.get(filename) != entry:
+                self._entries[filename] = entry
+                self._changed()
+
+    def remove(self, path: str) -> None:
+        with self._lock:
+            if self._entries.pop(os.path.basename(path), None) is not None:
+                self._changed()
+
+    def rescan(self, full: bool = False) -> None:
+        """对照目录内容更新索引；full 时重新 stat 所有文件，否则只读取新出现的文件"""
+        try:
+            dir_mtime_ns = os.stat(self.root).st_mtime_ns
+            names = {name for name in os.listdir(self.root) if self._is_archive(name)}
+        except FileNotFoundError:
+            dir_mtime_ns, names = None, set()
+        with self._lock:
+            known = set(self._entries)
+        loaded = {name: self._load_entry(name) for name in (names if full else names - known)}
+        with self._lock:
+            changed = False
+            for name in known - names:
+                del self._entries[name]
+                changed = True
+            for name, entry in loaded.items():
+                if entry is None:
+                    changed = self._entries.pop(name, None) is not None or changed
+                elif self._entries.get(name) != entry:
+                    self._entries[name] = entry
+                    changed = True
+            if changed:
+                self._changed()
+            self._dir_mtime_ns = dir_mtime_ns
+            if full:
+                self._last_full_scan = time.monotonic()
+
+    def revalidate(self) -> None:
+        """按间隔检查目录 mtime，发生变化时增量更新；超过全量间隔时重新 stat 所有文件"""
+        now = time.monotonic()
+        if now - self._last_check < self.revalidate_interval:
+            return
+        self._last_check = now
+        if self._dir_mtime_ns is None or now - self._last_full_scan >= self.full_rescan_interval:
+            self.rescan(full=True)
+            return
+        try:
+            dir_mtime_ns = os.stat(self.root).st_mtime_ns
+        except FileNotFoundError:
+            dir_mtime_ns = None
+        if dir_mtime_ns != self._dir_mtime_ns:
+            self.rescan()
+
+    def entries(self) -> List[Dict]:
+        with self._lock:
+            return list(self._entries.values())
+
+    def _sorted_entries(self, sort: str) -> List[Dict]:
+        """按字段升序排列（同值按文件名），同一 generation 内缓存排序结果"""
+        with self._lock:
+            cached = self._sorted.get(sort)
+            if cached is None:
+                cached = sorted(self._entries.values(), key=lambda entry: (entry[sort], entry["name"]))
+                self._sorted[sort] = cached
+            return cached
+
+    def query(self, sort: str = "created_at", descending: bool = True, image: Optional[str] = None,
+              cursor: Optional[str] = None, limit: int = 100) -> Tuple[List[Dict], Optional[str], int]:
+        """分页查询，返回 (本页条目, 下一页游标, 符合条件的总数)
+
+        游标记录上一页最后一条的 (排序值, 文件名)，翻页期间有文件增删也不会重复或遗漏。
+        image 按镜像名或文件名做不区分大小写的包含匹配（文件名中的 / 与 : 已替换为 _）。
+        """
+        if sort not in SORT_FIELDS:
+            raise ValueError(f"不支持的排序字段: {sort}，可选: {', '.join(SORT_FIELDS)}")
+        entries = self._sorted_entries(sort)
+        if descending:
+            entries = entries[::-1]
+        if image:
+            needle = image.lower()
+            file_needle = needle.replace("/", "_").replace(":", "_")
+            entries = [entry for entry in entries
+                       if file_needle in entry["name"].lower() or needle in (entry["image_name"] or "").lower()]
+        total = len(entries)
+        if cursor:
+            last = decode_cursor(cursor)
+            if descending:
+                entries = [entry for entry in entries if (entry[sort], entry["name"]) < last]
+            else:
+                entries = [entry for entry in entries if (entry[sort], entry["name"]) > last]
+        page = entries[:limit]
+        next_cursor = None
+        if len(entries) > limit:
+            next_cursor = encode_cursor((page[-1][sort], page[-1]["name"]))
+        return page, next_cursor, total
+
+
+def encode_cursor(position: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        value, name = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return value, name
+    except (ValueError, TypeError):
+        raise ValueError("无效的分页游标")
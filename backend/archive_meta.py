@@ -0,0 +1,87 @@
+"""归档的 sidecar 元数据
+
+每个导出成功的归档旁边保存一个 <归档>.meta.json，记录镜像 ID、仓库摘要、层摘要、
+导出方式（拉取引擎、压缩格式、是否使用层缓存）与文件大小。再次导出同一镜像时据此判断
+已有归档是否可以直接复用。元数据中的大小与实际文件不一致时视为无效。
+"""
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+META_SUFFIX = ".meta.json"
+
+
+def meta_path(archive_path: str) -> str:
+    return archive_path + META_SUFFIX
+
+
+def export_variant(engine: str, codec_family: str, layer_cache: bool, delta_base: Optional[str] = None,
+                   seekable: bool = False) -> Dict:
+    """决定归档内容格式的导出参数，相同镜像 ID 且导出方式相同的归档可以互相替代
+
+    pigz 与 gzip 属于同一格式族；压缩级别只影响压缩比，不参与比较。
+    delta_base 为增量归档的基础镜像标识，完整归档为 None（没有该字段的旧元数据同样视为完整归档）。
+    分块压缩的归档（seekable）同时也是普通的压缩流，不要求分块的导出可以复用它，反之则不行。
+    """
+    variant = {"engine": engine, "codec_family": codec_family, "layer_cache": bool(layer_cache), "delta_base": delta_base}
+    if seekable:
+        variant["seekable"] = True
+    return variant
+
+
+def write_archive_meta(archive_path: str, meta: Dict) -> Dict:
+    """写入归档的元数据（先写临时文件再重命名），自动补充文件大小与创建时间"""
+    meta = dict(meta)
+    meta["file"] = os.path.basename(archive_path)
+    meta["size"] = os.path.getsize(archive_path)
+    meta.setdefault("created_at", int(time.time()))
+    path = meta_path(archive_path)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+    return meta
+
+
+def remove_archive_meta(archive_path: str) -> None:
+    """删除归档的元数据，覆盖或删除归档前调用"""
+    try:
+        os.remove(meta_path(archive_path))
+    except FileNotFoundError:
+        pass
+
+
+def read_archive_meta(archive_path: str) -> Optional[Dict]:
+    """读取归档的元数据，归档不存在、元数据缺失或与归档大小不一致时返回 None"""
+    try:
+        with open(meta_path(archive_path)) as f:
+            meta = json.load(f)
+        if meta.get("size") != os.path.getsize(archive_path):
+            return None
+        return meta
+    except (OSError, ValueError):
+        return None
+
+
+def _matches(meta: Optional[Dict], image_id: str, variant: Dict) -> bool:
+    return bool(meta) and meta.get("image_id") == image_id and all(
+        meta.get(key) == value for key, value in variant.items()
+    )
+
+
+def find_reusable_archive(downloads_dir: str, image_id: str, variant: Dict,
+                          preferred_path: Optional[str] = None) -> Optional[str]:
+    """查找镜像 ID 与导出方式都相同的已有归档，优先检查本次导出的目标文件"""
+    if preferred_path and _matches(read_archive_meta(preferred_path), image_id, variant):
+        return preferred_path
+    for filename in os.listdir(downloads_dir):
+        if not filename.endswith(META_SUFFIX):
+            continue
+        archive_path = os.path.join(downloads_dir, filename[:-len(META_SUFFIX)])
+        if archive_path != preferred_path and _matches(read_archive_meta(archive_path), image_id, variant):
+            return archive_path
+    return None
@@ -0,0 +1,348 @@
+"""导出流水线基准测试
+
+离线生成合成的 docker save 格式镜像 tar（不需要 Docker daemon），按编解码器、线程数、块大小的组合
+逐一通过真实的流式压缩流水线（compression.compress_stream），输出吞吐量（MB/s）、CPU 时间、
+峰值内存和压缩比，结果为 JSON，可与之前的结果对比以发现性能回退。
+
+用法:
+    python bench.py --size-mb 256 --entropy random,text --codecs pigz,zstd --threads 1,4 \\
+        --chunk-sizes 1M,4M --output result.json
+    python bench.py --baseline result.json   # 与之前的结果对比
+
+每个用例在独立子进程中运行，峰值内存和 CPU 时间互不干扰。
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from typing import Dict, Iterable, List, Optional
+
+from compression import CODECS, compress_stream
+
+logger = logging.getLogger(__name__)
+
+ENTROPY_KINDS = ("random", "text", "zero", "mixed")
+# 单个合成层的最大大小，较大的镜像拆分为多层
+SYNTHETIC_LAYER_SIZE = 64 * 1024 * 1024
+GENERATE_BLOCK_SIZE = 1024 * 1024
+TEXT_WORDS = (
+    "usr lib bin etc var share include python3 site-packages __init__ .so .py config "
+    "node_modules index.js package.json README LICENSE locale zoneinfo ssl certs "
+    "def class import return self None True False for in if else while"
+).split()
+
+
+def parse_size(value: str) -> int:
+    """解析 512K、4M、1G 之类的大小"""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def iter_synthetic_data(size: int, entropy: str, seed: int) -> Iterable[bytes]:
+    """按指定熵类型生成确定性的数据块
+
+    random 不可压缩，text 类似源码/配置文件，zero 几乎完全可压缩，mixed 三者交替。
+    """
+    rng = random.Random(seed)
+    remaining = size
+    index = 0
+    while remaining > 0:
+        block_size = min(GENERATE_BLOCK_SIZE, remaining)
+        kind = ENTROPY_KINDS[index % 3] if entropy == "mixed" else entropy
+        if kind == "random":
+            block = rng.randbytes(block_size)
+        elif kind == "text":
+            words = []
+            length = 0
+            while length <= block_size:
+                word = rng.choice(TEXT_WORDS)
+                words.append(word)
+                length += len(word) + 1
+            block = " ".join(words).encode()[:block_size]
+        else:
+            block = bytes(block_size)
+        yield block
+        remaining -= block_size
+        index += 1
+
+
+class _ChunkFile:
+    """把数据块迭代器包装成 tarfile 可读取的文件对象"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def generate_image_tar(path: str, size: int, entropy: str, seed: int = 0) -> int:
+    """生成 docker save 格式的合成镜像 tar，返回文件大小"""
+    layer_sizes = []
+    remaining = size
+    while remaining > 0:
+        layer_sizes.append(min(SYNTHETIC_LAYER_SIZE, remaining))
+        remaining -= layer_sizes[-1]
+
+    layer_dir = tempfile.mkdtemp(prefix="bench-layers-", dir=os.path.dirname(path))
+    try:
+        layers = []
+        for index, layer_size in enumerate(layer_sizes):
+            layer_id = f"{seed:08x}{index:056x}"
+            layer_path = os.path.join(layer_dir, f"{layer_id}.tar")
+            with tarfile.open(layer_path, "w", format=tarfile.GNU_FORMAT) as layer_tar:
+                info = tarfile.TarInfo(f"data/blob-{index}.bin")
+                info.size = layer_size
+                layer_tar.addfile(info, _ChunkFile(iter_synthetic_data(layer_size, entropy, seed + index)))
+            layers.append((layer_id, layer_path))
+
+        config_name = f"{seed:064x}.json"
+        config = json.dumps({
+            "architecture": "amd64",
+            "os": "linux",
+            "rootfs": {"type": "layers", "diff_ids": [f"sha256:{layer_id}" for layer_id, _ in layers]},
+        }).encode()
+        manifest = json.dumps([{
+            "Config": config_name,
+            "RepoTags": [f"bench/{entropy}:latest"],
+            "Layers": [f"{layer_id}/layer.tar" for layer_id, _ in layers],
+        }]).encode()
+
+        with tarfile.open(path, "w", format=tarfile.GNU_FORMAT) as image_tar:
+            for layer_id, layer_path in layers:
+                image_tar.add(layer_path, arcname=f"{layer_id}/layer.tar")
+            for name, data in ((config_name, config), ("manifest.json", manifest)):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                image_tar.addfile(info, _ChunkFile([data]))
+    finally:
+        shutil.rmtree(layer_dir, ignore_errors=True)
+    return os.path.getsize(path)
+
+
+def _cpu_seconds() -> float:
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage_self.ru_utime + usage_self.ru_stime
+            + usage_children.ru_utime + usage_children.ru_stime)
+
+
+def _peak_rss_bytes() -> int:
+    """本进程与压缩子进程中的较大峰值内存（Linux 上 ru_maxrss 单位为 KB，macOS 为字节）"""
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def run_case(case: Dict) -> Dict:
+    """在当前进程中运行一个用例（由 run_case_isolated 在子进程中调用）"""
+    codec = CODECS[case["codec"]]
+    input_size = os.path.getsize(case["input"])
+    output_path = os.path.join(case["workdir"], f"bench-output{codec.ext}")
+    chunk_size = case["chunk_size"]
+
+    def iter_input():
+        with open(case["input"], "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                yield chunk
+
+    cpu_start = _cpu_seconds()
+    start = time.perf_counter()
+    compress_stream(iter_input(), output_path, codec=codec, level=case.get("level"), threads=case["threads"])
+    elapsed = time.perf_counter() - start
+    cpu = _cpu_seconds() - cpu_start
+    output_size = os.path.getsize(output_path)
+    os.unlink(output_path)
+
+    return {
+        **{key: case[key] for key in ("entropy", "codec", "threads", "chunk_size")},
+        "level": codec.resolve_level(case.get("level")),
+        "input_bytes": input_size,
+        "output_bytes": output_size,
+        "ratio": round(input_size / output_size, 4) if output_size else None,
+        "seconds": round(elapsed, 4),
+        "mb_per_s": round(input_size / (1024 * 1024) / elapsed, 2) if elapsed else None,
+        "cpu_seconds": round(cpu, 4),
+        "cpu_utilization": round(cpu / elapsed, 2) if elapsed else None,
+        "peak_rss_bytes": _peak_rss_bytes(),
+    }
+
+
+def run_case_isolated(case: Dict) -> Dict:
+    """在独立子进程中运行用例，保证峰值内存与 CPU 时间只属于该用例"""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case)],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"用例执行失败 {case['codec']}/{case['entropy']}: {result.stderr.strip()}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _case_key(result: Dict) -> tuple:
+    return (result["entropy"], result["codec"], result["threads"], result["chunk_size"], result["level"])
+
+
+def compare_with_baseline(results: List[Dict], baseline: Dict, tolerance: float) -> List[Dict]:
+    """与基线结果逐用例对比，吞吐量下降超过 tolerance 的用例标记为回退"""
+    previous = {_case_key(item): item for item in baseline.get("results", [])}
+    comparisons = []
+    for result in results:
+        old = previous.get(_case_key(result))
+        if not old or not old.get("mb_per_s") or not result.get("mb_per_s"):
+            continue
+        change = result["mb_per_s"] / old["mb_per_s"] - 1
+        comparisons.append({
+            "entropy": result["entropy"],
+            "codec": result["codec"],
+            "threads": result["threads"],
+            "chunk_size": result["chunk_size"],
+            "mb_per_s_before": old["mb_per_s"],
+            "mb_per_s_after": result["mb_per_s"],
+            "change": round(change, 4),
+            "peak_rss_change": result["peak_rss_bytes"] - old["peak_rss_bytes"],
+            "regression": change < -tolerance,
+        })
+    return comparisons
+
+
+def run_benchmark(size: int, entropies: List[str], codecs: List[str], threads: List[int],
+                  chunk_sizes: List[int], level: Optional[int] = None, repeat: int = 1,
+                  workdir: Optional[str] = None) -> Dict:
+    """生成合成镜像并运行全部用例组合，重复运行时取吞吐量最高的一次"""
+    workdir = tempfile.mkdtemp(prefix="docker-pull-bench-", dir=workdir)
+    results = []
+    skipped = []
+    try:
+        for entropy in entropies:
+            image_path = os.path.join(workdir, f"image-{entropy}.tar")
+            generate_image_tar(image_path, size, entropy)
+            for codec_name in codecs:
+                codec = CODECS[codec_name]
+                if not codec.available():
+                    skipped.append(codec_name)
+                    continue
+                # 单线程编解码器只需测一次线程数
+                for thread_count in (threads if codec.multithreaded else threads[:1]):
+                    for chunk_size in chunk_sizes:
+                        case = {
+                            "input": image_path, "workdir": workdir, "entropy": entropy, "codec": codec_name,
+                            "threads": thread_count, "chunk_size": chunk_size, "level": level,
+                        }
+                        runs = [run_case_isolated(case) for _ in range(repeat)]
+                        best = max(runs, key=lambda item: item["mb_per_s"] or 0)
+                        logger.info(f"{entropy:>6} {codec_name:>5} 线程={thread_count:<2} 块={chunk_size // 1024}K "
+                                    f"{best['mb_per_s']}MB/s 压缩比={best['ratio']} "
+                                    f"峰值内存={best['peak_rss_bytes'] / (1024 * 1024):.1f}MB")
+                        results.append(best)
+            os.unlink(image_path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "timestamp": int(time.time()),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "params": {
+            "size_bytes": size,
+            "entropy": entropies,
+            "codecs": codecs,
+            "threads": threads,
+            "chunk_sizes": chunk_sizes,
+            "level": level,
+            "repeat": repeat,
+        },
+        "skipped_codecs": sorted(set(skipped)),
+        "results": results,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="导出流水线离线基准测试")
+    parser.add_argument("--size-mb", type=float, default=128, help="合成镜像大小（MB）")
+    parser.add_argument("--entropy", default="random,text", help=f"数据类型，逗号分隔：{','.join(ENTROPY_KINDS)}")
+    parser.add_argument("--codecs", default=",".join(CODECS), help="编解码器，逗号分隔")
+    parser.add_argument("--threads", default=str(os.cpu_count() or 1), help="线程数，逗号分隔")
+    parser.add_argument("--chunk-sizes", default="2M", help="读取块大小，逗号分隔，如 256K,2M")
+    parser.add_argument("--level", type=int, default=None, help="压缩级别，默认使用各编解码器的默认级别")
+    parser.add_argument("--repeat", type=int, default=1, help="每个用例重复次数，取最快的一次")
+    parser.add_argument("--workdir", default=None, help="临时文件目录（默认系统临时目录）")
+    parser.add_argument("--output", default=None, help="结果 JSON 文件，默认输出到标准输出")
+    parser.add_argument("--baseline", default=None, help="用于对比的历史结果 JSON")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="吞吐量下降超过该比例视为回退")
+    parser.add_argument("--run-case", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return 0
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    entropies = [item for item in args.entropy.split(",") if item]
+    codecs = [item for item in args.codecs.split(",") if item]
+    for name in entropies:
+        if name not in ENTROPY_KINDS:
+            parser.error(f"不支持的数据类型: {name}")
+    for name in codecs:
+        if name not in CODECS:
+            parser.error(f"不支持的压缩格式: {name}")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    report = run_benchmark(
+        size=int(args.size_mb * 1024 * 1024),
+        entropies=entropies,
+        codecs=codecs,
+        threads=[int(item) for item in args.threads.split(",") if item],
+        chunk_sizes=[parse_size(item) for item in args.chunk_sizes.split(",") if item],
+        level=args.level,
+        repeat=max(1, args.repeat),
+        workdir=args.workdir,
+    )
+
+    regressions = []
+    if baseline is not None:
+        report["comparison"] = compare_with_baseline(report["results"], baseline, args.tolerance)
+        regressions = [item for item in report["comparison"] if item["regression"]]
+        for item in regressions:
+            logger.warning(f"性能回退: {item['entropy']} {item['codec']} 线程={item['threads']} "
+                           f"{item['mb_per_s_before']} -> {item['mb_per_s_after']}MB/s")
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""归档校验和
+
+导出时在压缩输出写入文件的同时计算 SHA-256（安装 blake3 包后可选 BLAKE3），不需要再读一遍归档。
+校验和以 sha256sum/b3sum 兼容的格式保存在归档旁边的 <归档>.sha256 / <归档>.b3 中，
+接收方可以直接用 sha256sum -c 校验。
+"""
+import hashlib
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+logger = logging.getLogger(__name__)
+
+# 导出时计算的校验和算法，逗号分隔（sha256、blake3）
+CHECKSUM_ALGORITHMS = [name.strip() for name in os.getenv("CHECKSUM_ALGORITHMS", "sha256").split(",") if name.strip()]
+# 校验归档时每次读取的块大小
+CHECKSUM_CHUNK_SIZE = int(os.getenv("CHECKSUM_CHUNK_SIZE", str(4 * 1024 * 1024)))
+
+# 各算法的 sidecar 文件后缀
+CHECKSUM_SUFFIXES = {"sha256": ".sha256", "blake3": ".b3"}
+
+
+def new_hasher(algorithm: str):
+    if algorithm == "sha256":
+        return hashlib.sha256()
+    if algorithm == "blake3":
+        if blake3 is None:
+            raise ValueError("计算 BLAKE3 需要安装 blake3 包")
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    raise ValueError(f"不支持的校验和算法: {algorithm}，可选: {', '.join(CHECKSUM_SUFFIXES)}")
+
+
+def resolve_algorithms(algorithms: Optional[Iterable[str]] = None) -> list:
+    """返回可用的算法列表，未安装 blake3 时跳过 blake3"""
+    resolved = []
+    for algorithm in CHECKSUM_ALGORITHMS if algorithms is None else algorithms:
+        if algorithm == "blake3" and blake3 is None:
+            logger.warning("未安装 blake3 包，跳过 BLAKE3 校验和")
+            continue
+        new_hasher(algorithm)
+        resolved.append(algorithm)
+    return resolved
+
+
+class ChecksumWriter:
+    """包装可写文件对象，写入的同时更新各算法的摘要"""
+
+    def __init__(self, fileobj, algorithms: Optional[Iterable[str]] = None):
+        self.fileobj = fileobj
+        self.hashers = {algorithm: new_hasher(algorithm) for algorithm in resolve_algorithms(algorithms)}
+
+    def write(self, data) -> int:
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self) -> None:
+        self.fileobj.flush()
+
+    def hexdigests(self) -> Dict[str, str]:
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in self.hashers.items()}
+
+
+def checksum_path(archive_path: str, algorithm: str) -> str:
+    return archive_path + CHECKSUM_SUFFIXES[algorithm]
+
+
+def write_checksums(archive_path: str, digests: Dict[str, str]) -> None:
+    """以 sha256sum 格式（<摘要>  <文件名>）写入各算法的 sidecar"""
+    filename = os.path.basename(archive_path)
+    for algorithm, digest in digests.items():
+        path = checksum_path(archive_path, algorithm)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(f"{digest}  {filename}\n")
+        os.replace(temp_path, path)
+
+
+def read_checksums(archive_path: str) -> Dict[str, str]:
+    """读取归档已有的校验和，缺失或格式错误的 sidecar 被忽略"""
+    digests = {}
+    for algorithm in CHECKSUM_SUFFIXES:
+        try:
+            with open(checksum_path(archive_path, algorithm)) as f:
+                digest = f.read().split()[0]
+        except (OSError, IndexError):
+            continue
+        digests[algorithm] = digest.lower()
+    return digests
+
+
+def remove_checksums(archive_path: str) -> None:
+    for algorithm in CHECKSUM_SUFFIXES:
+        try:
+            os.remove(checksum_path(archive_path, algorithm))
+        except FileNotFoundError:
+            pass
+
+
+def compute_checksums(path: str, algorithms: Iterable[str],
+                      progress_callback: Optional[Callable[[int], None]] = None) -> Dict[str, str]:
+    """流式读取文件计算摘要，每秒最多回调一次已读取的字节数"""
+    hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+    bytes_read = 0
+    last_report = 0.0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b""):
+            for hasher in hashers.values():
+                hasher.update(chunk)
+            bytes_read += len(chunk)
+            if progress_callback and time.time() - last_report >= 1:
+                last_report = time.time()
+                progress_callback(bytes_read)
+    if progress_callback:
+        progress_callback(bytes_read)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+
+def verify_archive(archive_path: str, progress_callback: Optional[Callable[[int], None]] = None) -> Dict:
+    """按 sidecar 中记录的校验和重新计算并比较
+
+    没有 sidecar 时计算 SHA-256 并写入，结果的 ok 为 None（无可比较的记录）。
+    """
+    expected = read_checksums(archive_path)
+    algorithms = resolve_algorithms(expected) or ["sha256"]
+    actual = compute_checksums(archive_path, algorithms, progress_callback)
+    if not expected:
+        write_checksums(archive_path, actual)
+        return {"ok": None, "expected": {}, "actual": actual}
+    mismatched = [algorithm for algorithm in algorithms if actual[algorithm] != expected[algorithm]]
+    return {"ok": not mismatched, "expected": expected, "actual": actual, "mismatched": mismatched}
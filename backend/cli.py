@@ -0,0 +1,202 @@
+"""命令行批量导出
+
+不启动 Web 服务，在进程内按清单文件提交导出任务，与 API 使用同一套调度器、拉取/导出/压缩流水线、层缓存、
+任务存储和下载目录；任务记录写入任务存储，同一下载目录上运行的服务也能看到（多个进程通过租约协调）。
+全部任务结束后输出 JSON 汇总（每个镜像的状态、归档路径、大小、SHA-256 与各阶段耗时），有镜像失败时以非零状态退出。
+
+清单文件:
+- 文本：每行一个镜像名，空行与 # 开头的行忽略
+- JSON（.json）：数组，元素为镜像名或与 POST /api/pull-image 请求体相同的对象（可单独指定 engine、codec、delta_base 等）
+
+用法:
+    python cli.py images.txt --parallel 8 --engine registry --codec zstd --output summary.json
+
+其他配置（下载目录、层缓存、阶段并发上限、镜像仓库与代理等）与服务相同，来自环境变量或 .env。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 等待任务结束时检查任务状态的间隔（秒）
+POLL_INTERVAL = 0.5
+
+
+def read_manifest(path: str) -> List[Dict]:
+    """读取清单文件，返回 ImageRequest 字段组成的字典列表"""
+    with open(path) as f:
+        content = f.read()
+    if path.endswith(".json") or content.lstrip().startswith("["):
+        items = json.loads(content)
+        if not isinstance(items, list):
+            raise ValueError("JSON 清单必须是数组")
+    else:
+        items = [line.strip() for line in content.splitlines()]
+        items = [line for line in items if line and not line.startswith("#")]
+    entries = []
+    for item in items:
+        if isinstance(item, str):
+            item = {"image_name": item}
+        if not isinstance(item, dict) or not str(item.get("image_name") or "").strip():
+            raise ValueError(f"清单条目缺少镜像名: {item!r}")
+        entries.append(dict(item, image_name=str(item["image_name"]).strip()))
+    return entries
+
+
+def archive_result(pipeline, job_id: str, image_name: str) -> Dict:
+    """从任务存储读取任务的最终状态、归档信息与计时"""
+    # 流水线模块在导入时读取配置（含 .env），须在导入 main 之后导入
+    from checksum import read_checksums
+    job = pipeline.job_store.get(job_id) or {}
+    result = {
+        "image_name": image_name,
+        "job_id": job_id,
+        "status": job.get("status", "error"),
+        "detail": job.get("detail"),
+        "file_path": None,
+        "size": None,
+        "sha256": None,
+        "timings": job.get("timings"),
+    }
+    file_path = job.get("file_path")
+    if result["status"] == "complete" and file_path and os.path.exists(file_path):
+        result["file_path"] = file_path
+        result["size"] = os.path.getsize(file_path)
+        result["sha256"] = read_checksums(file_path).get("sha256")
+    return result
+
+
+async def run_batch(pipeline, entries: List[Dict]) -> List[Dict]:
+    """提交全部任务并等待结束，返回与 entries 顺序一致的结果"""
+    pipeline.job_scheduler.start()
+    # 只续租本进程的任务，不接管其他进程中断的任务
+    renew_task = asyncio.create_task(pipeline.renew_leases_periodically(recover=False))
+    results: List[Optional[Dict]] = []
+    pending: Dict[str, int] = {}
+    for entry in entries:
+        try:
+            request = pipeline.ImageRequest(**entry)
+            pipeline.validate_image_request(request)
+        except pipeline.HTTPException as e:
+            results.append({"image_name": entry["image_name"], "status": "rejected", "detail": e.detail})
+            continue
+        except ValueError as e:
+            results.append({"image_name": entry["image_name"], "status": "rejected", "detail": str(e)})
+            continue
+        job_id = await pipeline.start_job(request.image_name, request.model_dump(exclude={"image_name"}))
+        pending[job_id] = len(results)
+        results.append(None)
+    for result in results:
+        if result is not None:
+            logger.error(f"{result['image_name']}: 已拒绝，{result['detail']}")
+
+    total = len(pending)
+    finished = 0
+    try:
+        while pending:
+            await asyncio.sleep(POLL_INTERVAL)
+            # 任务结束后跟踪器被移除，最终状态已写入任务存储
+            for job_id in [job_id for job_id in pending if job_id not in pipeline.progress_trackers]:
+                index = pending.pop(job_id)
+                results[index] = archive_result(pipeline, job_id, entries[index]["image_name"])
+                finished += 1
+                result = results[index]
+                wall = (result["timings"] or {}).get("wall_seconds")
+                message = f"[{finished}/{total}] {result['image_name']}: {result['status']}"
+                if wall is not None:
+                    message += f"，耗时 {wall:.1f} 秒"
+                if result["status"] == "complete":
+                    logger.info(message)
+                else:
+                    logger.error(f"{message}，{result['detail']}")
+    finally:
+        renew_task.cancel()
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="按清单文件批量导出镜像（不启动 Web 服务）")
+    parser.add_argument("manifest", help="清单文件：每行一个镜像名，或 .json 数组")
+    parser.add_argument("--parallel", type=int, default=None,
+                        help="同时执行的任务数，默认使用 MAX_CONCURRENT_JOBS")
+    parser.add_argument("--engine", default="docker", choices=("docker", "registry"), help="拉取引擎")
+    parser.add_argument("--codec", default=None, help="压缩格式，默认使用 COMPRESSION_CODEC")
+    parser.add_argument("--level", type=int, default=None, help="压缩级别，默认使用编解码器的默认级别")
+    parser.add_argument("--layer-cache", action=argparse.BooleanOptionalAction, default=None,
+                        help="是否使用层缓存导出，默认使用 LAYER_CACHE_ENABLED")
+    parser.add_argument("--seekable", action=argparse.BooleanOptionalAction, default=None,
+                        help="分块并行压缩并生成成员索引，默认使用 SEEKABLE_ARCHIVES")
+    parser.add_argument("--downloads-dir", default=None, help="下载目录，默认使用 DOWNLOADS_DIR")
+    parser.add_argument("--output", default=None, help="汇总 JSON 文件，默认输出到标准输出")
+    parser.add_argument("--verbose", action="store_true", help="输出流水线的详细日志")
+    args = parser.parse_args(argv)
+
+    # 日志配置先于 main 中的 basicConfig 生效，默认只输出警告与每个任务的结果
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    logger.setLevel(logging.INFO)
+
+    if args.parallel is not None and args.parallel < 1:
+        parser.error("--parallel 必须大于 0")
+    try:
+        manifest = read_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        parser.error(f"无法读取清单文件: {e}")
+    # 清单中的条目覆盖命令行给出的默认值；同一镜像只导出一次
+    defaults = {"engine": args.engine, "codec": args.codec, "compression_level": args.level,
+                "layer_cache": args.layer_cache, "seekable": args.seekable}
+    entries = {}
+    for item in manifest:
+        if item["image_name"] in entries:
+            logger.warning(f"清单中重复的镜像已忽略: {item['image_name']}")
+            continue
+        entries[item["image_name"]] = {**defaults, **item}
+    entries = list(entries.values())
+
+    # 流水线的配置在导入 main 时读取，须在导入前设置
+    os.environ["DOCKER_PULL_HEADLESS"] = "true"
+    if args.parallel is not None:
+        os.environ["MAX_CONCURRENT_JOBS"] = str(args.parallel)
+    if args.downloads_dir:
+        os.environ["DOWNLOADS_DIR"] = os.path.abspath(args.downloads_dir)
+    import main as pipeline
+
+    started_at = time.time()
+    try:
+        results = asyncio.run(run_batch(pipeline, entries))
+    except KeyboardInterrupt:
+        logger.error("已中断，未结束的任务在租约过期后由服务标记为中断")
+        return 130
+    wall_seconds = time.time() - started_at
+
+    succeeded = [result for result in results if result["status"] == "complete"]
+    report = {
+        "started_at": datetime.fromtimestamp(started_at).isoformat(timespec="seconds"),
+        "wall_seconds": round(wall_seconds, 3),
+        "parallel": pipeline.MAX_CONCURRENT_JOBS,
+        "downloads_dir": os.path.abspath(pipeline.DOWNLOADS_DIR),
+        "total": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "total_bytes": sum(result["size"] or 0 for result in succeeded),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    logger.info(f"完成 {len(succeeded)}/{len(results)} 个镜像，耗时 {wall_seconds:.1f} 秒")
+    return 0 if len(succeeded) == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
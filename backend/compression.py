@@ -0,0 +1,493 @@
+"""压缩编解码器注册表与流式压缩
+
+导出流程通过 get_compression_method 选择编解码器：pigz（多线程 gzip）、gzip（Python 内置，pigz 不可用时的降级方案）、
+zstd（多线程）、lz4 以及不压缩的 none。数据以字节块的形式流式写入压缩器，不需要先落地为未压缩文件。
+导入时 decompress_stream 以同样的方式流式解压，输出直接交给 docker load。
+"""
+import gzip
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from checksum import ChecksumWriter
+from metrics import StageTimings, timed_writer
+
+logger = logging.getLogger(__name__)
+
+# 从环境变量获取压缩超时设置（默认2小时）
+COMPRESSION_TIMEOUT = int(os.getenv("COMPRESSION_TIMEOUT", "7200"))
+DOCKER_SAVE_TIMEOUT = int(os.getenv("DOCKER_SAVE_TIMEOUT", "3600"))
+# docker save 流式导出的块大小与有界缓冲区深度（块数）
+SAVE_CHUNK_SIZE = int(os.getenv("SAVE_CHUNK_SIZE", str(2 * 1024 * 1024)))
+SAVE_BUFFER_CHUNKS = int(os.getenv("SAVE_BUFFER_CHUNKS", "16"))
+# 默认编解码器（auto 表示 pigz 可用时用 pigz，否则用 gzip）与多线程编解码器的线程数（0 表示使用全部 CPU 核心）
+COMPRESSION_CODEC = os.getenv("COMPRESSION_CODEC", "auto")
+COMPRESSION_THREADS = int(os.getenv("COMPRESSION_THREADS", "0")) or os.cpu_count() or 1
+
+
+class Codec:
+    """一种压缩格式
+
+    command/decompress 为 None 时由 Python 进程内完成（gzip 降级方案或不压缩）。
+    family 相同的编解码器输出格式兼容（如 pigz 与 gzip），可以共享层缓存。
+    layer_compatible 表示 docker load 能直接读取用它压缩的层。
+    """
+
+    def __init__(self, name: str, ext: str, family: str, default_level: int, level_range: tuple,
+                 command: Optional[Callable[[int, int], List[str]]] = None,
+                 decompress: Optional[List[str]] = None, multithreaded: bool = False,
+                 layer_compatible: bool = False):
+        self.name = name
+        self.ext = ext
+        self.family = family
+        self.default_level = default_level
+        self.level_range = level_range
+        self._command = command
+        self.decompress = decompress
+        self.multithreaded = multithreaded
+        self.layer_compatible = layer_compatible
+        self._available: Optional[bool] = None
+
+    def build_command(self, level: Optional[int] = None, threads: Optional[int] = None) -> Optional[List[str]]:
+        if self._command is None:
+            return None
+        return self._command(self.resolve_level(level), threads or COMPRESSION_THREADS)
+
+    def resolve_level(self, level: Optional[int] = None) -> int:
+        if level is None:
+            return self.default_level
+        low, high = self.level_range
+        if not low <= level <= high:
+            raise ValueError(f"{self.name} 的压缩级别必须在 {low}-{high} 之间")
+        return level
+
+    def available(self) -> bool:
+        """检查外部压缩工具是否可用，结果会被缓存"""
+        if self._available is None:
+            if self._command is None:
+                self._available = True
+            else:
+                binary = self._command(self.default_level, 1)[0]
+                self._available = check_command_support([binary, "--version"])
+        return self._available
+
+    def info(self) -> Dict:
+        return {
+            "name": self.name,
+            "ext": self.ext,
+            "available": self.available(),
+            "multithreaded": self.multithreaded,
+            "default_level": self.default_level,
+            "level_range": list(self.level_range),
+        }
+
+
+def check_command_support(command: List[str]) -> bool:
+    """检查外部命令是否可以执行"""
+    try:
+        subprocess.run(command, capture_output=True, check=True, timeout=5)
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError, subprocess.TimeoutExpired):
+        return False
+
+
+# 编解码器注册表
+CODECS: Dict[str, Codec] = {
+    "pigz": Codec(
+        "pigz", ".tar.gz", "gzip", 1, (1, 9),
+        command=lambda level, threads: ["pigz", f"-{level}", "-p", str(threads), "-c"],
+        decompress=["pigz", "-d", "-c"],
+        multithreaded=True,
+        layer_compatible=True,
+    ),
+    "gzip": Codec("gzip", ".tar.gz", "gzip", 1, (1, 9), decompress=["gzip", "-d", "-c"], layer_compatible=True),
+    "zstd": Codec(
+        "zstd", ".tar.zst", "zstd", 3, (1, 19),
+        command=lambda level, threads: ["zstd", f"-{level}", f"-T{threads}", "-q", "-c"],
+        decompress=["zstd", "-d", "-q", "-c"],
+        multithreaded=True,
+        layer_compatible=True,
+    ),
+    "lz4": Codec(
+        "lz4", ".tar.lz4", "lz4", 1, (1, 12),
+        command=lambda level, threads: ["lz4", f"-{level}", "-q", "-c"],
+        decompress=["lz4", "-d", "-q", "-c"],
+    ),
+    "none": Codec("none", ".tar", "none", 0, (0, 0)),
+}
+
+# 下载目录中可识别的归档格式，较长的扩展名在前
+ARCHIVE_EXTENSIONS = tuple(sorted({codec.ext for codec in CODECS.values()}, key=len, reverse=True))
+
+
+def get_compression_method(name: Optional[str] = None) -> Codec:
+    """按名称获取编解码器，auto 时优先使用 pigz，不可用则降级为 Python 内置 gzip"""
+    name = name or COMPRESSION_CODEC
+    if name == "auto":
+        return CODECS["pigz"] if CODECS["pigz"].available() else CODECS["gzip"]
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"不支持的压缩格式: {name}，可选: {', '.join(CODECS)}")
+    if not codec.available():
+        raise ValueError(f"压缩工具 {name} 不可用")
+    return codec
+
+
+def codec_for_archive(filename: str) -> Optional[Codec]:
+    """根据归档文件名判断其压缩格式"""
+    for ext in ARCHIVE_EXTENSIONS:
+        if filename.endswith(ext):
+            if ext == ".tar.gz":
+                return get_compression_method("auto")
+            return next(codec for codec in CODECS.values() if codec.ext == ext)
+    return None
+
+
+# 各压缩格式的文件头
+MAGIC_NUMBERS = (
+    (b"\x1f\x8b", "gzip"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"\x04\x22\x4d\x18", "lz4"),
+)
+
+
+def detect_codec(path: str) -> Codec:
+    """按文件头判断归档的压缩格式（不依赖扩展名），无法识别时视为未压缩的 tar；gzip 优先用 pigz 解压"""
+    with open(path, "rb") as f:
+        head = f.read(4)
+    for magic, name in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return get_compression_method("auto") if name == "gzip" else CODECS[name]
+    return CODECS["none"]
+
+
+def decompress_stream(path: str, codec: Codec, chunk_size: int = SAVE_CHUNK_SIZE,
+                      progress_callback: Optional[Callable[[int], None]] = None) -> Iterator[bytes]:
+    """以流的方式解压归档，逐块产出未压缩的数据，不落地为临时文件
+
+    外部解压器（pigz/zstd/lz4）在子进程中运行，由后台线程从文件读取压缩数据写入其标准输入，
+    读盘、解压与调用方消费输出（如上传给 docker load）同时进行；gzip 在进程内解压，none 直接读取。
+    progress_callback 接收已读取的压缩字节数。
+    """
+    if codec.name in ("gzip", "none"):
+        with open(path, "rb") as rawfile:
+            stream = gzip.GzipFile(fileobj=rawfile, mode="rb") if codec.name == "gzip" else rawfile
+            for chunk in iter(lambda: stream.read(chunk_size), b""):
+                if progress_callback:
+                    progress_callback(rawfile.tell())
+                yield chunk
+        return
+
+    if not codec.available():
+        raise ValueError(f"解压 {os.path.basename(path)} 需要 {codec.name}")
+    process = subprocess.Popen(codec.decompress, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, bufsize=1024*1024)
+    feed_errors = []
+
+    def feed_input():
+        bytes_read = 0
+        try:
+            with open(path, "rb") as f:
+                for data in iter(lambda: f.read(chunk_size), b""):
+                    process.stdin.write(data)
+                    bytes_read += len(data)
+                    if progress_callback:
+                        progress_callback(bytes_read)
+        except BrokenPipeError:
+            # 解压进程提前退出，错误由其返回码报告
+            pass
+        except BaseException as e:
+            feed_errors.append(e)
+            process.kill()
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    feed_thread = threading.Thread(target=feed_input, daemon=True)
+    feed_thread.start()
+    finished = False
+    try:
+        for chunk in iter(lambda: process.stdout.read(chunk_size), b""):
+            yield chunk
+        finished = True
+    finally:
+        if not finished and process.poll() is None:
+            # 调用方提前停止读取
+            process.kill()
+        process.wait()
+        feed_thread.join()
+    if feed_errors:
+        raise feed_errors[0]
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, codec.decompress,
+                                            f"解压失败: {process.stderr.read().decode()}")
+
+
+def iter_with_bounded_buffer(chunks, max_chunks=None, timeout=None):
+    """在后台线程中消费 chunks，经有界队列交给调用方，使导出与压缩并行
+
+    Args:
+        chunks: 字节块迭代器（如 docker save 的输出）
+        max_chunks: 队列最多缓存的块数，控制内存占用
+        timeout: 生产者总超时时间（秒），超时后抛出 TimeoutError
+    """
+    max_chunks = max_chunks or SAVE_BUFFER_CHUNKS
+    buffer = queue.Queue(maxsize=max_chunks)
+    stop_event = threading.Event()
+    end_marker = object()
+
+    def put(item):
+        # 消费者提前退出时不能永远阻塞在满队列上
+        while not stop_event.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        start_time = time.time()
+        try:
+            for chunk in chunks:
+                if timeout and time.time() - start_time > timeout:
+                    raise TimeoutError(f"Docker保存操作超时（{timeout}秒）")
+                if not put(chunk):
+                    return
+            put(end_marker)
+        except BaseException as e:
+            put(e)
+
+    producer_thread = threading.Thread(target=producer, daemon=True)
+    producer_thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is end_marker:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop_event.set()
+
+
+def process_exited(process: subprocess.Popen) -> bool:
+    """子进程是否已退出；不回收进程（Popen.poll 会回收），回收留给 wait_with_rusage 以取得其 CPU 时间"""
+    if process.returncode is not None:
+        return True
+    if not hasattr(os, "waitid") or not hasattr(os, "WNOWAIT"):
+        return process.poll() is not None
+    try:
+        return os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+    except ChildProcessError:
+        return True
+
+
+def wait_with_rusage(process: subprocess.Popen, timeout: float) -> Optional[float]:
+    """等待子进程结束，返回其 CPU 时间（用户态 + 内核态，秒）；平台不支持 wait4 时返回 None"""
+    if not hasattr(os, "wait4"):
+        process.wait(timeout=timeout)
+        return None
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            # 已被回收（如 process_exited 不可用时的 poll）
+            process.wait()
+            return None
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return rusage.ru_utime + rusage.ru_stime
+        if time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(0.05)
+
+
+def compress_stream(input_chunks, output_path, codec: Optional[Codec] = None, level: Optional[int] = None,
+                    threads: Optional[int] = None, progress_callback=None, buffer_chunks: Optional[int] = None,
+                    checksum_algorithms: Iterable[str] = (),
+                    timings: Optional[StageTimings] = None) -> Dict[str, str]:
+    """使用指定编解码器进行流式压缩，带超时控制和进度反馈
+
+    输入以流的方式逐块写入压缩器，不需要先落地为未压缩的 tar 文件。
+    先写入 output_path + ".tmp"，成功后重命名。压缩输出写入文件的同时计算 checksum_algorithms
+    中各算法的摘要，返回 {算法: 十六进制摘要}。
+
+    Args:
+        input_chunks: 字节块迭代器（如 docker save 的输出）
+        output_path: 输出文件路径
+        codec: 编解码器，默认按 COMPRESSION_CODEC 选择
+        level: 压缩级别，默认使用编解码器的默认级别
+        threads: 多线程编解码器使用的线程数，默认 COMPRESSION_THREADS
+        progress_callback: 可选的进度回调函数，接收已写入压缩器的字节数
+        buffer_chunks: 输入与压缩器之间有界缓冲区的块数
+        checksum_algorithms: 对压缩输出计算的校验和算法（如 sha256）
+        timings: 记录 compress（写入压缩器）与 write（写入磁盘）阶段的耗时，以及压缩进程的 CPU 时间
+    """
+    codec = codec or get_compression_method()
+    level = codec.resolve_level(level)
+    temp_output = output_path + ".tmp"
+    chunks = iter_with_bounded_buffer(input_chunks, max_chunks=buffer_chunks, timeout=DOCKER_SAVE_TIMEOUT)
+    start_time = time.time()
+    bytes_copied = 0
+    last_report = 0.0
+
+    def report(force=False):
+        nonlocal last_report
+        now = time.time()
+        if progress_callback and (force or now - last_report >= 1):
+            last_report = now
+            progress_callback(bytes_copied)
+
+    def check_timeout():
+        if time.time() - start_time > COMPRESSION_TIMEOUT:
+            raise TimeoutError(f"压缩操作超时（{COMPRESSION_TIMEOUT}秒）")
+
+    try:
+        cmd = codec.build_command(level, threads)
+        if cmd is None:
+            # 进程内完成：Python 内置 gzip 或不压缩
+            with open(temp_output, 'wb') as rawfile:
+                checksum_writer = ChecksumWriter(timed_writer(rawfile, timings), checksum_algorithms)
+                if codec.name == "gzip":
+                    outfile = gzip.GzipFile(fileobj=checksum_writer, mode='wb', compresslevel=level)
+                else:
+                    outfile = checksum_writer
+                for chunk in chunks:
+                    check_timeout()
+                    if timings is not None and outfile is not checksum_writer:
+                        # 压缩与写盘在同一个调用中完成，压缩耗时需扣除其中写盘的部分
+                        start = time.perf_counter()
+                        write_seconds = timings.seconds("write")
+                        outfile.write(chunk)
+                        elapsed = time.perf_counter() - start - (timings.seconds("write") - write_seconds)
+                        timings.add("compress", elapsed, len(chunk))
+                    else:
+                        outfile.write(chunk)
+                    bytes_copied += len(chunk)
+                    report()
+                if outfile is not checksum_writer:
+                    outfile.close()
+            report(force=True)
+            os.rename(temp_output, output_path)
+            return checksum_writer.hexdigests()
+
+        with open(temp_output, 'wb') as outfile:
+            checksum_writer = ChecksumWriter(timed_writer(outfile, timings), checksum_algorithms)
+            process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=1024*1024  # 1MB缓冲区
+            )
+            # 压缩输出经管道读回，写入文件的同时计算校验和
+            drain_errors = []
+
+            def drain_output():
+                try:
+                    for data in iter(lambda: process.stdout.read(SAVE_CHUNK_SIZE), b""):
+                        checksum_writer.write(data)
+                except BaseException as e:
+                    drain_errors.append(e)
+                    process.kill()
+
+            drain_thread = threading.Thread(target=drain_output, daemon=True)
+            drain_thread.start()
+
+            def reap():
+                """回收已退出（或已被终止）的压缩进程，记录其 CPU 时间"""
+                cpu_seconds = wait_with_rusage(process, 30)
+                if timings is not None and cpu_seconds is not None:
+                    timings.add_cpu(codec.name, cpu_seconds)
+
+            try:
+                for chunk in chunks:
+                    # 检查是否超时
+                    try:
+                        check_timeout()
+                    except TimeoutError:
+                        process.kill()
+                        raise
+
+                    try:
+                        # 压缩器处理不过来时管道写满，写入在此阻塞
+                        start = time.perf_counter()
+                        process.stdin.write(chunk)
+                        if timings is not None:
+                            timings.add("compress", time.perf_counter() - start, len(chunk))
+                        bytes_copied += len(chunk)
+                        report()
+
+                        # 检查进程是否还活着
+                        if process_exited(process):
+                            reap()
+                            stderr = process.stderr.read().decode()
+                            raise subprocess.CalledProcessError(
+                                process.returncode,
+                                cmd,
+                                f"压缩进程意外退出: {stderr}"
+                            )
+                    except BrokenPipeError:
+                        reap()
+                        stderr = process.stderr.read().decode()
+                        raise subprocess.CalledProcessError(
+                            process.returncode,
+                            cmd,
+                            f"压缩进程管道断开: {stderr}"
+                        )
+            except BaseException:
+                if not process_exited(process):
+                    process.kill()
+                reap()
+                drain_thread.join()
+                if drain_errors:
+                    raise drain_errors[0]
+                raise
+
+            # 关闭输入流并等待进程完成
+            start = time.perf_counter()
+            process.stdin.close()
+            try:
+                reap()  # 给进程30秒完成压缩
+                if timings is not None:
+                    timings.add("compress", time.perf_counter() - start)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                raise TimeoutError("压缩进程未能在30秒内完成")
+            finally:
+                drain_thread.join()
+            if drain_errors:
+                raise drain_errors[0]
+
+            if process.returncode != 0:
+                stderr = process.stderr.read().decode()
+                raise subprocess.CalledProcessError(
+                    process.returncode,
+                    cmd,
+                    f"压缩失败: {stderr}"
+                )
+
+        report(force=True)
+        # 压缩成功，重命名临时文件
+        os.rename(temp_output, output_path)
+        return checksum_writer.hexdigests()
+
+    except Exception as e:
+        # 清理临时文件
+        if os.path.exists(temp_output):
+            try:
+                os.unlink(temp_output)
+            except:
+                pass
+        raise e
+    finally:
+        chunks.close()
@@ -0,0 +1,37 @@
+"""多个 worker 进程（uvicorn --workers 或多个副本）共享同一下载目录时的协调
+
+- WORKER_ID 标识当前进程，任务与租约记录在任务存储中的持有者（见 job_store.JobStore 的租约方法）
+- file_lock 以 flock 对共享目录中的文件加排他锁，用于层 blob 下载、存储状态文件等只能有一个写入者的场合
+
+不支持 fcntl 的平台上 file_lock 退化为不加锁，只能以单进程运行。
+"""
+import logging
+import os
+import socket
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 当前 worker 的标识：主机名、进程号与随机后缀，进程重启后不会与旧的租约混淆
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+@contextmanager
+def file_lock(path: str):
+    """在 path 上加排他锁（不存在时创建），阻塞直到获得；同一进程内的不同线程之间同样互斥"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,233 @@
+"""相对基础镜像的增量归档
+
+增量归档与普通的层缓存归档格式相同（manifest.json + 配置 + 各层），只是省略了基础镜像中已有的层，
+并附带 delta.json 记录省略了哪些层（manifest 中的路径 -> diff_id）以及基础镜像/归档的身份。
+
+接收方有两种方式还原：
+- 基础镜像已经 docker load 过：直接 docker load 增量归档，已存在的层不会再读取文件
+- 只有基础归档：用 python delta.py apply --base <基础归档> --delta <增量归档> --output <完整归档>
+  重建完整的 docker load 兼容归档（读取基础归档两遍，不需要 Docker daemon）
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tarfile
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set
+
+from archive_meta import read_archive_meta
+from checksum import read_checksums
+from compression import codec_for_archive
+from seekable import ArchiveNotSeekable, iter_member, list_members
+
+logger = logging.getLogger(__name__)
+
+DELTA_MANIFEST = "delta.json"
+DELTA_FORMAT = "docker-pull-delta/v1"
+# 扫描归档时缓存在内存中的 JSON 成员（manifest 与镜像配置）的大小上限
+MAX_JSON_MEMBER_SIZE = 4 * 1024 * 1024
+
+
+def delta_manifest(base: Dict, omitted_layers: Dict[str, str]) -> bytes:
+    """生成 delta.json：base 为基础镜像/归档的身份，omitted_layers 为 {manifest 中的层路径: diff_id}"""
+    return json.dumps({
+        "format": DELTA_FORMAT,
+        "base": base,
+        "base_layers": omitted_layers,
+        "created_at": int(time.time()),
+    }, ensure_ascii=False, indent=2).encode()
+
+
+@contextmanager
+def open_archive(path: str):
+    """以流的方式打开归档，按扩展名选择解压方式，返回未压缩 tar 的文件对象"""
+    codec = codec_for_archive(path)
+    if codec is None:
+        raise ValueError(f"无法识别的归档格式: {os.path.basename(path)}")
+    if codec.name == "none":
+        with open(path, "rb") as f:
+            yield f
+        return
+    if codec.name == "gzip":
+        with gzip.open(path, "rb") as f:
+            yield f
+        return
+    if not codec.available():
+        raise ValueError(f"解压 {os.path.basename(path)} 需要 {codec.name}")
+    process = subprocess.Popen(codec.decompress + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        yield process.stdout
+        # 读取方可能没有读完，剩余的数据直接丢弃
+        for _ in iter(lambda: process.stdout.read(1024 * 1024), b""):
+            pass
+    finally:
+        if process.poll() is None:
+            process.stdout.close()
+            process.kill()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, codec.decompress, process.stderr.read().decode())
+
+
+def read_json_members_directly(path: str) -> Optional[Dict[str, bytes]]:
+    """可以随机读取成员的归档（有成员索引或未压缩）只读取 manifest、delta.json 与镜像配置，否则返回 None"""
+    try:
+        names = {member["name"] for member in list_members(path)[0]}
+    except ArchiveNotSeekable:
+        return None
+
+    def read(name: str) -> Optional[bytes]:
+        if name not in names:
+            return None
+        try:
+            return b"".join(iter_member(path, name)[1])
+        except KeyError:
+            return None
+
+    json_members = {name: read(name) for name in ("manifest.json", DELTA_MANIFEST)}
+    if json_members["manifest.json"]:
+        for entry in json.loads(json_members["manifest.json"]):
+            json_members[entry["Config"]] = read(entry["Config"])
+    return {name: data for name, data in json_members.items() if data is not None}
+
+
+def read_archive_index(path: str) -> Dict:
+    """扫描归档，返回 manifest、各镜像 ID 以及 {层路径: diff_id}
+
+    manifest 中第 i 个层对应镜像配置 rootfs.diff_ids 的第 i 项，与归档的具体格式（docker save 新旧格式、
+    层缓存格式、registry 引擎格式）无关。可以随机读取成员的归档不需要完整扫描。
+    """
+    json_members = read_json_members_directly(path)
+    if json_members is None:
+        json_members = {}
+        with open_archive(path) as stream:
+            with tarfile.open(fileobj=stream, mode="r|") as archive:
+                for member in archive:
+                    if not member.isfile() or member.size > MAX_JSON_MEMBER_SIZE:
+                        continue
+                    data = archive.extractfile(member).read()
+                    if data[:1] in (b"{", b"["):
+                        json_members[member.name] = data
+    if DELTA_MANIFEST in json_members:
+        raise ValueError(f"{os.path.basename(path)} 是增量归档，不能作为基础")
+    if "manifest.json" not in json_members:
+        raise ValueError(f"{os.path.basename(path)} 不是 docker save 格式的归档（缺少 manifest.json）")
+
+    manifest = json.loads(json_members["manifest.json"])
+    layers: Dict[str, str] = {}
+    image_ids: List[str] = []
+    for entry in manifest:
+        config_data = json_members.get(entry["Config"])
+        if config_data is None:
+            raise ValueError(f"{os.path.basename(path)} 缺少镜像配置 {entry['Config']}")
+        image_ids.append("sha256:" + hashlib.sha256(config_data).hexdigest())
+        diff_ids = json.loads(config_data).get("rootfs", {}).get("diff_ids", [])
+        layers.update(zip(entry.get("Layers", []), diff_ids))
+    return {"manifest": manifest, "image_ids": image_ids, "layers": layers}
+
+
+def archive_diff_ids(path: str) -> Set[str]:
+    """归档中包含的全部层的 diff_id，优先读取元数据 sidecar，没有时扫描归档"""
+    meta = read_archive_meta(path)
+    if meta and meta.get("delta"):
+        raise ValueError(f"{os.path.basename(path)} 是增量归档，不能作为基础")
+    if meta and (meta.get("layers") or meta.get("bundle")):
+        diff_ids = set(meta.get("layers") or [])
+        for image in meta.get("bundle") or []:
+            diff_ids.update(image.get("layers") or [])
+        return diff_ids
+    return set(read_archive_index(path)["layers"].values())
+
+
+def archive_base_info(path: str) -> Dict:
+    """记录在 delta.json 中的基础归档身份"""
+    meta = read_archive_meta(path) or {}
+    info = {"archive": os.path.basename(path), "size": os.path.getsize(path)}
+    if meta.get("image_id"):
+        info["image_id"] = meta["image_id"]
+    if meta.get("repo_tags"):
+        info["repo_tags"] = meta["repo_tags"]
+    info.update(read_checksums(path))
+    return info
+
+
+def apply_delta(base_path: str, delta_path: str, output_path: str) -> Dict:
+    """由基础归档与增量归档重建完整的 docker load 兼容归档（未压缩的 tar），返回 delta.json 的内容
+
+    增量归档的成员原样写入，省略的层从基础归档中按 diff_id 找到后以增量 manifest 中的路径写入。
+    """
+    temp_output = output_path + ".tmp"
+    delta = None
+    try:
+        with open(temp_output, "wb") as outfile, tarfile.open(fileobj=outfile, mode="w|") as output:
+            with open_archive(delta_path) as stream, tarfile.open(fileobj=stream, mode="r|") as source:
+                for member in source:
+                    if member.name == DELTA_MANIFEST:
+                        delta = json.loads(source.extractfile(member).read())
+                        continue
+                    output.addfile(member, source.extractfile(member) if member.isfile() else None)
+            if delta is None or delta.get("format") != DELTA_FORMAT:
+                raise ValueError(f"{os.path.basename(delta_path)} 不是增量归档（缺少 {DELTA_MANIFEST}）")
+
+            expected_sha256 = delta["base"].get("sha256")
+            actual_sha256 = read_checksums(base_path).get("sha256")
+            if expected_sha256 and actual_sha256 and expected_sha256 != actual_sha256:
+                logger.warning("基础归档的 SHA-256 与增量归档记录的不一致，按层 diff_id 继续匹配")
+
+            base_members = {diff_id: name for name, diff_id in read_archive_index(base_path)["layers"].items()}
+            wanted: Dict[str, List[str]] = {}
+            for layer_name, diff_id in delta["base_layers"].items():
+                if diff_id not in base_members:
+                    raise ValueError(f"基础归档中缺少层 {diff_id}")
+                wanted.setdefault(base_members[diff_id], []).append(layer_name)
+
+            with open_archive(base_path) as stream, tarfile.open(fileobj=stream, mode="r|") as source:
+                for member in source:
+                    if member.name not in wanted or not member.isfile():
+                        continue
+                    names = wanted.pop(member.name)
+                    fileobj = source.extractfile(member)
+                    info = tarfile.TarInfo(names[0])
+                    info.size = member.size
+                    info.mtime = member.mtime
+                    info.mode = 0o644
+                    output.addfile(info, fileobj)
+                    for name in names[1:]:
+                        # 同一层被多个路径引用（极少见），以硬链接指向第一个
+                        link = tarfile.TarInfo(name)
+                        link.type = tarfile.LNKTYPE
+                        link.linkname = names[0]
+                        output.addfile(link)
+            if wanted:
+                raise ValueError(f"基础归档中缺少层文件: {', '.join(wanted)}")
+        os.replace(temp_output, output_path)
+        return delta
+    except BaseException:
+        if os.path.exists(temp_output):
+            os.unlink(temp_output)
+        raise
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="增量归档工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    apply_parser = subparsers.add_parser("apply", help="由基础归档与增量归档重建完整归档")
+    apply_parser.add_argument("--base", required=True, help="基础归档")
+    apply_parser.add_argument("--delta", required=True, help="增量归档")
+    apply_parser.add_argument("--output", required=True, help="输出的完整归档（未压缩 tar，可直接 docker load）")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    delta = apply_delta(args.base, args.delta, args.output)
+    logger.info(f"已重建 {args.output}，从基础归档补齐 {len(delta['base_layers'])} 个层")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
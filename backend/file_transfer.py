@@ -0,0 +1,231 @@
+"""归档文件的 HTTP 传输
+
+支持 Range/If-Range 断点续传与多段并行下载（206，多个区间时返回 multipart/byteranges）、
+基于文件身份的 ETag、HEAD 请求。服务器在 ASGI 扩展中声明 http.response.zerocopysend 时
+使用 sendfile 零拷贝发送，否则在线程中按块读取；也可以通过 X-Accel-Redirect 交给前置的 nginx 发送。
+"""
+import logging
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from functools import partial
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from fastapi import Request
+from fastapi.responses import Response
+
+logger = logging.getLogger(__name__)
+
+# 非零拷贝发送时每次读取的块大小
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+
+class RangeNotSatisfiable(Exception):
+    """Range 请求的区间全部超出文件范围"""
+
+
+def file_etag(stat: os.stat_result) -> str:
+    """由文件身份（inode、大小、修改时间）生成强 ETag，文件被替换或改写后随之变化"""
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range_header(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """解析 Range 请求头，返回合并后的闭区间列表
+
+    格式无法识别时返回 None（按整个文件响应），区间全部越界时抛出 RangeNotSatisfiable。
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start_text, separator, end_text = part.partition("-")
+        if not separator:
+            return None
+        try:
+            if not start_text.strip():
+                # 后缀区间：最后 N 个字节，空文件没有可返回的字节
+                length = int(end_text)
+                if length <= 0 or size == 0:
+                    continue
+                ranges.append((max(0, size - length), size - 1))
+                continue
+            start = int(start_text)
+            end = int(end_text) if end_text.strip() else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _if_range_matches(if_range: str, etag: str, stat: os.stat_result) -> bool:
+    """If-Range 可以是 ETag（只接受强比较）或 Last-Modified 日期"""
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        return if_range == etag
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == int(stat.st_mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def _etag_listed(header: str, etag: str) -> bool:
+    """If-None-Match 使用弱比较"""
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+class FileRangeResponse(Response):
+    """发送文件的一个或多个区间，parts 为 (起始偏移, 结束偏移, 区间前的 multipart 头) 列表"""
+
+    def __init__(self, path: str, status_code: int, headers: dict, parts: List[Tuple[int, int, bytes]],
+                 trailer: bytes = b"", send_body: bool = True, media_type: str = "application/octet-stream"):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.parts = parts
+        self.trailer = trailer
+        self.send_body = send_body
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if not self.send_body:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+            zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+            async with anyio.create_task_group() as task_group:
+                async def wrap(func):
+                    await func()
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(wrap, partial(self._send_body, send, zerocopy))
+                await wrap(partial(self._listen_for_disconnect, receive))
+        finally:
+            # 与 Starlette 的 Response 一样在发送结束后执行 background，客户端断开时也会执行
+            if self.background is not None:
+                await self.background()
+
+    async def _listen_for_disconnect(self, receive):
+        # 客户端断开后停止读取文件
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+
+    async def _send_body(self, send, zerocopy: bool):
+        if zerocopy:
+            with open(self.path, "rb") as f:
+                for start, end, header in self.parts:
+                    if header:
+                        await send({"type": "http.response.body", "body": header, "more_body": True})
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": f,
+                        "offset": start,
+                        "count": end - start + 1,
+                        "more_body": True,
+                    })
+        else:
+            async with await anyio.open_file(self.path, "rb") as f:
+                for start, end, header in self.parts:
+                    if header:
+                        await send({"type": "http.response.body", "body": header, "more_body": True})
+                    await f.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        chunk = await f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": self.trailer, "more_body": False})
+
+
+def file_response(request: Request, path: str, filename: Optional[str] = None,
+                  media_type: str = "application/octet-stream",
+                  accel_redirect: Optional[str] = None) -> Response:
+    """按请求头返回文件的完整内容、部分内容（206）、304 或 416
+
+    accel_redirect 为前置 nginx 的 internal location 路径时，只返回 X-Accel-Redirect，
+    由 nginx 以 sendfile 发送文件并处理 Range。
+    """
+    filename = filename or os.path.basename(path)
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = file_etag(stat)
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "last-modified": formatdate(stat.st_mtime, usegmt=True),
+        "content-disposition": content_disposition(filename),
+    }
+
+    if accel_redirect:
+        headers["x-accel-redirect"] = accel_redirect
+        return Response(status_code=200, headers=headers, media_type=media_type)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_listed(if_none_match, etag):
+        return Response(status_code=304, headers={key: headers[key] for key in ("etag", "last-modified")})
+
+    send_body = request.method != "HEAD"
+    ranges = None
+    range_header = request.headers.get("range")
+    if range_header:
+        if_range = request.headers.get("if-range")
+        if not if_range or _if_range_matches(if_range, etag, stat):
+            try:
+                ranges = parse_range_header(range_header, size)
+            except RangeNotSatisfiable:
+                return Response(status_code=416, headers={"content-range": f"bytes */{size}", "accept-ranges": "bytes"})
+
+    if not ranges:
+        headers["content-length"] = str(size)
+        return FileRangeResponse(path, 200, headers, [(0, size - 1, b"")] if size else [],
+                                 send_body=send_body, media_type=media_type)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["content-range"] = f"bytes {start}-{end}/{size}"
+        headers["content-length"] = str(end - start + 1)
+        return FileRangeResponse(path, 206, headers, [(start, end, b"")], send_body=send_body, media_type=media_type)
+
+    # 多个区间：multipart/byteranges
+    boundary = uuid.uuid4().hex
+    parts = []
+    length = 0
+    for start, end in ranges:
+        header = (f"\r\n--{boundary}\r\nContent-Type: {media_type}\r\n"
+                  f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+        parts.append((start, end, header))
+        length += len(header) + end - start + 1
+    trailer = f"\r\n--{boundary}--\r\n".encode()
+    headers["content-length"] = str(length + len(trailer))
+    return FileRangeResponse(path, 206, headers, parts, trailer=trailer, send_body=send_body,
+                             media_type=f"multipart/byteranges; boundary={boundary}")
@@ -0,0 +1,268 @@
+"""持久化的任务存储
+
+任务记录保存在 SQLite（WAL 模式）中，内存里只保留正在运行的任务的进度跟踪器。
+任务结束后保存最终的日志与层信息，超过 TTL 后压缩为只含状态、进度等字段的摘要，
+超过保留期的摘要被删除。
+
+多个 worker 进程共享同一个数据库：每个未结束的任务由一个 worker 持有（owner），持有者定期续租
+（lease_expires）；租约过期的任务（持有者已退出）由其他 worker 通过 claim 原子地接管。
+leases 表记录跨 worker 的互斥租约（如同一镜像的导出、同一目标文件的写入）。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 任务的终止状态
+FINISHED_STATUSES = ("complete", "error")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    image_name TEXT NOT NULL,
+    params TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    detail TEXT,
+    file_path TEXT,
+    output TEXT,
+    layers TEXT,
+    timings TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL,
+    compacted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at);
+CREATE INDEX IF NOT EXISTS jobs_image_name ON jobs (image_name, created_at);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, finished_at);
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    job_id TEXT,
+    expires_at REAL NOT NULL
+);
+"""
+
+# 可以通过 update 修改的列
+_UPDATABLE_COLUMNS = ("status", "progress", "detail", "file_path", "output", "layers", "timings", "finished_at",
+                      "params")
+# 以 JSON 保存的列
+_JSON_COLUMNS = ("params", "output", "layers", "timings")
+# 列表接口返回的摘要列（不含日志与层信息）；计时明细很小，压缩后仍保留，便于事后分析慢任务
+_SUMMARY_COLUMNS = ("id", "image_name", "params", "status", "progress", "detail", "file_path", "timings",
+                    "owner", "created_at", "updated_at", "finished_at", "compacted")
+# 旧版本数据库中没有的列，打开时补上
+_ADDED_COLUMNS = {"timings": "TEXT", "owner": "TEXT", "lease_expires": "REAL"}
+
+
+class JobStore:
+    """基于 SQLite 的任务存储，可在多个线程中使用"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        # 多个进程同时写入时等待锁的时间
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 只在检查点时 fsync，进度更新不会频繁刷盘
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in _ADDED_COLUMNS.items():
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        logger.info(f"任务存储: {path}")
+
+    def _execute(self, sql: str, args: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, args)
+
+    @staticmethod
+    def _decode(row: Optional[sqlite3.Row]) -> Optional[Dict]:
+        if row is None:
+            return None
+        job = dict(row)
+        for key in _JSON_COLUMNS:
+            if job.get(key) is not None:
+                job[key] = json.loads(job[key])
+        job["compacted"] = bool(job.get("compacted"))
+        return job
+
+    def create(self, job_id: str, image_name: str, params: Dict, status: str = "starting",
+               detail: str = "准备开始下载...", owner: Optional[str] = None, lease_ttl: float = 0) -> None:
+        now = time.time()
+        self._execute(
+            "INSERT INTO jobs (id, image_name, params, status, detail, owner, lease_expires, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, image_name, json.dumps(params), status, detail, owner, now + lease_ttl if owner else None,
+             now, now),
+        )
+
+    def update(self, job_id: str, **fields) -> None:
+        """更新任务字段，output/layers/timings/params 会序列化为 JSON"""
+        columns = []
+        values = []
+        for key, value in fields.items():
+            if key not in _UPDATABLE_COLUMNS:
+                raise ValueError(f"未知的任务字段: {key}")
+            if key in _JSON_COLUMNS and value is not None:
+                value = json.dumps(value, ensure_ascii=False)
+            columns.append(f"{key} = ?")
+            values.append(value)
+        columns.append("updated_at = ?")
+        values.append(time.time())
+        self._execute(f"UPDATE jobs SET {', '.join(columns)} WHERE id = ?", (*values, job_id))
+
+    def finish(self, job_id: str, snapshot: Dict) -> None:
+        """保存任务的最终状态、日志、层信息与计时明细"""
+        self.update(
+            job_id,
+            status=snapshot["status"],
+            progress=snapshot.get("progress", 0),
+            detail=snapshot.get("detail"),
+            output=list(snapshot.get("output") or []),
+            layers=snapshot.get("layers") or {},
+            timings=snapshot.get("timings"),
+            finished_at=time.time(),
+        )
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        return self._decode(self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def latest_for_image(self, image_name: str) -> Optional[Dict]:
+        row = self._execute(
+            "SELECT * FROM jobs WHERE image_name = ? ORDER BY created_at DESC LIMIT 1", (image_name,)
+        ).fetchone()
+        return self._decode(row)
+
+    def list(self, limit: int = 20, offset: int = 0, status: Optional[str] = None,
+             image_name: Optional[str] = None) -> Tuple[int, List[Dict]]:
+        """按创建时间倒序分页返回任务摘要，以及符合条件的任务总数"""
+        conditions = []
+        args: list = []
+        if status:
+            conditions.append("status = ?")
+            args.append(status)
+        if image_name:
+            conditions.append("image_name = ?")
+            args.append(image_name)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        total = self._execute(f"SELECT COUNT(*) FROM jobs {where}", tuple(args)).fetchone()[0]
+        rows = self._execute(
+            f"SELECT {', '.join(_SUMMARY_COLUMNS)} FROM jobs {where} "
+            f"ORDER BY created_at DESC LIMIT ? OFFSET ?",
+            (*args, limit, offset),
+        ).fetchall()
+        return total, [self._decode(row) for row in rows]
+
+    def unfinished(self) -> List[Dict]:
+        """未结束的任务（服务重启后即为被中断的任务）"""
+        placeholders = ", ".join("?" for _ in FINISHED_STATUSES)
+        rows = self._execute(
+            f"SELECT * FROM jobs WHERE status NOT IN ({placeholders}) ORDER BY created_at",
+            FINISHED_STATUSES,
+        ).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def compact(self, ttl_seconds: float, retention_seconds: float = 0) -> Tuple[int, int]:
+        """将结束超过 ttl_seconds 的任务压缩为摘要，删除结束超过 retention_seconds 的任务
+
+        retention_seconds 为 0 时不删除。返回（压缩数，删除数）。
+        """
+        now = time.time()
+        compacted = self._execute(
+            "UPDATE jobs SET output = NULL, layers = NULL, compacted = 1 "
+            "WHERE compacted = 0 AND finished_at IS NOT NULL AND finished_at < ?",
+            (now - ttl_seconds,),
+        ).rowcount
+        deleted = 0
+        if retention_seconds > 0:
+            deleted = self._execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?",
+                (now - retention_seconds,),
+            ).rowcount
+        if compacted or deleted:
+            logger.info(f"任务存储: 压缩 {compacted} 个任务，删除 {deleted} 个过期任务")
+        return compacted, deleted
+
+    # 任务持有与租约
+
+    def claim(self, job_id: str, owner: str, ttl: float) -> bool:
+        """原子地取得未结束任务的持有权：任务无人持有、已由 owner 持有或原持有者的租约已过期时成功"""
+        now = time.time()
+        placeholders = ", ".join("?" for _ in FINISHED_STATUSES)
+        return self._execute(
+            f"UPDATE jobs SET owner = ?, lease_expires = ? WHERE id = ? AND status NOT IN ({placeholders}) "
+            f"AND (owner IS NULL OR owner = ? OR lease_expires IS NULL OR lease_expires < ?)",
+            (owner, now + ttl, job_id, *FINISHED_STATUSES, owner, now),
+        ).rowcount == 1
+
+    def expired(self) -> List[Dict]:
+        """未结束且无人持有或租约已过期的任务（持有者已退出）"""
+        placeholders = ", ".join("?" for _ in FINISHED_STATUSES)
+        rows = self._execute(
+            f"SELECT * FROM jobs WHERE status NOT IN ({placeholders}) "
+            f"AND (owner IS NULL OR lease_expires IS NULL OR lease_expires < ?) ORDER BY created_at",
+            (*FINISHED_STATUSES, time.time()),
+        ).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def renew(self, owner: str, ttl: float) -> List[str]:
+        """延长 owner 持有的未结束任务与租约，返回仍由 owner 持有的未结束任务 ID"""
+        expires = time.time() + ttl
+        placeholders = ", ".join("?" for _ in FINISHED_STATUSES)
+        self._execute(
+            f"UPDATE jobs SET lease_expires = ? WHERE owner = ? AND status NOT IN ({placeholders})",
+            (expires, owner, *FINISHED_STATUSES),
+        )
+        self._execute("UPDATE leases SET expires_at = ? WHERE owner = ?", (expires, owner))
+        rows = self._execute(
+            f"SELECT id FROM jobs WHERE owner = ? AND status NOT IN ({placeholders})", (owner, *FINISHED_STATUSES)
+        ).fetchall()
+        return [row["id"] for row in rows]
+
+    def acquire_leases(self, keys: List[str], owner: str, job_id: str, ttl: float) -> Optional[Dict]:
+        """在一个事务中取得全部租约，成功返回 None；任一租约被其他任务持有且未过期时全部放弃，返回其持有者"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for key in keys:
+                    acquired = self._conn.execute(
+                        "INSERT INTO leases (key, owner, job_id, expires_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, job_id = excluded.job_id, "
+                        "expires_at = excluded.expires_at WHERE leases.job_id = excluded.job_id OR leases.expires_at < ?",
+                        (key, owner, job_id, now + ttl, now),
+                    ).rowcount
+                    if not acquired:
+                        holder = self._conn.execute("SELECT * FROM leases WHERE key = ?", (key,)).fetchone()
+                        self._conn.execute("ROLLBACK")
+                        return dict(holder)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return None
+
+    def release_leases(self, job_id: str, owner: str, keys: Optional[List[str]] = None) -> None:
+        """释放 owner 为任务取得的租约，keys 为 None 时释放全部
+
+        任务被其他 worker 接管后，原持有者不会误删新持有者的租约。
+        """
+        if keys is None:
+            self._execute("DELETE FROM leases WHERE job_id = ? AND owner = ?", (job_id, owner))
+            return
+        for key in keys:
+            self._execute("DELETE FROM leases WHERE key = ? AND job_id = ? AND owner = ?", (key, job_id, owner))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
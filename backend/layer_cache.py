@@ -0,0 +1,207 @@
+"""按内容寻址的压缩层缓存
+
+导出过的镜像层以压缩后的形式按摘要保存，后续导出相同的层时直接复用，
+多个基于同一基础镜像的导出只需保存和压缩一次基础层。缓存按总大小做 LRU 淘汰，
+正在被导出使用的层会被固定，不会被淘汰。
+
+多个 worker 进程可以共享同一个缓存目录：其他进程写入的条目在查找时从磁盘发现；
+固定只在进程内有效，因此最近 EVICTION_GRACE_SECONDS 秒内被使用过（mtime 更新过）的条目不会被淘汰。
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 未完成的文件与锁文件的后缀，扫描缓存时忽略
+PARTIAL_SUFFIXES = (".partial", ".tmp", ".lock")
+# 超过此时长未更新的 .tmp 视为中断遗留，启动时删除（更新的可能正由其他 worker 写入）
+STALE_TEMP_SECONDS = 3600
+# 最近使用过的条目不被淘汰的时长，保护其他 worker 正在使用的层
+EVICTION_GRACE_SECONDS = 600
+
+
+class LayerCache:
+    """压缩层缓存
+
+    键是相对路径形式的字符串，例如 blobs/<digest> 表示仓库中的原始压缩 blob，
+    layers/gzip/<diff_id> 表示本地压缩的层。文件的 mtime 记录最近一次使用时间，
+    重启后据此恢复 LRU 顺序。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._pins: Counter = Counter()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_reused = 0
+        self.bytes_stored = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """扫描缓存目录，按 mtime 恢复 LRU 顺序"""
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    # 上次运行中断时未写完的临时文件，.partial 保留用于续传
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        if time.time() - os.path.getmtime(path) > STALE_TEMP_SECONDS:
+                            os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if filename.endswith(PARTIAL_SUFFIXES):
+                    continue
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                found.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.total_bytes += size
+        logger.info(f"层缓存: {self.root}，{len(self._entries)} 个条目，"
+                    f"{self.total_bytes / (1024 * 1024):.1f}MB")
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def partial_path(self, key: str) -> str:
+        """可续传的未完成文件路径（同一个键只会有一个下载者）"""
+        path = self.path(key) + ".partial"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def temp_path(self, key: str) -> str:
+        """一次性临时文件路径，写完后通过 commit 放入缓存"""
+        path = f"{self.path(key)}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def lookup(self, key: str, record: bool = True) -> Optional[str]:
+        """查找缓存条目，命中时刷新 LRU 顺序并返回文件路径
+
+        record 为 False 时不计入命中统计，用于同一个层的重复检查（每个层只计一次命中或未命中）。
+        """
+        with self._lock:
+            size = self._entries.get(key)
+            if size is None:
+                # 可能由其他 worker 写入
+                try:
+                    size = os.path.getsize(self.path(key))
+                except OSError:
+                    if record:
+                        self.misses += 1
+                    return None
+                self._entries[key] = size
+                self.total_bytes += size
+            self._entries.move_to_end(key)
+            if record:
+                self.hits += 1
+                self.bytes_reused += size
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # 文件被外部删除
+            with self._lock:
+                if self._entries.pop(key, None) is not None:
+                    self.total_bytes -= size
+                if record:
+                    self.hits -= 1
+                    self.bytes_reused -= size
+                    self.misses += 1
+            return None
+        return path
+
+    def commit(self, key: str, temp_path: str) -> str:
+        """将写好的临时文件放入缓存，已存在相同条目时丢弃临时文件
+
+        放入后会触发淘汰，需要继续使用该条目的调用方应在 commit 之前固定它。
+        """
+        path = self.path(key)
+        size = os.path.getsize(temp_path)
+        with self._lock:
+            if key in self._entries:
+                os.unlink(temp_path)
+                self._entries.move_to_end(key)
+                return path
+            os.replace(temp_path, path)
+            self._entries[key] = size
+            self.total_bytes += size
+            self.bytes_stored += size
+        self.evict()
+        return path
+
+    @contextmanager
+    def pinned(self, keys: Iterable[str]):
+        """在上下文中固定这些条目，避免正在使用时被淘汰"""
+        keys = list(keys)
+        with self._lock:
+            self._pins.update(keys)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins.subtract(keys)
+                self._pins += Counter()  # 去掉计数为 0 的键
+
+    def evict(self, reserve_bytes: int = 0) -> int:
+        """按 LRU 淘汰未固定的条目，直到总大小加上 reserve_bytes 不超过上限，返回释放的字节数"""
+        freed = 0
+        recently_used = time.time() - EVICTION_GRACE_SECONDS
+        with self._lock:
+            for key in list(self._entries):
+                if self.total_bytes + reserve_bytes <= self.max_bytes:
+                    break
+                if self._pins[key] > 0:
+                    continue
+                try:
+                    if os.path.getmtime(self.path(key)) > recently_used:
+                        continue
+                except FileNotFoundError:
+                    pass
+                size = self._entries.pop(key)
+                try:
+                    os.unlink(self.path(key))
+                except FileNotFoundError:
+                    pass
+                self.total_bytes -= size
+                self.evictions += 1
+                freed += size
+        if freed:
+            logger.info(f"层缓存淘汰释放 {freed / (1024 * 1024):.1f}MB")
+        return freed
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bytes_reused": self.bytes_reused,
+                "bytes_stored": self.bytes_stored,
+                "evictions": self.evictions,
+                "pinned": len(self._pins),
+                "timestamp": int(time.time()),
+            }
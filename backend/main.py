@@ -1,26 +1,61 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import subprocess
 import os
-import tempfile
-from fastapi.responses import FileResponse, JSONResponse, HTMLResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, HTMLResponse, Response, StreamingResponse
 import logging
 import json
-import shutil
 import time
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
+from urllib.parse import quote
+from collections import deque
 from datetime import datetime
 from dotenv import load_dotenv
 from fastapi import APIRouter
+from starlette.background import BackgroundTask
 import docker
 import asyncio
+from mirrors import MirrorManager
+from registry import (DEFAULT_REGISTRY, DEFAULT_REGISTRY_HOST, RegistryPuller, bundle_tar_members,
+                      iter_tar_members, remove_stale_job_blobs, tar_members_size)
+from delta import DELTA_MANIFEST, archive_base_info, archive_diff_ids, delta_manifest
+from layer_cache import LayerCache
+from job_store import FINISHED_STATUSES, JobStore
+from archive_index import SORT_FIELDS, ArchiveIndex
+from storage import StorageManager
+from admission import CompressionRatios, CpuBudget
+from uploads import UploadError, UploadOffsetMismatch, UploadStore
+from seekable import (INDEX_SUFFIX, SEEKABLE_BLOCK_SIZE, ArchiveNotSeekable, iter_member, list_members, remove_index,
+                      write_seekable_archive)
+from coordination import WORKER_ID
+from metrics import ARCHIVE_REUSE, REGISTRY, CallbackCounter, Gauge, StageTimings, timed_writer
+from scheduler import JobScheduler
+from file_transfer import DOWNLOAD_CHUNK_SIZE, content_disposition, file_response
+from checksum import (
+    CHECKSUM_ALGORITHMS, CHECKSUM_SUFFIXES, ChecksumWriter, remove_checksums, verify_archive, write_checksums
+)
+from archive_meta import (
+    META_SUFFIX, export_variant, find_reusable_archive, read_archive_meta, remove_archive_meta, write_archive_meta
+)
+import anyio
+from compression import (
+    ARCHIVE_EXTENSIONS, CODECS, DOCKER_SAVE_TIMEOUT, SAVE_CHUNK_SIZE,
+    COMPRESSION_THREADS, compress_stream, decompress_stream, detect_codec, get_compression_method,
+    iter_with_bounded_buffer
+)
 from concurrent.futures import ThreadPoolExecutor
-import gzip
 import signal
 import sys
 import concurrent.futures
+import hashlib
+import io
+import itertools
+import tarfile
+import uuid
+from contextlib import AsyncExitStack, ExitStack, asynccontextmanager
+import threading
 import uvicorn
 
 # 加载环境变量
@@ -67,15 +102,71 @@ def get_docker_client():
                 raise e2
     return docker_client
 
+# 拉取引擎：docker 通过本机 dockerd 拉取并 docker save；registry 直接访问镜像仓库 v2 API，不经过 dockerd
+PULL_ENGINES = ("docker", "registry")
+
 # 模型定义
 class ImageRequest(BaseModel):
     image_name: str
+    engine: str = "docker"
+    # 压缩格式（pigz/gzip/zstd/lz4/none）与压缩级别，未指定时使用 COMPRESSION_CODEC 与编解码器默认级别
+    codec: Optional[str] = None
+    compression_level: Optional[int] = None
+    # 是否使用层缓存导出，未指定时使用 LAYER_CACHE_ENABLED
+    layer_cache: Optional[bool] = None
+    # 排队优先级，数值大的先执行，相同优先级按提交顺序
+    priority: int = 0
+    # 增量导出的基础：镜像名，或下载目录中已有的归档文件名；归档只包含基础中没有的层
+    delta_base: Optional[str] = None
+    # 是否分块并行压缩并生成成员索引（可随机读取单个成员，不使用层缓存），未指定时使用 SEEKABLE_ARCHIVES
+    seekable: Optional[bool] = None
+
+class BatchImageRequest(BaseModel):
+    images: List[ImageRequest]
+
+class BundleRequest(BaseModel):
+    # 打包进同一个归档的镜像，相同的层只保存一次
+    images: List[str]
+    # 归档名（不含扩展名），未指定时由镜像列表生成
+    bundle_name: Optional[str] = None
+    engine: str = "docker"
+    codec: Optional[str] = None
+    compression_level: Optional[int] = None
+    layer_cache: Optional[bool] = None
+    priority: int = 0
+    seekable: Optional[bool] = None
+
+class UploadRequest(BaseModel):
+    # 归档的文件名与总字节数；提供 sha256 时导入前校验上传内容
+    filename: str
+    size: int
+    sha256: Optional[str] = None
+
+class ImportRequest(BaseModel):
+    # 导入的归档：下载目录中的文件路径，或已上传完成的上传 ID，二者选一
+    path: Optional[str] = None
+    upload_id: Optional[str] = None
+    priority: int = 0
 
 class DownloadedFile(BaseModel):
     name: str
     size: int
     created_at: str
     path: str
+    # 创建与修改时间（Unix 时间戳），created_at 为其格式化形式
+    created_ts: float
+    mtime: float
+    # 元数据中记录的镜像名（打包归档为归档名），没有元数据时为空
+    image_name: Optional[str] = None
+    # 导出时计算的校验和，没有 sidecar 时为空
+    sha256: Optional[str] = None
+    blake3: Optional[str] = None
+
+class DownloadedFilePage(BaseModel):
+    items: List[DownloadedFile]
+    # 下一页的游标，没有更多时为空
+    next_cursor: Optional[str] = None
+    total: int
 
 app = FastAPI()
 
@@ -89,33 +180,88 @@ DOCKER_REGISTRY_MIRROR = os.getenv("DOCKER_REGISTRY_MIRROR")
 # 新的代理配置
 DOCKER_PROXY = os.getenv("DOCKER_PROXY")
 
-# 压缩方法配置
-COMPRESSION_METHOD = {
-    "name": "pigz",
-    "ext": ".tar.gz", 
-    "command": ["pigz", "--fast", "-c"],  # 让pigz自动使用所有可用CPU核心
-    "decompress": ["pigz", "-d", "-c"]
-}
-
-# 从环境变量获取压缩超时设置（默认2小时）
-COMPRESSION_TIMEOUT = int(os.getenv("COMPRESSION_TIMEOUT", "7200"))
-DOCKER_SAVE_TIMEOUT = int(os.getenv("DOCKER_SAVE_TIMEOUT", "3600"))
+# registry 引擎配置：并行下载的层数、失败重试次数、目标平台、使用 HTTP 的仓库以及可选的认证信息
+REGISTRY_MAX_WORKERS = int(os.getenv("REGISTRY_MAX_WORKERS", "4"))
+REGISTRY_RETRIES = int(os.getenv("REGISTRY_RETRIES", "3"))
+REGISTRY_PLATFORM = os.getenv("REGISTRY_PLATFORM", "linux/amd64")
+REGISTRY_INSECURE_HOSTS = [host for host in os.getenv("REGISTRY_INSECURE_HOSTS", "").split(",") if host]
+REGISTRY_USERNAME = os.getenv("REGISTRY_USERNAME")
+REGISTRY_PASSWORD = os.getenv("REGISTRY_PASSWORD")
+# Docker Hub 加速地址（DOCKER_REGISTRY_MIRROR，多个用逗号分隔）：registry 引擎按探测的延迟与吞吐量选择最快的健康地址，
+# 探测结果缓存 MIRROR_PROBE_TTL 秒；单个层在 MIRROR_STALL_WINDOW 秒内的速度低于 MIRROR_MIN_THROUGHPUT_KB（KB/s，0 表示不限）
+# 时切换到下一个地址续传；失败的地址暂停使用 MIRROR_FAILURE_COOLDOWN 秒（连续失败时加倍）
+DOCKER_REGISTRY_MIRRORS = [url for url in (DOCKER_REGISTRY_MIRROR or "").split(",") if url.strip()]
+MIRROR_PROBE_TTL = float(os.getenv("MIRROR_PROBE_TTL", "300"))
+MIRROR_PROBE_TIMEOUT = float(os.getenv("MIRROR_PROBE_TIMEOUT", "5"))
+MIRROR_MIN_THROUGHPUT_KB = float(os.getenv("MIRROR_MIN_THROUGHPUT_KB", "100"))
+MIRROR_STALL_WINDOW = float(os.getenv("MIRROR_STALL_WINDOW", "15"))
+MIRROR_FAILURE_COOLDOWN = float(os.getenv("MIRROR_FAILURE_COOLDOWN", "60"))
+
+# 层缓存：按层摘要保存压缩后的层，多次导出共享；超过上限时按 LRU 淘汰
+LAYER_CACHE_ENABLED = os.getenv("LAYER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+LAYER_CACHE_MAX_SIZE_GB = float(os.getenv("LAYER_CACHE_MAX_SIZE_GB", "50"))
+LAYER_CACHE_DIR_ENV = os.getenv("LAYER_CACHE_DIR")
+
+# 任务存储：任务记录保存在 SQLite 中，结束超过 JOB_TTL_HOURS 后压缩为摘要，超过 JOB_RETENTION_DAYS 后删除（0 表示永久保留）
+JOB_DB_PATH_ENV = os.getenv("JOB_DB_PATH")
+JOB_TTL_HOURS = float(os.getenv("JOB_TTL_HOURS", "24"))
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", "30"))
+JOB_COMPACT_INTERVAL = int(os.getenv("JOB_COMPACT_INTERVAL", "600"))
+# 运行中任务的进度写入任务存储的最小间隔（秒），状态变化时立即写入
+JOB_PERSIST_INTERVAL = float(os.getenv("JOB_PERSIST_INTERVAL", "5"))
+# 服务重启后是否重新执行被中断的任务（否则标记为失败并清理未完成的文件）
+JOB_RESUME_INTERRUPTED = os.getenv("JOB_RESUME_INTERRUPTED", "false").lower() in ("1", "true", "yes")
+# 多 worker：uvicorn worker 进程数；任务与导出租约的有效期（秒），持有者每 1/3 有效期续租一次，
+# 超过有效期未续租（worker 已退出）的任务由其他 worker 接管；查看其他 worker 上任务进度的轮询间隔（秒）
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+JOB_LEASE_TTL = float(os.getenv("JOB_LEASE_TTL", "30"))
+JOB_REMOTE_POLL_INTERVAL = float(os.getenv("JOB_REMOTE_POLL_INTERVAL", "1"))
+
+# 下载归档时交给前置 nginx 发送的 internal location（如 /internal-downloads/），为空时由后端直接发送
+DOWNLOAD_ACCEL_REDIRECT = os.getenv("DOWNLOAD_ACCEL_REDIRECT")
+# 边导出边下载时，读到当前文件末尾后等待新数据的最长间隔（秒）
+ARCHIVE_FOLLOW_POLL_INTERVAL = float(os.getenv("ARCHIVE_FOLLOW_POLL_INTERVAL", "0.5"))
+# 归档索引：检查下载目录 mtime 以发现外部变化的最小间隔，以及重新 stat 全部文件的间隔（秒）
+ARCHIVE_INDEX_REVALIDATE_INTERVAL = float(os.getenv("ARCHIVE_INDEX_REVALIDATE_INTERVAL", "2"))
+ARCHIVE_INDEX_FULL_RESCAN_INTERVAL = float(os.getenv("ARCHIVE_INDEX_FULL_RESCAN_INTERVAL", "300"))
+# 同时进行的归档校验数量，校验在专用线程池中执行，不阻塞 API
+MAX_CONCURRENT_VERIFICATIONS = int(os.getenv("MAX_CONCURRENT_VERIFICATIONS", "1"))
+# 下载目录容量：归档总大小上限、剩余空间低水位/高水位（GB，0 表示不限制）与归档保留时间（小时，按最近下载时间计，0 表示永久保留）
+STORAGE_QUOTA_GB = float(os.getenv("STORAGE_QUOTA_GB", "0"))
+STORAGE_MIN_FREE_GB = float(os.getenv("STORAGE_MIN_FREE_GB", "0"))
+STORAGE_TARGET_FREE_GB = float(os.getenv("STORAGE_TARGET_FREE_GB", "0"))
+ARCHIVE_TTL_HOURS = float(os.getenv("ARCHIVE_TTL_HOURS", "0"))
+STORAGE_SWEEP_INTERVAL = int(os.getenv("STORAGE_SWEEP_INTERVAL", "300"))
+# 导出前的空间准入：空间不足时 queue 排队等待、reject 直接失败；排队超过 STORAGE_ADMISSION_TIMEOUT 秒（0 表示不限）后失败
+STORAGE_ADMISSION = os.getenv("STORAGE_ADMISSION", "queue").lower()
+STORAGE_ADMISSION_TIMEOUT = float(os.getenv("STORAGE_ADMISSION_TIMEOUT", "0"))
+# docker 引擎估算归档大小时使用的压缩率（压缩后/未压缩），同一导出方式有足够的历史导出后改用实际压缩率
+STORAGE_COMPRESSION_RATIO = float(os.getenv("STORAGE_COMPRESSION_RATIO", "0.5"))
+# 压缩线程分配：同时进行的压缩共用 COMPRESSION_THREADS 个线程；是否按主机平均负载减少线程数
+COMPRESSION_LOAD_AWARE = os.getenv("COMPRESSION_LOAD_AWARE", "true").lower() in ("1", "true", "yes")
+# 导入：单个上传的大小上限（GB，0 表示不限制）与未完成上传的保留时间（小时，按最后一次收到数据计）
+UPLOAD_MAX_SIZE_GB = float(os.getenv("UPLOAD_MAX_SIZE_GB", "0"))
+UPLOAD_TTL_HOURS = float(os.getenv("UPLOAD_TTL_HOURS", "24"))
+
+# 默认是否以分块压缩格式导出：tar 流按 SEEKABLE_BLOCK_SIZE 切块并行压缩，附带成员索引，可以单独读取 manifest.json 等成员
+SEEKABLE_ARCHIVES = os.getenv("SEEKABLE_ARCHIVES", "false").lower() in ("1", "true", "yes")
+
 # Docker SDK 超时设置（默认2小时）
 DOCKER_SDK_TIMEOUT = int(os.getenv("DOCKER_SDK_TIMEOUT", "7200"))
 
-def check_pigz_support():
-    """检查 pigz 是否可用"""
-    try:
-        subprocess.run(["pigz", "--version"], 
-                     capture_output=True, check=True, timeout=5)
-        logger.info("pigz 高速压缩工具可用")
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError, subprocess.TimeoutExpired):
-        logger.warning("pigz 不可用，将使用 Python 内置 gzip")
-        return False
+# 以命令行批处理方式运行（cli.py）时只使用导出流水线：不挂载静态文件、不检查前端文件，
+# 导入时不探测压缩工具（用到时再探测）、不打印路由
+HEADLESS = os.getenv("DOCKER_PULL_HEADLESS", "false").lower() in ("1", "true", "yes")
 
-# 检查 pigz 支持
-PIGZ_AVAILABLE = check_pigz_support()
+# 检查各压缩工具是否可用
+if not HEADLESS:
+    for codec in CODECS.values():
+        if codec.available():
+            logger.info(f"压缩格式可用: {codec.name} ({codec.ext})")
+        else:
+            logger.warning(f"压缩工具 {codec.name} 不可用")
+    if not CODECS["pigz"].available():
+        logger.warning("pigz 不可用，默认将使用 Python 内置 gzip")
 
 # Docker命令执行函数
 def run_docker_command(command, stream_output=False):
@@ -167,248 +313,797 @@ app.add_middleware(
 # 创建必要的目录
 DOWNLOADS_DIR = DOWNLOADS_DIR_ENV or os.path.join(os.path.dirname(__file__), "downloads")
 STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+# registry 引擎下载中的层数据，保留未完成的部分以便续传
+REGISTRY_BLOB_DIR = os.path.join(DOWNLOADS_DIR, ".blobs")
+LAYER_CACHE_DIR = LAYER_CACHE_DIR_ENV or os.path.join(DOWNLOADS_DIR, ".layer-cache")
+JOB_DB_PATH = JOB_DB_PATH_ENV or os.path.join(DOWNLOADS_DIR, ".jobs.db")
+UPLOADS_DIR = os.path.join(DOWNLOADS_DIR, ".uploads")
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
-os.makedirs(STATIC_DIR, exist_ok=True)
+remove_stale_job_blobs(REGISTRY_BLOB_DIR)
+
+layer_cache = LayerCache(LAYER_CACHE_DIR, int(LAYER_CACHE_MAX_SIZE_GB * 1024 ** 3))
+job_store = JobStore(JOB_DB_PATH)
+upload_store = UploadStore(UPLOADS_DIR, int(UPLOAD_MAX_SIZE_GB * 1024 ** 3), UPLOAD_TTL_HOURS * 3600)
+archive_index = ArchiveIndex(DOWNLOADS_DIR, ARCHIVE_EXTENSIONS, ARCHIVE_INDEX_REVALIDATE_INTERVAL,
+                             ARCHIVE_INDEX_FULL_RESCAN_INTERVAL)
+# 运行中任务的目标文件正在写入，不参与淘汰
+storage_manager = StorageManager(
+    DOWNLOADS_DIR, archive_index,
+    quota_bytes=int(STORAGE_QUOTA_GB * 1024 ** 3),
+    min_free_bytes=int(STORAGE_MIN_FREE_GB * 1024 ** 3),
+    target_free_bytes=int(STORAGE_TARGET_FREE_GB * 1024 ** 3),
+    ttl_seconds=ARCHIVE_TTL_HOURS * 3600,
+    busy_paths=lambda: [tracker.output_path for tracker in progress_trackers.values()],
+    on_evict=lambda path: forget_verification(path),
+)
+
+# 历史压缩率从已有归档的元数据中恢复
+compression_ratios = CompressionRatios(STORAGE_COMPRESSION_RATIO)
+compression_ratios.load(read_archive_meta(entry["path"]) for entry in archive_index.entries())
 
 # 记录目录信息
 logger.info(f"下载目录: {os.path.abspath(DOWNLOADS_DIR)}")
-logger.info(f"静态文件目录: {os.path.abspath(STATIC_DIR)}")
-
-# 检查静态文件是否存在
-index_html_path = os.path.join(STATIC_DIR, "index.html")
-if os.path.exists(index_html_path):
-    logger.info(f"找到index.html: {index_html_path}")
-else:
-    logger.warning(f"找不到index.html: {index_html_path}")
-    # 尝试在上一级目录查找
-    parent_static = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static")
-    parent_index = os.path.join(parent_static, "index.html")
-    if os.path.exists(parent_index):
-        logger.info(f"在上级目录找到index.html: {parent_index}")
-        # 如果在上级目录找到，则使用上级目录
-        STATIC_DIR = parent_static
-        index_html_path = parent_index
-        logger.info(f"更新静态文件目录为: {STATIC_DIR}")
-    
-    # 列出静态目录中的文件
-    if os.path.exists(STATIC_DIR):
-        files = os.listdir(STATIC_DIR)
-        logger.info(f"静态目录中的文件: {files if files else '(空)'}")
-        # 如果有static子目录，列出它的内容
-        static_subdir = os.path.join(STATIC_DIR, "static")
-        if os.path.exists(static_subdir) and os.path.isdir(static_subdir):
-            subfiles = os.listdir(static_subdir)
-            logger.info(f"static子目录中的文件: {subfiles if subfiles else '(空)'}")
-
-# 挂载静态文件目录到 /static 路径
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+
+def mount_static_files():
+    """查找前端构建产物并挂载到 /static 路径，找不到 index.html 时尝试上一级目录"""
+    global STATIC_DIR
+    os.makedirs(STATIC_DIR, exist_ok=True)
+    logger.info(f"静态文件目录: {os.path.abspath(STATIC_DIR)}")
+
+    # 检查静态文件是否存在
+    index_html_path = os.path.join(STATIC_DIR, "index.html")
+    if os.path.exists(index_html_path):
+        logger.info(f"找到index.html: {index_html_path}")
+    else:
+        logger.warning(f"找不到index.html: {index_html_path}")
+        # 尝试在上一级目录查找
+        parent_static = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static")
+        parent_index = os.path.join(parent_static, "index.html")
+        if os.path.exists(parent_index):
+            logger.info(f"在上级目录找到index.html: {parent_index}")
+            # 如果在上级目录找到，则使用上级目录
+            STATIC_DIR = parent_static
+            logger.info(f"更新静态文件目录为: {STATIC_DIR}")
+
+        # 列出静态目录中的文件
+        if os.path.exists(STATIC_DIR):
+            files = os.listdir(STATIC_DIR)
+            logger.info(f"静态目录中的文件: {files if files else '(空)'}")
+            # 如果有static子目录，列出它的内容
+            static_subdir = os.path.join(STATIC_DIR, "static")
+            if os.path.exists(static_subdir) and os.path.isdir(static_subdir):
+                subfiles = os.listdir(static_subdir)
+                logger.info(f"static子目录中的文件: {subfiles if subfiles else '(空)'}")
+
+    # 挂载静态文件目录到 /static 路径
+    app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+
+if not HEADLESS:
+    mount_static_files()
 
 # 创建 API 路由
 api_router = APIRouter(prefix="/api")
 
-# 用于存储下载进度的全局字典
-download_progress: Dict[str, Dict] = {}
+# 同时进行的镜像拉取数量上限，拉取在专用线程池中执行，避免阻塞事件循环
+MAX_CONCURRENT_PULLS = int(os.getenv("MAX_CONCURRENT_PULLS", "4"))
+# 同时执行的任务数，以及导出（docker save 流）与压缩阶段的并发上限（0 表示不限制）
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "4"))
+MAX_CONCURRENT_SAVES = int(os.getenv("MAX_CONCURRENT_SAVES", "2"))
+MAX_CONCURRENT_COMPRESSIONS = int(os.getenv("MAX_CONCURRENT_COMPRESSIONS", "2"))
+# 同时向 Docker daemon 载入（docker load）的归档数量上限
+MAX_CONCURRENT_LOADS = int(os.getenv("MAX_CONCURRENT_LOADS", "2"))
+# 单次批量提交的镜像数量上限
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "50"))
+# 拉取事件在线程与事件循环之间的缓冲队列长度
+PULL_EVENT_QUEUE_SIZE = int(os.getenv("PULL_EVENT_QUEUE_SIZE", "1000"))
+pull_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PULLS, thread_name_prefix="docker-pull")
+cpu_budget = CpuBudget(COMPRESSION_THREADS, load_aware=COMPRESSION_LOAD_AWARE)
+load_executor = ThreadPoolExecutor(max_workers=max(1, MAX_CONCURRENT_LOADS), thread_name_prefix="docker-load")
+
+async def iter_threaded_events(produce, executor: Optional[ThreadPoolExecutor] = None):
+    """异步迭代在工作线程中产生的事件
+
+    produce(emit) 在 executor（默认 pull_executor）的工作线程中运行，通过 emit 逐个交出事件；
+    事件经有界 asyncio 队列交给事件循环，慢消费者会对工作线程形成背压。
+    消费方提前退出后 emit 会抛出 CancelledError，使工作线程尽快停止。
+    """
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue(maxsize=PULL_EVENT_QUEUE_SIZE)
+    end_marker = object()
+    cancelled = threading.Event()
+
+    def put(item):
+        future = asyncio.run_coroutine_threadsafe(events.put(item), loop)
+        while not cancelled.is_set():
+            try:
+                future.result(timeout=0.5)
+                return
+            except concurrent.futures.TimeoutError:
+                continue
+        future.cancel()
+
+    def emit(item):
+        if cancelled.is_set():
+            raise concurrent.futures.CancelledError()
+        put(item)
 
-# 用于存储下载任务的全局字典
-download_tasks: Dict[str, asyncio.Task] = {}
+    def consume():
+        try:
+            produce(emit)
+            put(end_marker)
+        except BaseException as e:
+            put(e)
 
-async def pull_image_with_progress(image_name: str):
-    """使用 Docker SDK 拉取镜像并跟踪进度"""
+    loop.run_in_executor(executor or pull_executor, consume)
     try:
-        # 初始化进度
-        download_progress[image_name] = {
+        while True:
+            item = await events.get()
+            if item is end_marker:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+        # 唤醒可能阻塞在满队列上的工作线程
+        while not events.empty():
+            events.get_nowait()
+
+def iter_pull_events(image_name: str):
+    """异步迭代 Docker 拉取事件，同步的 Docker 事件流在工作线程中消费"""
+    def produce(emit):
+        for line in get_docker_client().api.pull(image_name, stream=True, decode=True):
+            emit(line)
+    return iter_threaded_events(produce)
+
+def save_images(image_names: List[str], chunk_size: int = SAVE_CHUNK_SIZE):
+    """docker save 多个镜像，输出一个 tar 流，各镜像共享的层只出现一次
+
+    Docker SDK 的 get_image 只支持单个镜像，这里按同样的方式调用 /images/get?names=...。
+    """
+    api = get_docker_client().api
+    response = api._get(api._url("/images/get"), params={"names": image_names}, stream=True)
+    api._raise_for_status(response)
+    return api._stream_raw_result(response, chunk_size, False)
+
+@asynccontextmanager
+async def pull_slot(tracker: "PullProgressTracker"):
+    """获得拉取阶段的槽位，拉取计时不含排队等待，结束后记录拉取的字节数并推送计时明细"""
+    async with job_scheduler.stage("pull", on_wait=lambda: tracker.update(detail="等待拉取槽位...")):
+        bytes_before = tracker.bytes_total
+        with tracker.timings.measure("pull"):
+            yield
+        tracker.timings.add_bytes("pull", tracker.bytes_total - bytes_before)
+    tracker.publish_timings()
+
+mirror_manager = MirrorManager(
+    DOCKER_REGISTRY_MIRRORS,
+    DEFAULT_REGISTRY,
+    f"https://{DEFAULT_REGISTRY_HOST}",
+    probe_ttl=MIRROR_PROBE_TTL,
+    probe_timeout=MIRROR_PROBE_TIMEOUT,
+    failure_cooldown=MIRROR_FAILURE_COOLDOWN,
+    min_throughput=MIRROR_MIN_THROUGHPUT_KB * 1024,
+    stall_window=MIRROR_STALL_WINDOW,
+    proxies={"http": DOCKER_PROXY, "https": DOCKER_PROXY} if DOCKER_PROXY else None
+)
+
+def create_registry_puller(image_name: str, use_cache: bool = False) -> RegistryPuller:
+    """创建直连镜像仓库的拉取器，use_cache 时层 blob 保存在共享层缓存中"""
+    proxies = {"http": DOCKER_PROXY, "https": DOCKER_PROXY} if DOCKER_PROXY else None
+    return RegistryPuller(
+        image_name,
+        REGISTRY_BLOB_DIR,
+        max_workers=REGISTRY_MAX_WORKERS,
+        retries=REGISTRY_RETRIES,
+        platform=REGISTRY_PLATFORM,
+        insecure_hosts=REGISTRY_INSECURE_HOSTS,
+        proxies=proxies,
+        username=REGISTRY_USERNAME,
+        password=REGISTRY_PASSWORD,
+        cache=layer_cache if use_cache else None,
+        mirrors=mirror_manager
+    )
+
+# 每个任务保留的增量进度事件数量，断线重连超出此范围时改为推送完整快照
+PROGRESS_JOURNAL_SIZE = int(os.getenv("PROGRESS_JOURNAL_SIZE", "2000"))
+# SSE 心跳间隔（秒），防止代理断开空闲连接
+PROGRESS_STREAM_HEARTBEAT = int(os.getenv("PROGRESS_STREAM_HEARTBEAT", "15"))
+
+class ProgressJournal:
+    """记录单个任务的增量进度事件（状态变化、层变化、新日志），供 SSE 推送与断线续传
+
+    publish 可以在任意线程中调用，等待中的流通过各自事件循环被唤醒。
+    """
+
+    def __init__(self, maxlen: int = PROGRESS_JOURNAL_SIZE):
+        self.events = deque(maxlen=maxlen)
+        self.seq = 0
+        # 可重入锁：状态修改与事件发布需在同一把锁内完成，保证快照与序号一致
+        self.lock = threading.RLock()
+        self.waiters = set()
+
+    def publish(self, event_type: str, data: Dict) -> int:
+        with self.lock:
+            self.seq += 1
+            self.events.append((self.seq, event_type, data))
+            waiters = list(self.waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+        return self.seq
+
+    def since(self, last_seq: int) -> Optional[List]:
+        """返回 last_seq 之后的事件；若这些事件已被淘汰则返回 None，调用方需改发快照"""
+        with self.lock:
+            if last_seq > self.seq:
+                return None
+            if last_seq == self.seq:
+                return []
+            if not self.events or self.events[0][0] > last_seq + 1:
+                return None
+            return [item for item in self.events if item[0] > last_seq]
+
+    async def wait(self, last_seq: int, timeout: float) -> None:
+        """等待 last_seq 之后出现新事件，或超时"""
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self.lock:
+            if self.seq > last_seq:
+                return
+            self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
+
+# 进度合并推送的最小间隔（秒），高频的层进度事件在此间隔内合并为一次更新
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", "0.5"))
+# 每个任务保留的日志行数（环形缓冲区）
+PROGRESS_LOG_SIZE = int(os.getenv("PROGRESS_LOG_SIZE", "200"))
+
+class PullProgressTracker:
+    """单个任务的进度跟踪器
+
+    - 按层的真实字节数加权计算拉取进度，总字节数增量维护，无需每个事件重新求和
+    - 日志保存在固定长度的环形缓冲区中
+    - 高频的层进度事件先合并，最多每 flush_interval 秒写入一次进度快照并推送增量事件
+    """
+
+    # 拉取阶段在总体进度中所占的区间
+    PULL_PROGRESS_START = 5
+    PULL_PROGRESS_END = 60
+
+    def __init__(self, image_name: str, job_id: Optional[str] = None, store: Optional[JobStore] = None,
+                 flush_interval: float = PROGRESS_FLUSH_INTERVAL, log_size: int = PROGRESS_LOG_SIZE):
+        self.image_name = image_name
+        self.job_id = job_id or uuid.uuid4().hex
+        self.store = store
+        # 导出的目标文件，导出过程中先写入 output_path + ".tmp"
+        self.output_path: Optional[str] = None
+        self.flush_interval = flush_interval
+        self.journal = ProgressJournal()
+        self.state = {
+            "job_id": self.job_id,
+            "image_name": image_name,
             "status": "starting",
             "progress": 0,
             "detail": "准备开始下载...",
-            "output": [],
+            "output": deque(maxlen=log_size),
             "layers": {}  # 存储每个层的进度
         }
-        
-        def add_log(message: str):
-            """添加日志到输出并记录到控制台"""
-            timestamp = datetime.now().strftime('%H:%M:%S')
-            log_message = f"[{timestamp}] {message}"
-            download_progress[image_name]["output"].append(log_message)
-            logger.info(f"下载进度: {message}")
-            # 限制输出行数，避免内存溢出
-            if len(download_progress[image_name]["output"]) > 200:
-                download_progress[image_name]["output"] = download_progress[image_name]["output"][-150:]
-        
+        # 每层的字节计数：download/extract 两个阶段各自的 current，以及层大小 total
+        self._layer_bytes: Dict[str, Dict[str, int]] = {}
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self._dirty_layers = set()
+        self._pending_detail: Optional[str] = None
+        self._last_flush = 0.0
+        self._last_persist = 0.0
+        # 各阶段的计时，state["timings"] 为其快照
+        self.timings = StageTimings()
+
+    def update(self, **fields):
+        """更新任务状态字段并推送增量事件，状态变化时立即写入任务存储，其余按间隔写入"""
+        if fields.get("status") in FINISHED_STATUSES and self.state["status"] not in FINISHED_STATUSES:
+            # 任务结束时计入全局指标，最终的计时明细随结束状态一起推送并保存
+            self.timings.observe(fields["status"])
+            fields["timings"] = self.timings.snapshot()
+        with self.journal.lock:
+            self.state.update(fields)
+            self.journal.publish("state", fields)
+        if self.store and ("status" in fields or time.monotonic() - self._last_persist >= JOB_PERSIST_INTERVAL):
+            self.persist()
+
+    def persist(self):
+        """将当前进度写入任务存储，任务结束时同时保存日志与层信息"""
+        self._last_persist = time.monotonic()
+        snapshot = self.snapshot()
+        try:
+            if snapshot["status"] in FINISHED_STATUSES:
+                self.store.finish(self.job_id, snapshot)
+            else:
+                # 其他 worker 从任务存储读取运行中任务的进度
+                self.store.update(self.job_id, status=snapshot["status"], progress=snapshot["progress"],
+                                  detail=snapshot["detail"], output=snapshot["output"],
+                                  layers=snapshot["layers"], timings=snapshot.get("timings"))
+        except Exception as e:
+            # 任务存储不可用时不影响导出本身
+            logger.error(f"保存任务状态失败: {e}")
+
+    def publish_timings(self):
+        self.update(timings=self.timings.snapshot())
+
+    def log(self, message: str):
+        """添加日志到输出并记录到控制台"""
+        timestamp = datetime.now().strftime('%H:%M:%S')
+        log_message = f"[{timestamp}] {message}"
+        with self.journal.lock:
+            self.state["output"].append(log_message)
+            self.journal.publish("log", {"line": log_message})
+        logger.info(f"下载进度: {message}")
+
+    @property
+    def layer_count(self) -> int:
+        return len(self.state["layers"])
+
+    def _set_layer_bytes(self, layer_id: str, total: Optional[int] = None,
+                         download: Optional[int] = None, extract: Optional[int] = None):
+        """更新某层的字节计数，并增量维护全部层的总字节与已完成字节"""
+        counters = self._layer_bytes.setdefault(layer_id, {"total": 0, "download": 0, "extract": 0})
+        if total is not None and total != counters["total"]:
+            self.bytes_total += total - counters["total"]
+            counters["total"] = total
+        for phase, value in (("download", download), ("extract", extract)):
+            if value is not None:
+                value = min(value, counters["total"])
+                self.bytes_done += value - counters[phase]
+                counters[phase] = value
+
+    def apply_pull_event(self, line: Dict):
+        """处理一条 Docker 拉取事件，只更新内存计数，推送由 flush 合并完成"""
+        if 'id' not in line or 'status' not in line:
+            return
+        layer_id = line['id']
+        status = line['status']
+        layers = self.state["layers"]
+
+        if layer_id not in layers:
+            layers[layer_id] = {"status": status, "progress": 0}
+            if status == "Pulling fs layer":
+                self.log(f"发现新层 {layer_id}: 开始拉取")
+        layer = layers[layer_id]
+        previous_status = layer["status"]
+        layer["status"] = status
+
+        detail = line.get('progressDetail') or {}
+        current = detail.get('current')
+        total = detail.get('total')
+        if current is not None and total:
+            layer["progress"] = int(current * 100 / total)
+            if status == 'Extracting':
+                self._set_layer_bytes(layer_id, total=total, download=total, extract=current)
+            else:
+                self._set_layer_bytes(layer_id, total=total, download=current)
+
+        if status in ['Pull complete', 'Already exists']:
+            layer["progress"] = 100
+            counters = self._layer_bytes.get(layer_id)
+            if counters:
+                self._set_layer_bytes(layer_id, download=counters["total"], extract=counters["total"])
+            if status == 'Pull complete':
+                self.log(f"层 {layer_id}: 下载完成")
+            else:
+                self.log(f"层 {layer_id}: 已存在，跳过下载")
+        elif status != previous_status:
+            # 只在状态切换时记录日志，字节进度在 flush 时合并记录
+            if status == 'Verifying Checksum':
+                self.log(f"层 {layer_id}: 验证校验和")
+            elif status == 'Download complete':
+                counters = self._layer_bytes.get(layer_id)
+                if counters:
+                    self._set_layer_bytes(layer_id, download=counters["total"])
+                self.log(f"层 {layer_id}: 下载完成，开始解压")
+
+        status_msg = f"层 {layer_id}: {status}"
+        if 'progress' in line:
+            status_msg += f" - {line['progress']}"
+        self._pending_detail = status_msg
+        self._dirty_layers.add(layer_id)
+        self.flush()
+
+    def pull_progress(self) -> int:
+        """按真实字节数计算拉取阶段的总体进度"""
+        if self.bytes_total <= 0:
+            return self.PULL_PROGRESS_START
+        # 下载与解压各占一半
+        fraction = self.bytes_done / (2 * self.bytes_total)
+        span = self.PULL_PROGRESS_END - self.PULL_PROGRESS_START
+        return self.PULL_PROGRESS_START + int(fraction * span)
+
+    def flush(self, force: bool = False):
+        """将合并后的变化写入进度快照，并推送 state/layer 增量事件"""
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        with self.journal.lock:
+            for layer_id in sorted(self._dirty_layers):
+                layer = self.state["layers"][layer_id]
+                counters = self._layer_bytes.get(layer_id)
+                if counters and layer["status"] in ('Downloading', 'Extracting'):
+                    phase = "extract" if layer["status"] == 'Extracting' else "download"
+                    current_mb = counters[phase] / (1024 * 1024)
+                    total_mb = counters["total"] / (1024 * 1024)
+                    action = "解压中" if phase == "extract" else "下载中"
+                    self.log(f"层 {layer_id}: {action} ({current_mb:.1f}MB/{total_mb:.1f}MB, {layer['progress']}%)")
+                self.journal.publish("layer", {"id": layer_id, **layer})
+            self._dirty_layers.clear()
+
+            fields = {"progress": max(self.state["progress"], self.pull_progress())}
+            if self._pending_detail is not None:
+                fields["detail"] = self._pending_detail
+                self._pending_detail = None
+            self.update(**fields)
+
+    def snapshot(self) -> Dict:
+        """复制当前的完整进度"""
+        with self.journal.lock:
+            snapshot = dict(self.state)
+            snapshot["output"] = list(self.state["output"])
+            snapshot["layers"] = {layer_id: dict(layer) for layer_id, layer in self.state["layers"].items()}
+            return snapshot
+
+class BundleProgressTracker(PullProgressTracker):
+    """多镜像打包任务的进度跟踪器
+
+    state["images"] 记录每个镜像的状态与进度，变化时推送 image 增量事件；
+    拉取阶段的整体进度为各镜像拉取进度的平均值，每个镜像按其自身各层的字节数计算。
+    """
+
+    def __init__(self, bundle_name: str, image_names: List[str], **kwargs):
+        super().__init__(bundle_name, **kwargs)
+        self.state["images"] = {name: {"status": "queued", "progress": 0} for name in image_names}
+        self._image_layers: Dict[str, set] = {name: set() for name in image_names}
+        # 正在拉取的镜像，拉取事件中的层归属于它
+        self.current_image: Optional[str] = None
+
+    def update_image(self, name: str, **fields):
+        with self.journal.lock:
+            image = self.state["images"][name]
+            image.update(fields)
+            self.journal.publish("image", {"name": name, **image})
+
+    def apply_pull_event(self, line: Dict):
+        if self.current_image and "id" in line:
+            self._image_layers[self.current_image].add(line["id"])
+        super().apply_pull_event(line)
+
+    def image_pull_fraction(self, name: str) -> float:
+        if self.state["images"][name]["status"] not in ("queued", "pulling"):
+            return 1.0
+        total = done = 0
+        for layer_id in self._image_layers[name]:
+            counters = self._layer_bytes.get(layer_id)
+            if counters:
+                total += 2 * counters["total"]
+                done += counters["download"] + counters["extract"]
+        return done / total if total else 0.0
+
+    def pull_progress(self) -> int:
+        images = self.state["images"]
+        fraction = sum(self.image_pull_fraction(name) for name in images) / len(images)
+        span = self.PULL_PROGRESS_END - self.PULL_PROGRESS_START
+        return self.PULL_PROGRESS_START + int(fraction * span)
+
+    def flush(self, force: bool = False):
+        if force or time.monotonic() - self._last_flush >= self.flush_interval:
+            name = self.current_image
+            if name and self.state["images"][name]["status"] == "pulling":
+                progress = int(self.image_pull_fraction(name) * 100)
+                if progress != self.state["images"][name]["progress"]:
+                    self.update_image(name, progress=progress)
+        super().flush(force)
+
+    def snapshot(self) -> Dict:
+        with self.journal.lock:
+            snapshot = super().snapshot()
+            snapshot["images"] = {name: dict(image) for name, image in self.state["images"].items()}
+            return snapshot
+
+# 排队中与运行中的任务的进度跟踪器，按任务 ID 索引；任务结束后移除，结果从任务存储中读取
+progress_trackers: Dict[str, PullProgressTracker] = {}
+
+def update_queue_positions(positions: Dict[str, int]):
+    """排队顺序变化时更新各排队任务的位置"""
+    for job_id, position in positions.items():
+        tracker = progress_trackers.get(job_id)
+        if tracker and tracker.state.get("queue_position") != position:
+            tracker.update(queue_position=position, detail=f"排队等待中，前面还有 {position - 1} 个任务")
+
+# 正在导出的镜像，按（镜像 ID, 导出方式）索引；相同镜像的其他任务等待其完成后直接复用归档
+inflight_exports: Dict[tuple, asyncio.Future] = {}
+
+def local_image_identity(image_name: str) -> Optional[Dict]:
+    """本地镜像的身份信息（镜像 ID、仓库摘要、层 diff_id），镜像不存在时返回 None"""
+    try:
+        image = get_docker_client().images.get(image_name)
+    except docker.errors.ImageNotFound:
+        return None
+    return {
+        "image_id": image.id,
+        "repo_digests": image.attrs.get("RepoDigests") or [],
+        "layers": (image.attrs.get("RootFS") or {}).get("Layers") or [],
+    }
+
+def export_lease_keys(identity: Dict, variant: Dict, save_path: str) -> List[str]:
+    """导出需要的跨 worker 租约：同一镜像与导出方式只导出一次，同一目标文件只有一个写入者"""
+    return [
+        f"export:{identity['image_id']}:{json.dumps(variant, sort_keys=True)}",
+        file_lease_key(save_path),
+    ]
+
+def file_lease_key(save_path: str) -> str:
+    return f"file:{os.path.basename(save_path)}"
+
+async def wait_for_leases(tracker: PullProgressTracker, keys: List[str]) -> None:
+    """获取跨 worker 的租约，被其他任务持有时轮询等待
+
+    任务存储是 SQLite，写锁被占用时最多等待 busy_timeout，因此放到线程池中执行，不阻塞事件循环。
+    """
+    loop = asyncio.get_running_loop()
+    logged = False
+    while True:
+        holder = await loop.run_in_executor(
+            None, job_store.acquire_leases, keys, WORKER_ID, tracker.job_id, JOB_LEASE_TTL)
+        if holder is None:
+            return
+        if not logged:
+            logged = True
+            tracker.log(f"目标文件正在由任务 {holder['job_id']}（{holder['owner']}）写入，等待其完成")
+            tracker.update(detail="等待其他任务写完目标文件...")
+        await asyncio.sleep(JOB_REMOTE_POLL_INTERVAL)
+
+async def claim_export(tracker: PullProgressTracker, identity: Dict, variant: Dict,
+                       save_path: str) -> Tuple[Optional[str], Optional[tuple]]:
+    """查找可复用的归档，或等待正在导出同一镜像的任务；都没有时登记由本任务导出
+
+    同一进程内的任务通过 inflight_exports 等待，其他 worker 上的任务通过任务存储中的租约互斥。
+    返回 (可复用的归档路径, None) 或 (None, 导出登记)，导出登记需要在导出结束后交给 release_export。
+    """
+    key = (identity["image_id"], tuple(sorted(variant.items())))
+    lease_keys = export_lease_keys(identity, variant, save_path)
+    loop = asyncio.get_running_loop()
+    waiting_remote = False
+    while True:
+        archive_path = find_reusable_archive(DOWNLOADS_DIR, identity["image_id"], variant, save_path)
+        if archive_path:
+            return archive_path, None
+        future = inflight_exports.get(key)
+        if future is None:
+            holder = await loop.run_in_executor(
+                None, job_store.acquire_leases, lease_keys, WORKER_ID, tracker.job_id, JOB_LEASE_TTL)
+            if inflight_exports.get(key) is not None:
+                # 等待任务存储期间同一进程内的其他任务已登记导出，释放刚取得的租约后改为等待它
+                if holder is None:
+                    await loop.run_in_executor(None, job_store.release_leases, tracker.job_id, WORKER_ID, lease_keys)
+                continue
+            if holder is None:
+                future = inflight_exports[key] = loop.create_future()
+                return None, (key, future, lease_keys, tracker.job_id)
+            if not waiting_remote:
+                waiting_remote = True
+                tracker.log(f"相同镜像或目标文件正在由任务 {holder['job_id']}（{holder['owner']}）导出，等待其完成")
+                tracker.update(detail="等待相同镜像的导出完成...")
+            await asyncio.sleep(JOB_REMOTE_POLL_INTERVAL)
+            continue
+        tracker.log(f"相同镜像 {identity['image_id'][:19]} 正在由其他任务导出，等待其完成后复用")
+        tracker.update(detail="等待相同镜像的导出完成...")
+        archive_path = await asyncio.shield(future)
+        if archive_path:
+            return archive_path, None
+        tracker.log("其他任务导出失败，改为自行导出")
+
+def release_export(claim: tuple, archive_path: Optional[str]):
+    """导出结束，通知等待同一镜像的任务；archive_path 为 None 表示导出失败"""
+    key, future, lease_keys, job_id = claim
+    job_store.release_leases(job_id, WORKER_ID, lease_keys)
+    if inflight_exports.get(key) is future:
+        del inflight_exports[key]
+    if not future.done():
+        future.set_result(archive_path)
+
+job_scheduler = JobScheduler(
+    MAX_CONCURRENT_JOBS,
+    {"pull": MAX_CONCURRENT_PULLS, "save": MAX_CONCURRENT_SAVES, "compress": MAX_CONCURRENT_COMPRESSIONS,
+     "load": MAX_CONCURRENT_LOADS},
+    on_queue_change=update_queue_positions
+)
+
+async def pull_image_with_progress(image_name: str, engine: str = "docker", use_layer_cache: Optional[bool] = None,
+                                   codec_name: Optional[str] = None, compression_level: Optional[int] = None,
+                                   delta_base: Optional[str] = None, job_id: Optional[str] = None,
+                                   seekable: Optional[bool] = None):
+    """拉取镜像并导出为压缩文件，同时跟踪进度
+
+    engine 为 docker 时通过 Docker SDK 拉取并 docker save；
+    为 registry 时直接从镜像仓库下载各层并组装 docker load 兼容的 tar，不经过 dockerd。
+    use_layer_cache 时导出由逐层压缩的层组成的 .tar，层从共享层缓存中复用。
+    codec_name/compression_level 选择压缩格式与级别。
+    delta_base 指定时导出增量归档，只包含基础镜像/归档中没有的层（docker 引擎总是使用层缓存格式）。
+    job_id 对应 start_job 已登记的任务，未指定时创建一个不持久化的跟踪器。
+    seekable 时分块并行压缩并生成成员索引（见 seekable 模块），不使用层缓存。
+    """
+    # 省略层需要逐层处理 docker save 的输出
+    use_layer_cache, seekable = resolve_export_format(use_layer_cache, seekable,
+                                                      force_layer_cache=bool(delta_base and engine == "docker"))
+    # 初始化进度
+    tracker = progress_trackers.get(job_id) if job_id else None
+    if tracker is None:
+        tracker = PullProgressTracker(image_name, job_id=job_id)
+        progress_trackers[tracker.job_id] = tracker
+    add_log = tracker.log
+    update_state = tracker.update
+    export_claim = None
+    exported_path = None
+    registry_puller = None
+    try:
+        tracker.timings.start()
+        update_state(status="starting", detail="准备开始下载...", queue_position=None)
         add_log("开始准备下载...")
         
-        # 添加一个小延迟，确保前端能获取到初始状态
-        await asyncio.sleep(0.5)
-        
-        # 获取最佳压缩方法
-        compression_method = get_compression_method()
-        method_name, method_config = compression_method
+        # 获取压缩方法
+        codec = get_compression_method(codec_name)
+        method_name = codec.name
+        if use_layer_cache and not codec.layer_compatible:
+            # docker load 只能读取 gzip/zstd 压缩的层
+            codec = get_compression_method("auto")
+            add_log(f"{method_name} 不能用于层压缩，层缓存改用 {codec.name}")
+            method_name = codec.name
         
-        # 构建保存路径
-        filename = f"{image_name.replace('/', '_').replace(':', '_')}{method_config['ext']}"
+        # 构建保存路径，使用层缓存时各层已单独压缩，归档本身不再整体压缩
+        ext = ".tar" if use_layer_cache else codec.ext
+        stem = image_name.replace('/', '_').replace(':', '_')
+        if delta_base:
+            stem += f"__delta_from_{delta_label(delta_base)}"
+        filename = f"{stem}{ext}"
         save_path = os.path.join(DOWNLOADS_DIR, filename)
+        tracker.output_path = save_path
+        if tracker.store:
+            tracker.store.update(tracker.job_id, file_path=save_path)
         
-        add_log(f"使用压缩方法: {method_name}")
+        if use_layer_cache:
+            add_log(f"使用层缓存导出，各层使用 {method_name} 单独压缩")
+        else:
+            add_log(f"使用压缩方法: {method_name}（级别 {codec.resolve_level(compression_level)}）")
+        if seekable:
+            add_log(f"分块并行压缩（每块 {SEEKABLE_BLOCK_SIZE // (1024 * 1024)}MB），生成成员索引")
         add_log(f"目标文件: {filename}")
         
         # 更新状态
-        download_progress[image_name]["status"] = "downloading"
-        download_progress[image_name]["detail"] = "正在检查镜像..."
+        update_state(status="downloading", detail="正在检查镜像...")
         add_log(f"开始拉取镜像: {image_name}")
         
-        # 获取镜像信息
-        try:
-            image = get_docker_client().images.get(image_name)
-            download_progress[image_name]["detail"] = "镜像已存在本地"
-            download_progress[image_name]["status"] = "downloading"
-            download_progress[image_name]["progress"] = 30
-            add_log("镜像已存在本地，跳过下载步骤")
-            await asyncio.sleep(1)
-            
-            download_progress[image_name]["detail"] = "跳过下载，开始保存镜像..."
-            download_progress[image_name]["progress"] = 60
-            add_log("开始保存已存在的镜像到文件")
-            await asyncio.sleep(1)
-        except docker.errors.ImageNotFound:
-            # 镜像不存在，需要下载
-            download_progress[image_name]["detail"] = "镜像不存在本地，开始从远程下载..."
-            download_progress[image_name]["progress"] = 5
-            add_log("镜像不存在本地，开始从远程仓库下载")
-            await asyncio.sleep(0.5)
-            
-            # 拉取镜像并跟踪进度
-            layer_count = 0
-            total_layers = 0
-            completed_layers = 0
-            
-            add_log("连接到Docker仓库，开始拉取镜像层...")
-            
-            for line in get_docker_client().api.pull(image_name, stream=True, decode=True):
-                if 'id' in line and 'status' in line:
-                    layer_id = line['id']
-                    status = line['status']
-                    
-                    # 统计总层数
-                    if layer_id not in download_progress[image_name]["layers"]:
-                        download_progress[image_name]["layers"][layer_id] = {
-                            "status": status,
-                            "progress": 0
-                        }
-                        total_layers += 1
-                        if status == "Pulling fs layer":
-                            add_log(f"发现新层 {layer_id}: 开始拉取")
-                    
-                    # 更新层状态
-                    download_progress[image_name]["layers"][layer_id]["status"] = status
-                    
-                    # 解析进度信息
-                    progress_info = ""
-                    if 'progressDetail' in line:
-                        detail = line['progressDetail']
-                        if 'current' in detail and 'total' in detail:
-                            current = detail['current']
-                            total = detail['total']
-                            if total > 0:
-                                progress = (current / total) * 100
-                                download_progress[image_name]["layers"][layer_id]["progress"] = int(progress)
-                                # 格式化字节大小
-                                current_mb = current / (1024 * 1024)
-                                total_mb = total / (1024 * 1024)
-                                progress_info = f" ({current_mb:.1f}MB/{total_mb:.1f}MB, {progress:.1f}%)"
-                    
-                    # 如果层完成了
-                    if status in ['Pull complete', 'Already exists']:
-                        download_progress[image_name]["layers"][layer_id]["progress"] = 100
-                        if status == 'Pull complete':
-                            completed_layers += 1
-                            add_log(f"层 {layer_id}: 下载完成")
-                        elif status == 'Already exists':
-                            add_log(f"层 {layer_id}: 已存在，跳过下载")
-                    elif status == 'Downloading':
-                        if progress_info:
-                            add_log(f"层 {layer_id}: 下载中{progress_info}")
-                    elif status == 'Extracting':
-                        if progress_info:
-                            add_log(f"层 {layer_id}: 解压中{progress_info}")
-                        elif 'progress' in line:
-                            add_log(f"层 {layer_id}: 解压中 - {line['progress']}")
-                    elif status == 'Verifying Checksum':
-                        add_log(f"层 {layer_id}: 验证校验和")
-                    elif status == 'Download complete':
-                        add_log(f"层 {layer_id}: 下载完成，开始解压")
-                    
-                    # 计算总体进度 (下载阶段占60%)
-                    if total_layers > 0:
-                        layer_progress = sum(layer["progress"] for layer in download_progress[image_name]["layers"].values())
-                        overall_progress = int((layer_progress / (total_layers * 100)) * 60)
-                        download_progress[image_name]["progress"] = max(5, overall_progress)
-                    
-                    # 更新详细信息
-                    status_msg = f"层 {layer_id}: {status}"
-                    if 'progress' in line:
-                        status_msg += f" - {line['progress']}"
-                    download_progress[image_name]["detail"] = status_msg
-                    
-                    # 添加小延迟，让前端有时间获取进度
-                    await asyncio.sleep(0.1)
+        loop = asyncio.get_running_loop()
+        base_info = base_diff_ids = base_key = None
+        if delta_base:
+            base_info, base_diff_ids, base_key = await loop.run_in_executor(
+                pull_executor, lambda: resolve_delta_base(delta_base, engine))
+            add_log(f"增量导出，基础为 {delta_base}（{base_key[:26]}），共 {len(base_diff_ids)} 个层")
+        variant = export_variant(engine, codec.family, use_layer_cache, base_key, seekable)
+        if engine == "registry":
+            # 直接从镜像仓库并行下载各层，不经过 Docker daemon；先只获取清单以确定镜像 ID
+            registry_puller = create_registry_puller(image_name, use_cache=use_layer_cache)
+            if delta_base:
+                # 基础中已有的层不下载
+                registry_puller.set_delta_base(base_info, base_diff_ids)
+            update_state(detail=f"正在从 {registry_puller.ref.registry} 获取镜像清单...", progress=5)
+            add_log(f"直接从镜像仓库拉取（不经过 Docker daemon）: {registry_puller.ref}")
+            identity = await loop.run_in_executor(pull_executor, registry_puller.identity)
+        else:
+            # 获取镜像信息
+            identity = await loop.run_in_executor(pull_executor, lambda: local_image_identity(image_name))
+            if identity:
+                update_state(detail="镜像已存在本地，跳过下载，开始保存镜像...", status="downloading", progress=60)
+                add_log("镜像已存在本地，跳过下载步骤")
+        
+        # 已有相同镜像的归档或其他任务正在导出同一镜像时，无需再次拉取与导出
+        reused_path = None
+        if identity:
+            reused_path, export_claim = await claim_export(tracker, identity, variant, save_path)
+        
+        if reused_path is None and registry_puller:
+            # 清单中已有各层大小，放不下的导出在拉取前就失败
+            await storage_manager.check_capacity(await loop.run_in_executor(pull_executor, lambda: estimate_archive_size(
+                [image_name], codec, use_layer_cache, [registry_puller])))
+        
+        if reused_path is None and (registry_puller or identity is None):
+            async with pull_slot(tracker):
+                if registry_puller:
+                    async for line in iter_threaded_events(registry_puller.pull):
+                        tracker.apply_pull_event(line)
+                    tracker.flush(force=True)
+                
+                    add_log(f"所有层下载完成！共处理 {tracker.layer_count} 个层，清单摘要: {registry_puller.manifest_digest}")
+                else:
+                    # 镜像不存在，需要下载
+                    update_state(detail="镜像不存在本地，开始从远程下载...", progress=5)
+                    add_log("镜像不存在本地，开始从远程仓库下载")
+                    add_log("连接到Docker仓库，开始拉取镜像层...")
+                
+                    # 拉取镜像并跟踪进度，事件在跟踪器中合并后按固定频率推送
+                    async for line in iter_pull_events(image_name):
+                        tracker.apply_pull_event(line)
+                    tracker.flush(force=True)
+                
+                    add_log(f"所有层下载完成！共处理 {tracker.layer_count} 个层")
             
-            add_log(f"所有层下载完成！共处理 {total_layers} 个层")
+            if identity is None:
+                identity = await loop.run_in_executor(pull_executor, lambda: local_image_identity(image_name))
+                if identity:
+                    reused_path, export_claim = await claim_export(tracker, identity, variant, save_path)
+        
+        if reused_path:
+            meta = read_archive_meta(reused_path) or {}
+            tracker.output_path = reused_path
+            if tracker.store:
+                tracker.store.update(tracker.job_id, file_path=reused_path)
+            add_log(f"已存在相同镜像（{identity['image_id'][:19]}）的归档，跳过导出: {os.path.basename(reused_path)}")
+            if reused_path != save_path:
+                add_log(f"归档中的镜像标签为 {', '.join(meta.get('repo_tags') or [])}，"
+                        f"docker load 后可使用 docker tag 重新打标签")
+            add_log(f"镜像 {image_name} 已就绪！")
+            ARCHIVE_REUSE.inc()
+            update_state(status="complete", detail="已复用相同镜像的归档", progress=100)
+            return {"status": "success", "message": "已复用相同镜像的归档"}
+        
+        # 目标文件将被覆盖，旧的元数据、成员索引与校验和不再有效
+        remove_archive_meta(save_path)
+        remove_index(save_path)
+        remove_checksums(save_path)
+        forget_verification(save_path)
         
         # 更新状态为保存中
-        download_progress[image_name]["status"] = "saving"
-        download_progress[image_name]["detail"] = f"正在保存到: {filename}"
-        download_progress[image_name]["progress"] = 70
+        update_state(status="saving", detail=f"正在使用 {method_name} 保存并压缩到: {filename}", progress=70)
         add_log(f"开始保存镜像到文件: {filename}")
-        await asyncio.sleep(0.5)
-        
-        # 更新压缩进度
-        download_progress[image_name]["detail"] = f"正在使用 {method_name} 压缩镜像数据..."
-        download_progress[image_name]["progress"] = 80
         add_log(f"使用高速压缩方法: {method_name}")
-        await asyncio.sleep(0.5)
         
-        # 在线程池中执行同步的保存操作
-        def save_image():
-            """保存镜像到压缩文件"""
+        # 在线程池中执行同步的保存操作，返回写入归档时计算的校验和
+        def save_image(threads: Optional[int]) -> Dict[str, str]:
+            """以流式方式将 docker save 的输出直接送入压缩进程，不落地未压缩的 tar；threads 为分配的压缩线程数"""
             try:
-                # 使用临时文件避免磁盘空间问题
-                with tempfile.NamedTemporaryFile(delete=False) as temp_tar:
-                    temp_tar_path = temp_tar.name
-                    try:
-                        # 先保存为tar到临时文件，带超时控制
-                        start_time = time.time()
-                        for chunk in get_docker_client().images.get(image_name).save():
-                            # 检查Docker保存操作是否超时
-                            if time.time() - start_time > DOCKER_SAVE_TIMEOUT:
-                                raise TimeoutError(f"Docker保存操作超时（{DOCKER_SAVE_TIMEOUT}秒）")
-                            temp_tar.write(chunk)
-                        temp_tar.flush()
-                        temp_tar.close()
-                        
-                        # 根据压缩方法进行压缩
-                        if method_name == "pigz":
-                            # 创建一个进度更新函数，接收当前的download_progress字典
-                            def make_progress_updater(progress_dict):
-                                def update_compression_progress(progress):
-                                    progress_dict[image_name]["progress"] = 80 + int(progress * 0.15)  # 80-95%
-                                    progress_dict[image_name]["detail"] = f"压缩进度: {progress}%"
-                                return update_compression_progress
-                            
-                            compress_with_pigz(
-                                open(temp_tar_path, 'rb'),
-                                save_path,
-                                progress_callback=make_progress_updater(download_progress)
-                            )
-                        else:
-                            # 使用 Python 内置 gzip (降级方案)
-                            with gzip.open(save_path, 'wb') as gz_file:
-                                shutil.copyfileobj(open(temp_tar_path, 'rb'), gz_file)
-                    finally:
-                        # 清理临时文件
-                        try:
-                            os.unlink(temp_tar_path)
-                        except:
-                            pass
-                        
+                if threads:
+                    add_log(f"压缩线程数: {threads}")
+                if registry_puller:
+                    image_chunks = registry_puller.iter_tar(chunk_size=SAVE_CHUNK_SIZE)
+                    image_size = registry_puller.tar_size()
+                else:
+                    image = get_docker_client().images.get(image_name)
+                    image_chunks = image.save(chunk_size=SAVE_CHUNK_SIZE)
+                    # 镜像未压缩大小仅用于估算进度，实际进度按已传输字节计算
+                    image_size = image.attrs.get("Size") or 0
+                image_chunks = tracker.timings.iter("save", image_chunks)
+
+                def update_compression_progress(bytes_done):
+                    done_mb = bytes_done / (1024 * 1024)
+                    if image_size > 0:
+                        progress = min(100, int(bytes_done * 100 / image_size))
+                        update_state(bytes_processed=bytes_done, progress=80 + int(progress * 0.15),  # 80-95%
+                                     detail=f"导出并压缩中: {done_mb:.1f}MB ({progress}%)")
+                    else:
+                        update_state(bytes_processed=bytes_done, detail=f"导出并压缩中: {done_mb:.1f}MB")
+
+                return write_archive(image_chunks, save_path, codec, compression_level, use_layer_cache,
+                                     from_registry=bool(registry_puller),
+                                     progress_callback=update_compression_progress, timings=tracker.timings,
+                                     exclude_diff_ids=None if registry_puller else base_diff_ids,
+                                     delta_base=base_info, seekable=seekable, threads=threads)
             except Exception as e:
                 if isinstance(e, TimeoutError):
                     raise Exception(f"操作超时: {str(e)}")
@@ -418,35 +1113,626 @@ async def pull_image_with_progress(image_name: str):
                     raise Exception(f"保存镜像失败: {str(e)}")
         
         # 使用线程池执行保存操作
-        with ThreadPoolExecutor() as executor:
-            await asyncio.get_event_loop().run_in_executor(executor, save_image)
+        estimated_size = await loop.run_in_executor(pull_executor, lambda: estimate_archive_size(
+            [image_name], codec, use_layer_cache, [registry_puller] if registry_puller else None))
+        add_log(f"预计归档大小: {estimated_size / (1024 * 1024):.1f}MB")
+        checksums = await run_export(
+            save_image, archive_stages(codec, use_layer_cache, bool(registry_puller)),
+            on_wait=lambda: update_state(detail="等待导出槽位..."),
+            estimated_size=estimated_size,
+            output_path=save_path,
+            on_wait_space=lambda: update_state(detail="等待下载目录腾出空间..."),
+            multithreaded=codec.multithreaded or seekable,
+            on_wait_cpu=lambda: update_state(detail="等待 CPU 空闲...")
+        )
+        
+        if use_layer_cache:
+            stats = layer_cache.stats()
+            add_log(f"层缓存: 命中 {stats['hits']} 次，未命中 {stats['misses']} 次，"
+                    f"占用 {stats['total_bytes'] / (1024 * 1024):.1f}MB")
         
-        download_progress[image_name]["progress"] = 95
-        download_progress[image_name]["detail"] = "保存完成，正在验证文件..."
+        update_state(progress=95, detail="保存完成，正在验证文件...")
         add_log("镜像保存完成，验证文件完整性...")
-        await asyncio.sleep(0.5)
         
         # 验证文件
         if os.path.exists(save_path):
             file_size = os.path.getsize(save_path)
             file_size_mb = file_size / (1024 * 1024)
             add_log(f"文件验证成功！文件大小: {file_size_mb:.1f}MB")
+            if checksums:
+                # 校验和在写入归档时已同步算出，无需再次读取文件
+                write_checksums(save_path, checksums)
+                for algorithm, digest in checksums.items():
+                    add_log(f"{algorithm.upper()}: {digest}")
+            tar_size = tracker.timings.snapshot()["stages"].get("save", {}).get("bytes", 0)
+            if engine == "docker" and not delta_base:
+                compression_ratios.record(codec.family, use_layer_cache, tar_size, file_size)
+            if identity:
+                # 记录镜像身份与导出方式，之后相同镜像的请求直接复用此归档
+                write_archive_meta(save_path, {
+                    "image_name": image_name,
+                    "repo_tags": [image_name],
+                    **identity,
+                    **variant,
+                    "codec": codec.name,
+                    "compression_level": codec.resolve_level(compression_level),
+                    "tar_size": tar_size,
+                    "checksums": checksums,
+                    "delta": base_info,
+                    "job_id": tracker.job_id,
+                })
+            exported_path = save_path
+            archive_index.refresh(save_path)
         
         # 更新最终状态
-        download_progress[image_name]["status"] = "complete"
-        download_progress[image_name]["detail"] = "下载完成"
-        download_progress[image_name]["progress"] = 100
         add_log(f"镜像 {image_name} 下载并保存完成！")
+        update_state(status="complete", detail="下载完成", progress=100)
         
         return {"status": "success", "message": "镜像拉取并保存成功"}
         
     except Exception as e:
         error_msg = f"拉取镜像失败: {str(e)}"
         logger.error(error_msg)
-        download_progress[image_name]["status"] = "error"
-        download_progress[image_name]["detail"] = str(e)
-        download_progress[image_name]["output"].append(f"[错误] {error_msg}")
+        with tracker.journal.lock:
+            tracker.log(f"[错误] {error_msg}")
+            update_state(status="error", detail=str(e))
         raise HTTPException(status_code=500, detail=error_msg)
+    finally:
+        if registry_puller:
+            # 无论成功、复用已有归档还是中途失败，都解除缓存固定或释放本任务的临时空间
+            registry_puller.release(success=os.path.exists(save_path))
+        if export_claim:
+            release_export(export_claim, exported_path)
+
+def delta_label(delta_base: str) -> str:
+    """增量归档文件名中表示基础的部分"""
+    name = delta_base
+    for ext in ARCHIVE_EXTENSIONS:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return name.replace('/', '_').replace(':', '_')
+
+def resolve_delta_base(delta_base: str, engine: str) -> Tuple[Dict, set, str]:
+    """解析增量导出的基础，返回 (写入 delta.json 的基础身份, 基础中全部层的 diff_id, 基础标识)
+
+    delta_base 为下载目录中的归档文件名时以该归档为基础；否则视为镜像名，docker 引擎要求镜像已在本地，
+    registry 引擎只获取其清单与配置。
+    """
+    archive_path = os.path.join(DOWNLOADS_DIR, os.path.basename(delta_base))
+    if delta_base.endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(archive_path):
+        info = archive_base_info(archive_path)
+        key = info.get("image_id") or "archive:" + (info.get("sha256") or f"{info['archive']}:{info['size']}")
+        return info, archive_diff_ids(archive_path), key
+    if engine == "registry":
+        identity = create_registry_puller(delta_base).identity()
+    else:
+        identity = local_image_identity(delta_base)
+        if identity is None:
+            raise Exception(f"基础镜像 {delta_base} 不在本地，也不是下载目录中的归档")
+    info = {"image": delta_base, "image_id": identity["image_id"], "repo_digests": identity["repo_digests"]}
+    return info, set(identity["layers"]), identity["image_id"]
+
+def bundle_filename(bundle_name: str, ext: str) -> str:
+    return f"{bundle_name.replace('/', '_').replace(':', '_')}{ext}"
+
+def default_bundle_name(image_names: List[str]) -> str:
+    """由镜像列表生成稳定的归档名，相同的镜像列表得到相同的名称"""
+    digest = hashlib.sha256("\n".join(sorted(image_names)).encode()).hexdigest()[:12]
+    return f"bundle_{len(image_names)}images_{digest}"
+
+async def pull_bundle_with_progress(bundle_name: str, image_names: List[str], engine: str = "docker",
+                                    use_layer_cache: Optional[bool] = None, codec_name: Optional[str] = None,
+                                    compression_level: Optional[int] = None, job_id: Optional[str] = None,
+                                    seekable: Optional[bool] = None):
+    """拉取多个镜像并导出为一个 docker load 兼容的归档，各镜像共享的层只保存一次
+
+    engine 为 docker 时拉取缺失的镜像后一次 docker save 全部镜像；为 registry 时逐个镜像下载各层，
+    再组装成一个 tar。manifest.json 中每个镜像一条记录，RepoTags 列出其标签。
+    进度按镜像（state["images"]）与整个打包任务分别报告。seekable 的含义与 pull_image_with_progress 相同。
+    """
+    use_layer_cache, seekable = resolve_export_format(use_layer_cache, seekable)
+    tracker = progress_trackers.get(job_id) if job_id else None
+    if not isinstance(tracker, BundleProgressTracker):
+        tracker = BundleProgressTracker(bundle_name, image_names, job_id=job_id)
+        progress_trackers[tracker.job_id] = tracker
+    add_log = tracker.log
+    update_state = tracker.update
+    pullers: List[RegistryPuller] = []
+    try:
+        tracker.timings.start()
+        update_state(status="starting", detail="准备开始打包...", queue_position=None)
+        add_log(f"开始打包 {len(image_names)} 个镜像: {', '.join(image_names)}")
+
+        codec = get_compression_method(codec_name)
+        method_name = codec.name
+        if use_layer_cache and not codec.layer_compatible:
+            codec = get_compression_method("auto")
+            add_log(f"{method_name} 不能用于层压缩，层缓存改用 {codec.name}")
+            method_name = codec.name
+
+        ext = ".tar" if use_layer_cache else codec.ext
+        filename = bundle_filename(bundle_name, ext)
+        save_path = os.path.join(DOWNLOADS_DIR, filename)
+        await wait_for_leases(tracker, [file_lease_key(save_path)])
+        tracker.output_path = save_path
+        if tracker.store:
+            tracker.store.update(tracker.job_id, file_path=save_path)
+        add_log(f"目标文件: {filename}")
+
+        loop = asyncio.get_running_loop()
+        update_state(status="downloading", detail="正在检查镜像...")
+        identities = {}
+        for name in image_names:
+            tracker.current_image = name
+            tracker.update_image(name, status="pulling")
+            if engine == "registry":
+                puller = create_registry_puller(name, use_cache=use_layer_cache)
+                pullers.append(puller)
+                add_log(f"[{name}] 直接从镜像仓库拉取: {puller.ref}")
+                async with pull_slot(tracker):
+                    async for line in iter_threaded_events(puller.pull):
+                        tracker.apply_pull_event(line)
+                identities[name] = await loop.run_in_executor(pull_executor, puller.identity)
+            else:
+                identity = await loop.run_in_executor(pull_executor, lambda: local_image_identity(name))
+                if identity:
+                    add_log(f"[{name}] 镜像已存在本地，跳过下载")
+                else:
+                    add_log(f"[{name}] 镜像不存在本地，开始从远程下载")
+                    async with pull_slot(tracker):
+                        async for line in iter_pull_events(name):
+                            tracker.apply_pull_event(line)
+                    identity = await loop.run_in_executor(pull_executor, lambda: local_image_identity(name))
+                    if identity is None:
+                        raise Exception(f"镜像 {name} 拉取后仍不存在")
+                identities[name] = identity
+            tracker.update_image(name, status="pulled", progress=100, image_id=identities[name]["image_id"])
+            tracker.flush(force=True)
+            add_log(f"[{name}] 拉取完成（{tracker.state['images'][name]['image_id'][:19]}）")
+        tracker.current_image = None
+
+        unique_layers = {layer for identity in identities.values() for layer in identity["layers"]}
+        total_layers = sum(len(identity["layers"]) for identity in identities.values())
+        add_log(f"共 {total_layers} 个层，去重后 {len(unique_layers)} 个，相同的层在归档中只保存一次")
+
+        remove_archive_meta(save_path)
+        remove_index(save_path)
+        remove_checksums(save_path)
+        forget_verification(save_path)
+        for name in image_names:
+            tracker.update_image(name, status="saving")
+        update_state(status="saving", detail=f"正在使用 {method_name} 打包并压缩到: {filename}", progress=70)
+
+        def save_bundle(threads: Optional[int]) -> Dict[str, str]:
+            try:
+                if threads:
+                    add_log(f"压缩线程数: {threads}")
+                if pullers:
+                    members = bundle_tar_members(pullers)
+                    image_chunks = iter_tar_members(members, chunk_size=SAVE_CHUNK_SIZE)
+                    image_size = tar_members_size(members)
+                else:
+                    client = get_docker_client()
+                    image_chunks = save_images(image_names)
+                    # 各镜像大小之和，共享层被重复计算，仅用于估算进度
+                    image_size = sum(client.images.get(name).attrs.get("Size") or 0 for name in image_names)
+                image_chunks = tracker.timings.iter("save", image_chunks)
+
+                def update_compression_progress(bytes_done):
+                    done_mb = bytes_done / (1024 * 1024)
+                    progress = min(100, int(bytes_done * 100 / image_size)) if image_size > 0 else 0
+                    update_state(bytes_processed=bytes_done, progress=70 + int(progress * 0.25),  # 70-95%
+                                 detail=f"打包并压缩中: {done_mb:.1f}MB")
+
+                return write_archive(image_chunks, save_path, codec, compression_level, use_layer_cache,
+                                     from_registry=bool(pullers), progress_callback=update_compression_progress,
+                                     timings=tracker.timings, seekable=seekable, threads=threads)
+            except Exception as e:
+                raise Exception(f"导出失败: {str(e)}")
+
+        estimated_size = await loop.run_in_executor(
+            pull_executor, lambda: estimate_archive_size(image_names, codec, use_layer_cache, pullers))
+        add_log(f"预计归档大小: {estimated_size / (1024 * 1024):.1f}MB")
+        checksums = await run_export(
+            save_bundle, archive_stages(codec, use_layer_cache, bool(pullers)),
+            on_wait=lambda: update_state(detail="等待导出槽位..."),
+            estimated_size=estimated_size,
+            output_path=save_path,
+            on_wait_space=lambda: update_state(detail="等待下载目录腾出空间..."),
+            multithreaded=codec.multithreaded or seekable,
+            on_wait_cpu=lambda: update_state(detail="等待 CPU 空闲...")
+        )
+
+        file_size = os.path.getsize(save_path)
+        add_log(f"打包完成！文件大小: {file_size / (1024 * 1024):.1f}MB")
+        tar_size = tracker.timings.snapshot()["stages"].get("save", {}).get("bytes", 0)
+        if engine == "docker":
+            compression_ratios.record(codec.family, use_layer_cache, tar_size, file_size)
+        if checksums:
+            write_checksums(save_path, checksums)
+            for algorithm, digest in checksums.items():
+                add_log(f"{algorithm.upper()}: {digest}")
+        write_archive_meta(save_path, {
+            "image_name": bundle_name,
+            "repo_tags": image_names,
+            "bundle": [{"image_name": name, **identities[name]} for name in image_names],
+            **export_variant(engine, codec.family, use_layer_cache, seekable=seekable),
+            "codec": codec.name,
+            "compression_level": codec.resolve_level(compression_level),
+            "tar_size": tar_size,
+            "checksums": checksums,
+            "job_id": tracker.job_id,
+        })
+        archive_index.refresh(save_path)
+        for name in image_names:
+            tracker.update_image(name, status="complete")
+        update_state(status="complete", detail="打包完成", progress=100)
+        return {"status": "success", "message": "镜像打包成功"}
+
+    except Exception as e:
+        error_msg = f"打包镜像失败: {str(e)}"
+        logger.error(error_msg)
+        with tracker.journal.lock:
+            if tracker.current_image:
+                tracker.update_image(tracker.current_image, status="error")
+            tracker.log(f"[错误] {error_msg}")
+            update_state(status="error", detail=str(e))
+        raise HTTPException(status_code=500, detail=error_msg)
+    finally:
+        # 某个镜像拉取失败时，已创建的 puller 也要解除缓存固定并释放临时空间
+        for puller in pullers:
+            puller.release(success=os.path.exists(save_path))
+
+def resolve_export_format(use_layer_cache: Optional[bool], seekable: Optional[bool],
+                          force_layer_cache: bool = False) -> Tuple[bool, bool]:
+    """确定是否使用层缓存与分块压缩，返回 (use_layer_cache, seekable)
+
+    两者互斥：显式要求的一方优先于另一方的默认值；force_layer_cache（docker 引擎的增量导出）时总是使用层缓存。
+    """
+    if force_layer_cache:
+        return True, False
+    if seekable is None:
+        seekable = SEEKABLE_ARCHIVES and not use_layer_cache
+    if seekable:
+        return False, True
+    return (LAYER_CACHE_ENABLED if use_layer_cache is None else use_layer_cache), False
+
+def estimate_archive_size(image_names: List[str], codec, use_layer_cache: bool,
+                          pullers: Optional[List[RegistryPuller]] = None) -> int:
+    """导出前预估归档大小，用于空间准入
+
+    registry 引擎按清单中各层的压缩大小之和（去重）计算；docker 引擎按镜像未压缩大小乘以
+    同一导出方式的历史压缩率（样本不足时为 STORAGE_COMPRESSION_RATIO），不压缩时按未压缩大小。
+    """
+    if pullers:
+        layers = {layer["digest"]: layer.get("size") or 0 for puller in pullers for layer in puller.layers}
+        return sum(layers.values())
+    client = get_docker_client()
+    size = sum(client.images.get(name).attrs.get("Size") or 0 for name in image_names)
+    if codec.name == "none" and not use_layer_cache:
+        return size
+    return int(size * compression_ratios.ratio(codec.family, use_layer_cache))
+
+def archive_stages(codec, use_layer_cache: bool, from_registry: bool) -> List[str]:
+    """写归档需要占用的调度阶段，registry 引擎使用层缓存或不压缩时没有压缩阶段"""
+    stages = ["save"]
+    if not (codec.name == "none" or (from_registry and use_layer_cache)):
+        stages.append("compress")
+    return stages
+
+async def run_export(save, stages: List[str], on_wait=None, estimated_size: int = 0, on_wait_space=None,
+                     multithreaded: bool = True, on_wait_cpu=None, output_path: Optional[str] = None):
+    """获得各阶段的槽位后在线程池中执行同步的导出函数 save(threads)，返回其结果
+
+    导出与压缩在同一条流水线中，需同时获得两个阶段的槽位。
+    estimated_size 为归档的预估大小，先在下载目录中为 output_path 预留空间（必要时淘汰旧归档），空间不足时按
+    STORAGE_ADMISSION 排队或失败；已写入的部分不再计入预留，预留在导出结束后释放。
+    有压缩阶段时再从 cpu_budget 分配压缩线程（multithreaded 为 False 的编解码器只用一个线程），
+    线程数传给 save；没有压缩阶段时为 None。
+    """
+    async with AsyncExitStack() as stage_slots:
+        await stage_slots.enter_async_context(storage_manager.admission(
+            estimated_size, output_path, wait=STORAGE_ADMISSION != "reject", timeout=STORAGE_ADMISSION_TIMEOUT,
+            on_wait=on_wait_space))
+        for stage in stages:
+            await stage_slots.enter_async_context(job_scheduler.stage(stage, on_wait=on_wait))
+        threads = None
+        if "compress" in stages:
+            threads = await stage_slots.enter_async_context(cpu_budget.allocate(multithreaded, on_wait=on_wait_cpu))
+        with ThreadPoolExecutor() as executor:
+            return await asyncio.get_running_loop().run_in_executor(executor, save, threads)
+
+async def import_archive_with_progress(source: Dict, job_id: str):
+    """将归档以流的方式解压并载入本机 Docker daemon（docker load），不生成未压缩的临时文件
+
+    source 为 {"path": 下载目录中的归档} 或 {"upload_id": 已上传完成的上传}，压缩格式按文件头识别。
+    读盘、解压（pigz/zstd/lz4 子进程）与向 daemon 上传同时进行，载入占用 load 阶段的槽位（MAX_CONCURRENT_LOADS）。
+    进度按已读取的压缩字节数计算，daemon 返回的层载入事件与拉取事件一样按层显示。
+    上传的归档导入成功后删除，失败时保留以便重试；下载目录中的归档在导入期间不会被淘汰。
+    """
+    tracker = progress_trackers[job_id]
+    add_log = tracker.log
+    update_state = tracker.update
+    loop = asyncio.get_running_loop()
+    upload_id = source.get("upload_id")
+    release_archive = storage_manager.lease(source["path"]) if source.get("path") else None
+    try:
+        tracker.timings.start()
+        update_state(status="starting", detail="准备导入...", queue_position=None)
+        if upload_id:
+            try:
+                upload = await loop.run_in_executor(None, upload_store.verify, upload_id)
+            except UploadError as e:
+                raise Exception(f"上传 {upload_id} 不可用: {e}")
+            path = upload_store.path(upload_id)
+            add_log(f"导入上传的归档: {upload['filename']}")
+        else:
+            path = source["path"]
+            if not os.path.isfile(path):
+                raise Exception(f"归档不存在: {os.path.basename(path)}")
+            add_log(f"导入归档: {os.path.basename(path)}")
+        archive_size = os.path.getsize(path)
+        codec = detect_codec(path)
+        add_log(f"归档格式: {codec.name}，大小 {archive_size / (1024 * 1024):.1f}MB")
+
+        last_report = 0.0
+
+        def update_read_progress(bytes_read: int):
+            nonlocal last_report
+            now = time.monotonic()
+            if now - last_report < 1 and bytes_read < archive_size:
+                return
+            last_report = now
+            read_mb = bytes_read / (1024 * 1024)
+            progress = 5 + int(bytes_read * 90 / archive_size) if archive_size else 5  # 5-95%
+            update_state(bytes_processed=bytes_read, progress=progress,
+                         detail=f"解压并载入中: {read_mb:.1f}MB/{archive_size / (1024 * 1024):.1f}MB")
+
+        def produce(emit):
+            # 等待解压输出的时间计入 decompress，未压缩的字节数计入 load
+            chunks = tracker.timings.iter("decompress", decompress_stream(path, codec, SAVE_CHUNK_SIZE,
+                                                                          update_read_progress))
+
+            def counted():
+                for chunk in chunks:
+                    tracker.timings.add_bytes("load", len(chunk))
+                    yield chunk
+
+            for line in get_docker_client().api.load_image(counted(), quiet=False):
+                emit(line)
+
+        loaded_images = []
+        async with job_scheduler.stage("load", on_wait=lambda: update_state(detail="等待导入槽位...")):
+            update_state(status="loading", detail="正在解压并载入 Docker...", progress=5)
+            with tracker.timings.measure("load"):
+                async for line in iter_threaded_events(produce, load_executor):
+                    if line.get("error") or line.get("errorDetail"):
+                        raise Exception(line.get("error") or line["errorDetail"].get("message"))
+                    message = (line.get("stream") or "").strip()
+                    if message:
+                        add_log(message)
+                        if message.startswith("Loaded image"):
+                            loaded_images.append(message.split(":", 1)[1].strip())
+                    else:
+                        tracker.apply_pull_event(line)
+            tracker.flush(force=True)
+        tracker.publish_timings()
+        if not loaded_images:
+            raise Exception("Docker 没有载入任何镜像")
+
+        if upload_id:
+            upload_store.remove(upload_id)
+        add_log(f"导入完成，载入 {len(loaded_images)} 个镜像: {', '.join(loaded_images)}")
+        update_state(status="complete", detail=f"导入完成: {', '.join(loaded_images)}", progress=100,
+                     loaded_images=loaded_images)
+    except Exception as e:
+        error_msg = f"导入失败: {str(e)}"
+        logger.error(error_msg)
+        with tracker.journal.lock:
+            tracker.log(f"[错误] {error_msg}")
+            update_state(status="error", detail=str(e))
+    finally:
+        if release_archive:
+            release_archive()
+
+async def start_job(image_name: str, params: Dict, job_id: Optional[str] = None) -> str:
+    """登记任务并提交给调度器排队执行，返回任务 ID
+
+    params 为 ImageRequest 中除镜像名以外的字段，打包任务的 image_name 为归档名、params["images"] 为镜像列表；
+    导入任务的 image_name 为归档文件名、params["import"] 为导入来源（见 import_archive_with_progress）；
+    指定 job_id 时重新执行任务存储中已有的任务（接管中断的任务，调用方已通过 claim 取得持有权）。
+    任务由当前 worker 持有并执行，持有期间定期续租。
+    """
+    if params.get("images"):
+        tracker = BundleProgressTracker(image_name, params["images"], job_id=job_id, store=job_store)
+    else:
+        tracker = PullProgressTracker(image_name, job_id=job_id, store=job_store)
+    loop = asyncio.get_running_loop()
+    if job_id:
+        await loop.run_in_executor(None, lambda: job_store.update(
+            job_id, status="queued", progress=0, detail="排队等待中...", finished_at=None))
+    else:
+        await loop.run_in_executor(None, lambda: job_store.create(
+            tracker.job_id, image_name, params, status="queued", detail="排队等待中...",
+            owner=WORKER_ID, lease_ttl=JOB_LEASE_TTL))
+    tracker.state.update(status="queued", detail="排队等待中...")
+    progress_trackers[tracker.job_id] = tracker
+    job_scheduler.submit(
+        tracker.job_id,
+        lambda: run_job(tracker.job_id, image_name, params),
+        priority=params.get("priority") or 0
+    )
+    return tracker.job_id
+
+async def run_job(job_id: str, image_name: str, params: Dict):
+    """由调度器的工作协程执行的任务，结束后释放内存中的跟踪器，最终状态已写入任务存储"""
+    try:
+        if not await asyncio.get_running_loop().run_in_executor(
+                None, job_store.claim, job_id, WORKER_ID, JOB_LEASE_TTL):
+            # 排队期间未能续租，任务已被其他 worker 接管
+            logger.warning(f"任务 {job_id} 已由其他 worker 接管，跳过")
+            return
+        if params.get("import"):
+            await import_archive_with_progress(params["import"], job_id)
+            return
+        if params.get("images"):
+            await pull_bundle_with_progress(
+                image_name,
+                params["images"],
+                params.get("engine", "docker"),
+                params.get("layer_cache"),
+                params.get("codec"),
+                params.get("compression_level"),
+                job_id=job_id,
+                seekable=params.get("seekable")
+            )
+            return
+        await pull_image_with_progress(
+            image_name,
+            params.get("engine", "docker"),
+            params.get("layer_cache"),
+            params.get("codec"),
+            params.get("compression_level"),
+            delta_base=params.get("delta_base"),
+            job_id=job_id,
+            seekable=params.get("seekable")
+        )
+    except HTTPException:
+        # 错误已记录在任务日志中
+        pass
+    finally:
+        # 服务关闭时任务被取消，任务存储中保留未结束的状态，租约过期后按中断任务处理
+        progress_trackers.pop(job_id, None)
+        job_store.release_leases(job_id, WORKER_ID)
+
+def find_active_tracker(image_name: str) -> Optional[PullProgressTracker]:
+    """查找该镜像正在运行的任务"""
+    for tracker in progress_trackers.values():
+        if tracker.image_name == image_name:
+            return tracker
+    return None
+
+def resolve_job_id(job_id: Optional[str], image_name: Optional[str]) -> Optional[str]:
+    """按任务 ID 或镜像名定位任务，镜像名对应正在运行的任务或最近一次任务"""
+    if job_id:
+        return job_id
+    if not image_name:
+        raise HTTPException(status_code=400, detail="需要提供 job_id 或 image_name")
+    tracker = find_active_tracker(image_name)
+    if tracker:
+        return tracker.job_id
+    job = job_store.latest_for_image(image_name)
+    return job["id"] if job else None
+
+def job_snapshot(job: Dict) -> Dict:
+    """将任务存储中的记录转换为与 PullProgressTracker.snapshot 相同的格式"""
+    return {
+        "job_id": job["id"],
+        "image_name": job["image_name"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "detail": job["detail"],
+        "output": job["output"] or [],
+        "layers": job["layers"] or {},
+        "timings": job["timings"],
+        "compacted": job["compacted"],
+        "worker": job["owner"],
+    }
+
+def remove_orphaned_exports():
+    """清理不属于任何未结束任务的未完成导出文件（<文件名>.tmp）
+
+    其他 worker 上运行中任务的 .tmp 保留；被中断任务的 .tmp 在 recover_interrupted_jobs 接管任务时清理。
+    """
+    active = {job["file_path"] + ".tmp" for job in job_store.unfinished() if job["file_path"]}
+    for filename in os.listdir(DOWNLOADS_DIR):
+        path = os.path.join(DOWNLOADS_DIR, filename)
+        if filename.endswith(".tmp") and not filename.startswith(".") and path not in active:
+            try:
+                os.unlink(path)
+                logger.info(f"已清理未完成的导出文件: {filename}")
+            except FileNotFoundError:
+                pass
+
+async def recover_interrupted_jobs() -> List[Dict]:
+    """接管持有者已退出（租约过期）的未结束任务，清理其未完成的导出文件后重新执行或标记为失败
+
+    每个任务只会被一个 worker 接管；registry 引擎未下载完的层（.partial）保留用于续传。
+    """
+    loop = asyncio.get_running_loop()
+    recovered = []
+    for job in await loop.run_in_executor(None, job_store.expired):
+        if not await loop.run_in_executor(None, job_store.claim, job["id"], WORKER_ID, JOB_LEASE_TTL):
+            continue
+        recovered.append(job)
+        if job["file_path"]:
+            try:
+                os.unlink(job["file_path"] + ".tmp")
+            except FileNotFoundError:
+                pass
+        if JOB_RESUME_INTERRUPTED:
+            logger.info(f"恢复被中断的任务: {job['id']} ({job['image_name']})")
+            await start_job(job["image_name"], job["params"], job_id=job["id"])
+        else:
+            await loop.run_in_executor(None, lambda: job_store.update(
+                job["id"], status="error", detail="服务重启，任务已中断", finished_at=time.time()))
+            logger.info(f"任务因服务重启而中断: {job['id']} ({job['image_name']})")
+    return recovered
+
+async def renew_leases_periodically(recover: bool = True):
+    """定期续租本 worker 持有的任务与租约，recover 为 True 时同时接管租约已过期的任务
+
+    续租失败（如事件循环长时间阻塞导致任务已被其他 worker 接管）的任务在本地取消，避免重复导出。
+    """
+    while True:
+        await asyncio.sleep(JOB_LEASE_TTL / 3)
+        try:
+            owned = set(await asyncio.get_running_loop().run_in_executor(
+                None, job_store.renew, WORKER_ID, JOB_LEASE_TTL))
+            for job_id in list(progress_trackers):
+                if job_id not in owned and job_id in job_scheduler.running:
+                    logger.warning(f"任务 {job_id} 已由其他 worker 接管，取消本地执行")
+                    job_scheduler.running[job_id].cancel()
+            if recover:
+                await recover_interrupted_jobs()
+        except Exception as e:
+            logger.error(f"续租任务失败: {str(e)}")
+
+def importing_uploads() -> set:
+    """未结束的导入任务（包括其他 worker 上的）正在使用的上传"""
+    return {(job["params"].get("import") or {}).get("upload_id") for job in job_store.unfinished()} - {None}
+
+async def sweep_storage_periodically():
+    """定期删除过期归档，并在超出配额或剩余空间不足时按 LRU 淘汰；同时清理过期的未完成上传"""
+    while True:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, storage_manager.sweep)
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: upload_store.cleanup(keep=importing_uploads()))
+        except Exception as e:
+            logger.error(f"清理下载目录失败: {str(e)}")
+        await asyncio.sleep(STORAGE_SWEEP_INTERVAL)
+
+async def compact_jobs_periodically():
+    """定期将过期任务压缩为摘要并删除超过保留期的任务"""
+    while True:
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, job_store.compact, JOB_TTL_HOURS * 3600, JOB_RETENTION_DAYS * 86400
+            )
+        except Exception as e:
+            logger.error(f"压缩任务记录失败: {str(e)}")
+        await asyncio.sleep(JOB_COMPACT_INTERVAL)
+
+@app.on_event("startup")
+async def on_startup():
+    job_scheduler.start()
+    remove_orphaned_exports()
+    await recover_interrupted_jobs()
+    asyncio.create_task(renew_leases_periodically())
+    asyncio.create_task(compact_jobs_periodically())
+    asyncio.create_task(sweep_storage_periodically())
 
 # 添加根路径重定向到前端应用
 @app.get("/")
@@ -490,54 +1776,348 @@ async def root():
     
     return FileResponse(index_path)
 
+def validate_image_request(request: ImageRequest):
+    """校验拉取引擎与压缩参数，同一镜像已有排队或运行中的任务时拒绝"""
+    if request.engine not in PULL_ENGINES:
+        raise HTTPException(status_code=400, detail=f"不支持的拉取引擎: {request.engine}")
+    try:
+        get_compression_method(request.codec).resolve_level(request.compression_level)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if request.seekable and request.layer_cache:
+        raise HTTPException(status_code=400, detail="分块压缩（seekable）不能与层缓存同时使用")
+    if request.seekable and request.delta_base and request.engine == "docker":
+        raise HTTPException(status_code=400, detail="docker 引擎的增量导出需要层缓存，不能使用分块压缩")
+    if find_active_tracker(request.image_name):
+        raise HTTPException(status_code=400, detail="该镜像正在下载中")
+
 @api_router.post("/pull-image")
 async def pull_image(request: ImageRequest):
-    """启动异步下载任务"""
+    """提交下载任务，任务在调度器中排队执行"""
+    validate_image_request(request)
     try:
-        # 如果已经有相同的下载任务在运行，返回错误
-        if request.image_name in download_tasks and not download_tasks[request.image_name].done():
-            raise HTTPException(status_code=400, detail="该镜像正在下载中")
-        
         # 创建新的下载任务
-        task = asyncio.create_task(pull_image_with_progress(request.image_name))
-        download_tasks[request.image_name] = task
+        job_id = await start_job(request.image_name, request.model_dump(exclude={"image_name"}))
         
-        return {"status": "started", "message": "开始下载镜像"}
+        return {
+            "status": "started",
+            "message": "开始下载镜像",
+            "job_id": job_id,
+            "queue_position": job_scheduler.positions().get(job_id, 0)
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"启动下载任务失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.post("/pull-images")
+async def pull_images(request: BatchImageRequest):
+    """批量提交下载任务，返回每个镜像的任务 ID 与排队位置，校验失败的镜像单独标记为 rejected"""
+    if not request.images:
+        raise HTTPException(status_code=400, detail="镜像列表不能为空")
+    if len(request.images) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"单次最多提交 {MAX_BATCH_SIZE} 个镜像")
+    results = []
+    for item in request.images:
+        try:
+            validate_image_request(item)
+        except HTTPException as e:
+            results.append({"image_name": item.image_name, "status": "rejected", "detail": e.detail})
+            continue
+        job_id = await start_job(item.image_name, item.model_dump(exclude={"image_name"}))
+        results.append({"image_name": item.image_name, "status": "queued", "job_id": job_id})
+
+    positions = job_scheduler.positions()
+    for result in results:
+        if "job_id" in result:
+            result["queue_position"] = positions.get(result["job_id"], 0)
+    return {"jobs": results, "queued": sum(1 for result in results if "job_id" in result)}
+
+@api_router.post("/pull-bundle")
+async def pull_bundle(request: BundleRequest):
+    """提交打包任务：多个镜像导出为一个 docker load 兼容的归档，共享的层只保存一次"""
+    image_names = list(dict.fromkeys(name.strip() for name in request.images if name.strip()))
+    if not image_names:
+        raise HTTPException(status_code=400, detail="镜像列表不能为空")
+    if len(image_names) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"单次最多打包 {MAX_BATCH_SIZE} 个镜像")
+    bundle_name = request.bundle_name or default_bundle_name(image_names)
+    validate_image_request(ImageRequest(image_name=bundle_name, **request.model_dump(exclude={"images", "bundle_name"})))
+    try:
+        job_id = await start_job(bundle_name, {**request.model_dump(exclude={"bundle_name"}), "images": image_names})
+        return {
+            "status": "started",
+            "message": f"开始打包 {len(image_names)} 个镜像",
+            "job_id": job_id,
+            "bundle_name": bundle_name,
+            "queue_position": job_scheduler.positions().get(job_id, 0)
+        }
+    except Exception as e:
+        logger.error(f"启动打包任务失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/uploads")
+async def create_upload(request: UploadRequest):
+    """登记一个可续传的上传，之后用 PATCH /api/uploads/{upload_id}?offset=N 按顺序提交数据"""
+    try:
+        return upload_store.create(request.filename, request.size, request.sha256)
+    except UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@api_router.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """上传的进度，offset 为已接收的字节数，断线后从这里继续"""
+    upload = upload_store.get(upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="上传不存在")
+    return upload
+
+@api_router.patch("/uploads/{upload_id}")
+async def append_upload(request: Request, upload_id: str, offset: int):
+    """从 offset 处追加请求体中的数据；offset 与已接收的字节数不一致时返回 409 与当前偏移
+
+    请求中途断开时已收到的部分保留，客户端查询偏移后续传。
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        with upload_store.writer(upload_id, offset) as write:
+            async for chunk in request.stream():
+                if chunk:
+                    offset = await loop.run_in_executor(None, write, chunk)
+    except UploadOffsetMismatch as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "offset": e.offset})
+    except UploadError as e:
+        status_code = 404 if upload_store.get(upload_id) is None else 400
+        raise HTTPException(status_code=status_code, detail=str(e))
+    upload = upload_store.get(upload_id)
+    return {"upload_id": upload_id, "offset": upload["offset"], "size": upload["size"], "complete": upload["complete"]}
+
+@api_router.delete("/uploads/{upload_id}")
+async def delete_upload(upload_id: str):
+    if upload_store.get(upload_id) is None:
+        raise HTTPException(status_code=404, detail="上传不存在")
+    if upload_id in importing_uploads():
+        raise HTTPException(status_code=400, detail="该上传正在导入中")
+    upload_store.remove(upload_id)
+    return {"status": "success"}
+
+@api_router.post("/imports")
+async def import_archive(request: ImportRequest):
+    """提交导入任务：将下载目录中的归档或已完成的上传载入本机 Docker，进度与下载任务一样查询
+
+    可以同时提交多个导入任务，同时载入的数量由 MAX_CONCURRENT_LOADS 限制。
+    """
+    if bool(request.path) == bool(request.upload_id):
+        raise HTTPException(status_code=400, detail="需要提供 path 或 upload_id 中的一个")
+    if request.upload_id:
+        upload = upload_store.get(request.upload_id)
+        if upload is None:
+            raise HTTPException(status_code=404, detail="上传不存在")
+        if not upload["complete"]:
+            raise HTTPException(status_code=400, detail=f"上传未完成，已接收 {upload['offset']}/{upload['size']} 字节")
+        if request.upload_id in importing_uploads():
+            raise HTTPException(status_code=400, detail="该上传正在导入中")
+        name = upload["filename"]
+        source = {"upload_id": request.upload_id}
+    else:
+        abs_path = resolve_download_path(request.path)
+        name = os.path.basename(abs_path)
+        source = {"path": abs_path}
+    job_id = await start_job(name, {"import": source, "priority": request.priority})
+    return {
+        "status": "started",
+        "message": f"开始导入 {name}",
+        "job_id": job_id,
+        "queue_position": job_scheduler.positions().get(job_id, 0)
+    }
+
+@api_router.get("/queue")
+async def get_queue():
+    """调度器状态：运行中的任务、排队顺序、各阶段的并发占用以及压缩线程的分配"""
+    return {**job_scheduler.stats(), "cpu": cpu_budget.stats()}
+
 @api_router.get("/pull-progress")
-async def get_pull_progress(image_name: str):
+async def get_pull_progress(image_name: Optional[str] = None, job_id: Optional[str] = None):
+    job_id = resolve_job_id(job_id, image_name)
     try:
-        if image_name not in download_progress:
+        tracker = progress_trackers.get(job_id) if job_id else None
+        if tracker:
+            return tracker.snapshot()
+        job = job_store.get(job_id) if job_id else None
+        if job is None:
             return {
                 "status": "not_found",
                 "progress": 0,
                 "detail": "未找到下载任务",
                 "output": []
             }
-        return download_progress[image_name]
+        return job_snapshot(job)
     except Exception as e:
         logger.error(f"获取进度失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"获取进度失败: {str(e)}")
 
-@api_router.get("/downloaded-files")
-async def list_downloaded_files():
+def format_sse(event_type: str, data: Dict, seq: Optional[int] = None) -> str:
+    """格式化一条 Server-Sent Events 消息"""
+    message = ""
+    if seq is not None:
+        message += f"id: {seq}\n"
+    message += f"event: {event_type}\n"
+    message += f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return message
+
+@api_router.get("/pull-progress/stream")
+async def stream_pull_progress(request: Request, image_name: Optional[str] = None, job_id: Optional[str] = None,
+                               last_event_id: Optional[int] = None):
+    """以 Server-Sent Events 推送增量进度
+
+    首次连接先推送一次完整快照（snapshot），之后只推送变化：state（状态/进度/详情）、
+    layer（单个层）、image（打包任务中单个镜像的状态与进度）、log（新日志行）。断线重连时通过 Last-Event-ID 请求头或
+    last_event_id 参数从指定序号继续；序号已被淘汰时重新推送快照。任务结束后发送 end 并关闭。
+    已结束的任务直接推送任务存储中的最终快照。
+    """
+    header_event_id = request.headers.get("last-event-id")
+    if last_event_id is None and header_event_id and header_event_id.isdigit():
+        last_event_id = int(header_event_id)
+    job_id = resolve_job_id(job_id, image_name)
+
+    async def event_stream():
+        last_seq = last_event_id
+        tracker = progress_trackers.get(job_id) if job_id else None
+        if tracker is None:
+            job = job_store.get(job_id) if job_id else None
+            if job is None:
+                yield format_sse("state", {"status": "not_found", "progress": 0, "detail": "未找到下载任务", "output": []})
+                yield format_sse("end", {"status": "not_found"})
+            elif job["status"] in FINISHED_STATUSES:
+                yield format_sse("snapshot", job_snapshot(job))
+                yield format_sse("end", {"status": job["status"]})
+            else:
+                async for message in stream_remote_progress(request, RemoteJobProgress(job)):
+                    yield message
+            return
+
+        journal = tracker.journal
+        while True:
+            with journal.lock:
+                events = None if last_seq is None else journal.since(last_seq)
+                if events is None:
+                    last_seq = journal.seq
+                    messages = [format_sse("snapshot", tracker.snapshot(), last_seq)]
+                else:
+                    messages = [format_sse(event_type, data, seq) for seq, event_type, data in events]
+                    if events:
+                        last_seq = events[-1][0]
+                status = tracker.state["status"]
+
+            for message in messages:
+                yield message
+            if status in FINISHED_STATUSES:
+                yield format_sse("end", {"status": status})
+                return
+            if await request.is_disconnected():
+                return
+
+            await journal.wait(last_seq, PROGRESS_STREAM_HEARTBEAT)
+            if journal.seq == last_seq:
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def stream_remote_progress(request: Request, remote: "RemoteJobProgress"):
+    """其他 worker 上运行的任务：任务存储中的进度变化时推送完整快照，任务结束后发送 end"""
+    sent_seq = None
+    last_sent = time.monotonic()
+    while True:
+        if remote.seq != sent_seq:
+            sent_seq = remote.seq
+            last_sent = time.monotonic()
+            yield format_sse("snapshot", remote.state)
+        status = remote.state["status"]
+        if status in FINISHED_STATUSES:
+            yield format_sse("end", {"status": status})
+            return
+        if await request.is_disconnected():
+            return
+        await remote.journal.wait(remote.journal.seq, PROGRESS_STREAM_HEARTBEAT)
+        if remote.seq == sent_seq and time.monotonic() - last_sent >= PROGRESS_STREAM_HEARTBEAT:
+            last_sent = time.monotonic()
+            yield ": keepalive\n\n"
+
+@api_router.get("/jobs")
+async def list_jobs(limit: int = 20, offset: int = 0, status: Optional[str] = None, image_name: Optional[str] = None):
+    """分页返回任务历史（按创建时间倒序，不含日志与层信息）"""
+    limit = max(1, min(limit, 200))
+    offset = max(0, offset)
     try:
-        files = []
-        # 只支持 .tar.gz 文件（pigz 压缩）
-        for filename in os.listdir(DOWNLOADS_DIR):
-            if filename.endswith('.tar.gz'):
-                file_path = os.path.join(DOWNLOADS_DIR, filename)
-                stat = os.stat(file_path)
-                files.append(DownloadedFile(
-                    name=filename,
-                    size=stat.st_size,
-                    created_at=datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S'),
-                    path=file_path
-                ))
-        return sorted(files, key=lambda x: x.created_at, reverse=True)
+        total, items = job_store.list(limit=limit, offset=offset, status=status, image_name=image_name)
+    except Exception as e:
+        logger.error(f"获取任务历史失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取任务历史失败: {str(e)}")
+    for item in items:
+        # 运行中的任务使用内存中的最新进度
+        tracker = progress_trackers.get(item["id"])
+        if tracker:
+            item.update({key: tracker.state[key] for key in ("status", "progress", "detail")})
+    return {"total": total, "limit": limit, "offset": offset, "items": items}
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """单个任务的完整记录，已压缩的任务不含日志与层信息"""
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    tracker = progress_trackers.get(job_id)
+    if tracker:
+        job.update(tracker.snapshot())
+    else:
+        job["output"] = job["output"] or []
+        job["layers"] = job["layers"] or {}
+    return job
+
+@api_router.get("/downloaded-files", response_model=DownloadedFilePage)
+async def list_downloaded_files(request: Request, sort: str = "created_at", order: str = "desc",
+                                image: Optional[str] = None, cursor: Optional[str] = None, limit: int = 100):
+    """分页返回下载目录中的归档
+
+    数据来自内存中的归档索引；sort 可选 created_at/mtime/size/name，order 为 asc/desc，
+    image 按镜像名过滤，cursor 为上一页返回的 next_cursor。响应带 ETag，索引未变化时返回 304。
+    """
+    if sort not in SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"不支持的排序字段: {sort}，可选: {', '.join(SORT_FIELDS)}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order 只能是 asc 或 desc")
+    limit = max(1, min(limit, 1000))
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, archive_index.revalidate)
+        etag = archive_index.etag
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers=headers)
+        entries, next_cursor, total = archive_index.query(
+            sort=sort, descending=order == "desc", image=image, cursor=cursor, limit=limit)
+        page = DownloadedFilePage(
+            items=[DownloadedFile(
+                name=entry["name"],
+                size=entry["size"],
+                created_at=datetime.fromtimestamp(entry["created_at"]).strftime('%Y-%m-%d %H:%M:%S'),
+                path=entry["path"],
+                created_ts=entry["created_at"],
+                mtime=entry["mtime"],
+                image_name=entry["image_name"],
+                sha256=entry["sha256"],
+                blake3=entry["blake3"]
+            ) for entry in entries],
+            next_cursor=next_cursor,
+            total=total
+        )
+        return JSONResponse(content=page.model_dump(), headers=headers)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"获取文件列表失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"获取文件列表失败: {str(e)}")
@@ -545,182 +2125,590 @@ async def list_downloaded_files():
 @api_router.delete("/clear-downloads")
 async def clear_downloads():
     try:
-        # 只删除 .tar.gz 文件
+        # 只删除归档文件及其元数据、成员索引与校验和，保留层缓存
+        sidecar_suffixes = (META_SUFFIX, INDEX_SUFFIX, *CHECKSUM_SUFFIXES.values())
         for filename in os.listdir(DOWNLOADS_DIR):
-            if filename.endswith('.tar.gz'):
+            if filename.endswith(ARCHIVE_EXTENSIONS) or filename.endswith(sidecar_suffixes):
                 file_path = os.path.join(DOWNLOADS_DIR, filename)
                 os.remove(file_path)
+                forget_verification(file_path)
                 logger.info(f"已删除文件: {file_path}")
+        archive_index.rescan(full=True)
         return {"status": "success", "message": "所有文件已清空"}
     except Exception as e:
         logger.error(f"清空文件失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"清空文件失败: {str(e)}")
 
-@api_router.get("/download-file")
-async def download_file(path: str):
+@api_router.get("/storage")
+async def get_storage_stats():
+    """下载目录的占用、配额、剩余空间、固定的归档与淘汰统计，以及估算归档大小使用的历史压缩率"""
+    stats = await asyncio.get_running_loop().run_in_executor(None, storage_manager.stats)
+    return {**stats, "compression_ratios": compression_ratios.stats()}
+
+@api_router.post("/storage/pin")
+async def pin_archive(path: str):
+    """固定归档，固定的归档不会被过期删除或淘汰"""
+    abs_path = resolve_download_path(path)
+    storage_manager.pin(abs_path)
+    return {"status": "success", "pinned": True, "name": os.path.basename(abs_path)}
+
+@api_router.delete("/storage/pin")
+async def unpin_archive(path: str):
+    abs_path = resolve_download_path(path)
+    storage_manager.pin(abs_path, pinned=False)
+    return {"status": "success", "pinned": False, "name": os.path.basename(abs_path)}
+
+@api_router.post("/storage/sweep")
+async def sweep_storage():
+    """立即执行一次过期删除与淘汰，返回被删除的归档"""
+    evicted = await asyncio.get_running_loop().run_in_executor(None, storage_manager.sweep)
+    return {"status": "success", "evicted": evicted}
+
+@api_router.get("/mirrors")
+async def get_mirror_stats():
+    """各加速地址（及 Docker Hub 本身）按优先级排列的延迟、吞吐量与健康状况"""
+    order = {url: index for index, url in enumerate(mirror_manager.order())}
+    return {"mirrors": sorted(mirror_manager.stats(), key=lambda info: order[info["url"]])}
+
+@api_router.post("/mirrors/probe")
+async def probe_mirrors():
+    """立即重新探测各地址的延迟"""
+    await asyncio.get_running_loop().run_in_executor(None, lambda: mirror_manager.refresh_latency(force=True))
+    return await get_mirror_stats()
+
+@api_router.get("/codecs")
+async def list_codecs():
+    """可用的压缩格式及默认值"""
+    return {"default": get_compression_method().name, "codecs": [codec.info() for codec in CODECS.values()]}
+
+@api_router.get("/layer-cache/stats")
+async def get_layer_cache_stats():
+    """层缓存的条目数、占用空间与命中统计"""
+    return layer_cache.stats()
+
+def resolve_download_path(path: str) -> str:
+    """验证文件路径在下载目录内且文件存在，返回绝对路径"""
+    abs_path = os.path.abspath(path)
+    downloads_root = os.path.abspath(DOWNLOADS_DIR)
+    if os.path.commonpath([abs_path, downloads_root]) != downloads_root:
+        raise HTTPException(status_code=400, detail="无效的文件路径")
+    if not os.path.isfile(abs_path):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return abs_path
+
+def serve_archive(request: Request, path: str, accel_redirect: Optional[str] = None) -> Response:
+    """发送下载目录中的归档，记录访问时间供 LRU 淘汰使用，发送期间归档不会被淘汰"""
+    storage_manager.touch(path)
+    response = file_response(request, path, accel_redirect=accel_redirect)
+    response.background = BackgroundTask(storage_manager.lease(path))
+    return response
+
+@api_router.api_route("/download-file", methods=["GET", "HEAD"])
+async def download_file(request: Request, path: str):
+    """下载归档文件，支持 Range/If-Range 断点续传、多段并行下载、ETag 与 HEAD"""
     try:
-        # 验证文件路径是否在下载目录内
-        abs_path = os.path.abspath(path)
-        if not abs_path.startswith(os.path.abspath(DOWNLOADS_DIR)):
-            raise HTTPException(status_code=400, detail="无效的文件路径")
-        
-        if not os.path.exists(abs_path):
-            raise HTTPException(status_code=404, detail="文件不存在")
+        abs_path = resolve_download_path(path)
+        downloads_root = os.path.abspath(DOWNLOADS_DIR)
         
-        # 获取文件名
-        filename = os.path.basename(abs_path)
+        accel_redirect = None
+        if DOWNLOAD_ACCEL_REDIRECT:
+            relative_path = os.path.relpath(abs_path, downloads_root).replace(os.sep, "/")
+            accel_redirect = DOWNLOAD_ACCEL_REDIRECT.rstrip("/") + "/" + quote(relative_path)
         
-        # 使用流式响应返回文件
-        return FileResponse(
-            abs_path,
-            filename=filename,
-            media_type='application/octet-stream',
-            background=None  # 禁用后台任务，避免文件被过早关闭
-        )
+        return serve_archive(request, abs_path, accel_redirect=accel_redirect)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"下载文件失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"下载文件失败: {str(e)}")
 
+verify_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_VERIFICATIONS, thread_name_prefix="verify")
+# 归档校验状态，按归档绝对路径索引；归档被删除、淘汰或重新导出时移除
+archive_verifications: Dict[str, Dict] = {}
+
+def forget_verification(path: str) -> None:
+    """移除归档的校验状态（归档已不存在或内容已改变）"""
+    archive_verifications.pop(os.path.abspath(path), None)
+
+def run_verification(abs_path: str, state: Dict):
+    """在 verify_executor 中流式计算归档的校验和并与 sidecar 比较，结果写入 state"""
+    size = os.path.getsize(abs_path)
+
+    def update_progress(bytes_done):
+        state.update(bytes_processed=bytes_done, progress=int(bytes_done * 100 / size) if size else 100)
+
+    try:
+        state.update(status="verifying")
+        result = verify_archive(abs_path, progress_callback=update_progress)
+        # 没有校验和记录时 verify_archive 会写入 sidecar
+        archive_index.refresh(abs_path)
+        state.update(result, status="complete", finished_at=time.time())
+        if result["ok"] is False:
+            logger.warning(f"归档校验失败: {abs_path}，不一致的算法: {', '.join(result['mismatched'])}")
+    except Exception as e:
+        logger.error(f"校验归档失败: {abs_path}: {e}")
+        state.update(status="error", detail=str(e), finished_at=time.time())
+
+@api_router.post("/verify-file")
+async def start_file_verification(path: str):
+    """在后台流式校验归档，立即返回校验状态；同一归档正在校验时返回已有的状态
+
+    ok 为 true/false 表示与导出时记录的校验和是否一致；归档没有校验和记录时计算并保存 SHA-256，ok 为 null。
+    """
+    abs_path = resolve_download_path(path)
+    state = archive_verifications.get(abs_path)
+    if state and state["status"] in ("queued", "verifying"):
+        return state
+    state = archive_verifications[abs_path] = {
+        "path": abs_path, "status": "queued", "progress": 0, "bytes_processed": 0, "started_at": time.time(),
+    }
+    asyncio.get_running_loop().run_in_executor(verify_executor, run_verification, abs_path, state)
+    return state
+
+@api_router.get("/verify-file")
+async def get_file_verification(path: str):
+    """查询归档的校验状态与结果"""
+    state = archive_verifications.get(os.path.abspath(path))
+    if state is None:
+        raise HTTPException(status_code=404, detail="该文件没有进行中或已完成的校验")
+    return state
+
+@api_router.get("/archive-contents")
+async def list_archive_contents(path: str):
+    """列出归档中的成员（名称、类型、大小、在未压缩 tar 中的偏移）
+
+    分块压缩的归档读取成员索引（indexed 为 true），未压缩的 tar 按 tar 头跳读；整体压缩的归档返回 409。
+    """
+    abs_path = resolve_download_path(path)
+    try:
+        members, indexed = await asyncio.get_running_loop().run_in_executor(None, list_members, abs_path)
+    except ArchiveNotSeekable as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"path": abs_path, "indexed": indexed, "members": members}
+
+@api_router.get("/archive-member")
+async def download_archive_member(path: str, name: str):
+    """读取归档中的单个文件（如 manifest.json），只解压与其重叠的块；发送期间归档不会被淘汰"""
+    abs_path = resolve_download_path(path)
+    try:
+        member, chunks = await asyncio.get_running_loop().run_in_executor(None, iter_member, abs_path, name)
+    except ArchiveNotSeekable as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="归档中没有该文件")
+    return StreamingResponse(
+        chunks,
+        media_type="application/octet-stream",
+        headers={
+            "Content-Length": str(member["size"]),
+            "Content-Disposition": content_disposition(os.path.basename(name)),
+        },
+        background=BackgroundTask(storage_manager.lease(abs_path)),
+    )
+
+class RemoteJobProgress:
+    """在其他 worker 上运行的任务，按 JOB_REMOTE_POLL_INTERVAL 从任务存储轮询进度
+
+    提供与 PullProgressTracker 相同的 state、output_path 与 journal（seq/wait）接口，
+    供进度推送与边导出边下载使用。
+    """
+
+    def __init__(self, job: Dict):
+        self.job_id = job["id"]
+        self.journal = self
+        self.seq = 0
+        self._apply(job)
+
+    def _apply(self, job: Dict):
+        self.updated_at = job["updated_at"]
+        self.state = job_snapshot(job)
+        self.output_path = job["file_path"]
+
+    async def wait(self, last_seq: int, timeout: float) -> None:
+        await asyncio.sleep(min(timeout, JOB_REMOTE_POLL_INTERVAL))
+        job = job_store.get(self.job_id)
+        if job is None:
+            # 任务记录已被删除
+            self.state = dict(self.state, status="error", detail="任务不存在")
+            self.seq += 1
+        elif job["updated_at"] != self.updated_at:
+            self._apply(job)
+            self.seq += 1
+
+class ArchiveExportFailed(Exception):
+    """边导出边下载时导出失败，中断传输使客户端得知归档不完整"""
+
+async def iter_growing_archive(tracker: PullProgressTracker, offset: int = 0):
+    """跟随正在写入的归档输出新数据，任务完成且读到文件末尾后结束，任务失败时抛出 ArchiveExportFailed
+
+    导出先写入 <目标文件>.tmp，完成后重命名；重命名不影响已打开的文件，因此只需在开始时确定打开哪个文件。
+    """
+    journal = tracker.journal
+    while True:
+        status = tracker.state["status"]
+        if status == "error":
+            raise ArchiveExportFailed(tracker.state.get("detail"))
+        path = tracker.output_path
+        try:
+            f = await anyio.open_file(path + ".tmp", "rb")
+            break
+        except FileNotFoundError:
+            pass
+        if status == "complete":
+            f = await anyio.open_file(path, "rb")
+            break
+        await journal.wait(journal.seq, ARCHIVE_FOLLOW_POLL_INTERVAL)
+
+    async with f:
+        await f.seek(offset)
+        while True:
+            chunk = await f.read(DOWNLOAD_CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                continue
+            status = tracker.state["status"]
+            if status == "complete":
+                # 完成状态在最后一次写入之后才更新，再读一次确认已到末尾
+                chunk = await f.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+                continue
+            if status == "error":
+                raise ArchiveExportFailed(tracker.state.get("detail"))
+            await journal.wait(journal.seq, ARCHIVE_FOLLOW_POLL_INTERVAL)
+
+@api_router.api_route("/jobs/{job_id}/download", methods=["GET", "HEAD"])
+async def download_job_archive(request: Request, job_id: str, offset: int = 0):
+    """下载任务导出的归档
+
+    任务已完成时等同于 download-file（支持 Range）；任务仍在排队或导出时以分块传输跟随写入进度，
+    持续输出新数据直到导出完成，导出失败时中断连接。跟随模式下断线后可以用 offset 从已接收的字节处继续。
+    """
+    tracker = progress_trackers.get(job_id)
+    if tracker is None:
+        job = job_store.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="任务不存在")
+        if job["status"] not in FINISHED_STATUSES:
+            # 任务在其他 worker 上运行，从任务存储跟随其进度
+            tracker = RemoteJobProgress(job)
+        else:
+            if job["status"] != "complete" or not job["file_path"] or not os.path.isfile(job["file_path"]):
+                raise HTTPException(status_code=404, detail="任务没有可下载的归档")
+            return serve_archive(request, job["file_path"])
+
+    # 排队中的任务还不知道目标文件名，等待导出开始
+    while tracker.output_path is None and tracker.state["status"] not in FINISHED_STATUSES:
+        if await request.is_disconnected():
+            return Response(status_code=204)
+        await tracker.journal.wait(tracker.journal.seq, PROGRESS_STREAM_HEARTBEAT)
+    if tracker.output_path is None:
+        raise HTTPException(status_code=404, detail="任务没有可下载的归档")
+
+    headers = {
+        "Content-Disposition": content_disposition(os.path.basename(tracker.output_path)),
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    }
+    if request.method == "HEAD":
+        return Response(headers=headers, media_type="application/octet-stream")
+    return StreamingResponse(iter_growing_archive(tracker, max(0, offset)), headers=headers,
+                             media_type="application/octet-stream")
+
+# 调度器、层缓存与下载目录的指标在抓取时读取当前值
+REGISTRY.register(Gauge("docker_pull_queue_depth", "排队中的任务数",
+                        collect=lambda: {(): len(job_scheduler.positions())}))
+REGISTRY.register(Gauge("docker_pull_active_jobs", "正在执行的任务数",
+                        collect=lambda: {(): len(job_scheduler.running)}))
+REGISTRY.register(Gauge("docker_pull_stage_slots_active", "各阶段占用的并发槽位", ["stage"],
+                        collect=lambda: {(name,): stage["active"]
+                                         for name, stage in job_scheduler.stats()["stages"].items()}))
+REGISTRY.register(Gauge("docker_pull_stage_slots_waiting", "等待各阶段槽位的任务数", ["stage"],
+                        collect=lambda: {(name,): stage["waiting"]
+                                         for name, stage in job_scheduler.stats()["stages"].items()}))
+REGISTRY.register(CallbackCounter("docker_pull_layer_cache_hits_total", "层缓存命中次数",
+                                  collect=lambda: {(): layer_cache.stats()["hits"]}))
+REGISTRY.register(CallbackCounter("docker_pull_layer_cache_misses_total", "层缓存未命中次数",
+                                  collect=lambda: {(): layer_cache.stats()["misses"]}))
+REGISTRY.register(Gauge("docker_pull_layer_cache_hit_ratio", "层缓存命中率",
+                        collect=lambda: {(): layer_cache.stats()["hit_rate"]}))
+REGISTRY.register(Gauge("docker_pull_layer_cache_bytes", "层缓存占用的字节数",
+                        collect=lambda: {(): layer_cache.stats()["total_bytes"]}))
+REGISTRY.register(Gauge("docker_pull_downloads_bytes", "下载目录中归档占用的字节数",
+                        collect=lambda: {(): storage_manager.used_bytes()}))
+REGISTRY.register(Gauge("docker_pull_downloads_free_bytes", "下载目录所在文件系统的剩余空间",
+                        collect=lambda: {(): storage_manager.free_bytes()}))
+REGISTRY.register(Gauge("docker_pull_compression_threads_allocated", "已分配给进行中压缩的线程数",
+                        collect=lambda: {(): cpu_budget.allocated}))
+REGISTRY.register(Gauge("docker_pull_mirror_healthy", "加速地址是否可用（1 可用，0 冷却中）", ["endpoint"],
+                        collect=lambda: {(info["url"],): int(info["healthy"]) for info in mirror_manager.stats()}))
+REGISTRY.register(Gauge("docker_pull_mirror_throughput_bytes_per_second", "加速地址测得的吞吐量", ["endpoint"],
+                        collect=lambda: {(info["url"],): info["throughput_bytes_per_second"]
+                                         for info in mirror_manager.stats() if info["throughput_bytes_per_second"]}))
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus 指标：各阶段耗时与吞吐量直方图、排队与运行中的任务数、缓存命中、压缩进程 CPU 时间"""
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # 将 api_router 挂载到主应用
 app.include_router(api_router)
 
 # 打印所有注册的路由，便于调试
-logger.info("已注册的API路由:")
-for route in app.routes:
-    if hasattr(route, 'methods'):
-        logger.info(f"  - {route.path} [{', '.join(route.methods)}]")
-    else:
-        logger.info(f"  - {route.path} [Mount]")
+if not HEADLESS:
+    logger.info("已注册的API路由:")
+    for route in app.routes:
+        if hasattr(route, 'methods'):
+            logger.info(f"  - {route.path} [{', '.join(route.methods)}]")
+        else:
+            logger.info(f"  - {route.path} [Mount]")
 
-logger.info(f"下载目录已创建: {DOWNLOADS_DIR}")
-logger.info("API路由已挂载到 /api 前缀")
+    logger.info(f"下载目录已创建: {DOWNLOADS_DIR}")
+    logger.info("API路由已挂载到 /api 前缀")
 
-def get_compression_method():
-    """获取压缩方法"""
-    if PIGZ_AVAILABLE:
-        return "pigz", COMPRESSION_METHOD
-    else:
-        # 如果 pigz 不可用，使用 Python 内置 gzip
-        return "gzip", {"name": "gzip", "ext": ".tar.gz", "command": None}
+class ChunkReader(io.RawIOBase):
+    """把字节块迭代器包装成只读文件对象，供 tarfile 流式解析"""
 
-def compress_with_pigz(input_stream, output_path, progress_callback=None):
-    """使用 pigz 进行高速并行压缩，带超时控制和进度反馈
-    
-    Args:
-        input_stream: 输入流
-        output_path: 输出文件路径
-        progress_callback: 可选的进度回调函数，接收压缩进度（0-100）
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def write_tar_member(outfile, info: tarfile.TarInfo, chunks=()):
+    """写入一个 tar 成员（头部、数据与补齐），info.size 必须与数据长度一致"""
+    outfile.write(info.tobuf(format=tarfile.GNU_FORMAT))
+    for chunk in chunks:
+        outfile.write(chunk)
+    remainder = info.size % tarfile.BLOCKSIZE
+    if remainder:
+        outfile.write(b"\0" * (tarfile.BLOCKSIZE - remainder))
+
+
+def iter_file_chunks(path: str, chunk_size: int = None):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size or SAVE_CHUNK_SIZE), b""):
+            yield chunk
+
+
+def write_archive(image_chunks, save_path, codec, level, use_layer_cache: bool, from_registry: bool = False,
+                  progress_callback=None, exclude_diff_ids=None, delta_base: Optional[Dict] = None,
+                  timings: Optional[StageTimings] = None, seekable: bool = False,
+                  threads: Optional[int] = None) -> Dict[str, str]:
+    """将 docker load 兼容的 tar 流写为归档，返回归档的校验和
+
+    registry 引擎生成的 tar 中层数据本身就是仓库中的压缩 blob，使用层缓存时原样写入；
+    docker save 的输出使用层缓存时逐层压缩，否则整体压缩；seekable 时分块并行压缩并写入成员索引。
+    exclude_diff_ids/delta_base 只用于 docker save 的输出（registry 引擎在生成 tar 时已省略基础中的层）。
+    timings 记录压缩与写盘阶段的耗时；threads 为压缩线程数（分块压缩时为同时压缩的块数），默认 COMPRESSION_THREADS。
     """
-    if not PIGZ_AVAILABLE:
-        # 使用 Python 内置 gzip
-        with gzip.open(output_path, 'wb') as gz_file:
-            shutil.copyfileobj(input_stream, gz_file)
-        return
-    
-    # 获取输入流大小用于进度计算
-    input_size = 0
-    if hasattr(input_stream, 'seek') and hasattr(input_stream, 'tell'):
-        current_pos = input_stream.tell()
-        input_stream.seek(0, 2)  # 移动到文件末尾
-        input_size = input_stream.tell()
-        input_stream.seek(current_pos)  # 恢复位置
-    
-    # 使用 pigz 进行并行压缩，限制CPU核心数
-    cmd = ["pigz", "--fast", "-p", "4", "-c"]
+    if seekable:
+        return write_seekable_archive(image_chunks, save_path, codec, level, workers=threads,
+                                      progress_callback=progress_callback,
+                                      checksum_algorithms=CHECKSUM_ALGORITHMS, timings=timings)
+    if from_registry and use_layer_cache:
+        return write_chunks_to_file(image_chunks, save_path, progress_callback=progress_callback, timings=timings)
+    if use_layer_cache:
+        return export_with_layer_cache(image_chunks, save_path, codec=codec, level=level,
+                                       progress_callback=progress_callback, exclude_diff_ids=exclude_diff_ids,
+                                       delta_base=delta_base, timings=timings, threads=threads)
+    return compress_stream(image_chunks, save_path, codec=codec, level=level, threads=threads,
+                           progress_callback=progress_callback, checksum_algorithms=CHECKSUM_ALGORITHMS,
+                           timings=timings)
+
+
+def write_chunks_to_file(chunks, output_path, progress_callback=None,
+                         timings: Optional[StageTimings] = None) -> Dict[str, str]:
+    """将字节块原样写入文件（先写临时文件，完成后重命名），按字节回调进度，返回写入内容的校验和"""
     temp_output = output_path + ".tmp"
-    
+    bytes_written = 0
+    last_report = 0.0
     try:
-        with open(temp_output, 'wb') as outfile:
-            process = subprocess.Popen(
-                cmd,
-                stdin=subprocess.PIPE,
-                stdout=outfile,
-                stderr=subprocess.PIPE,
-                bufsize=1024*1024  # 1MB缓冲区
+        with open(temp_output, "wb") as rawfile:
+            outfile = ChecksumWriter(timed_writer(rawfile, timings), CHECKSUM_ALGORITHMS)
+            for chunk in iter_with_bounded_buffer(chunks, timeout=DOCKER_SAVE_TIMEOUT):
+                outfile.write(chunk)
+                bytes_written += len(chunk)
+                if progress_callback and time.time() - last_report >= 1:
+                    last_report = time.time()
+                    progress_callback(bytes_written)
+        if progress_callback:
+            progress_callback(bytes_written)
+        os.rename(temp_output, output_path)
+        return outfile.hexdigests()
+    except Exception:
+        if os.path.exists(temp_output):
+            os.unlink(temp_output)
+        raise
+
+
+# docker save 输出中需要丢弃的 OCI 索引文件：层被替换为压缩格式后其中的摘要不再成立，
+# docker load 会改用 manifest.json
+DOCKER_SAVE_DROPPED_MEMBERS = ("index.json", "oci-layout")
+
+
+def _is_layer_member(name: str, head: bytes) -> bool:
+    """判断 docker save 中的成员是否为层 tar（旧格式 <id>/layer.tar，新格式 blobs/sha256/<digest>）"""
+    if name.endswith("/layer.tar"):
+        return True
+    return name.startswith("blobs/sha256/") and len(head) >= 262 and head[257:262] == b"ustar"
+
+
+def export_with_layer_cache(image_chunks, output_path, codec=None, level=None, progress_callback=None,
+                            exclude_diff_ids=None, delta_base: Optional[Dict] = None,
+                            timings: Optional[StageTimings] = None, threads: Optional[int] = None) -> Dict[str, str]:
+    """解析 docker save 的 tar 流，逐层压缩后组装 docker load 兼容的归档
+
+    每层以压缩格式和未压缩内容的 sha256（diff_id）为键保存在层缓存中：已缓存的层直接复用，
+    未缓存的层流式压缩进缓存。输出的归档由压缩后的层组成，不再整体压缩；
+    manifest.json 中的层路径改写为 <diff_id>/layer.tar。返回输出归档的校验和。
+    指定 exclude_diff_ids 时生成增量归档：这些层只保留 manifest 中的路径，并写入记录省略层的 delta.json。
+    """
+    omitted_layers: Dict[str, str] = {}
+    codec = codec or get_compression_method()
+    key_prefix = f"layers/{codec.family}"
+    temp_output = output_path + ".tmp"
+    bytes_read = 0
+    last_report = 0.0
+
+    def counted_chunks():
+        nonlocal bytes_read, last_report
+        for chunk in image_chunks:
+            bytes_read += len(chunk)
+            if progress_callback and time.time() - last_report >= 1:
+                last_report = time.time()
+                progress_callback(bytes_read)
+            yield chunk
+
+    renamed_layers = {}
+    layer_links = []
+    deferred = []
+    try:
+        with ExitStack() as pins, open(temp_output, "wb") as rawfile:
+            outfile = ChecksumWriter(timed_writer(rawfile, timings), CHECKSUM_ALGORITHMS)
+            source = tarfile.open(
+                fileobj=io.BufferedReader(ChunkReader(counted_chunks()), buffer_size=SAVE_CHUNK_SIZE),
+                mode="r|"
             )
-            
-            # 启动进度监控线程
-            if input_size > 0 and progress_callback:
-                def monitor_progress():
-                    while process.poll() is None:
-                        try:
-                            if hasattr(input_stream, 'tell'):
-                                current_pos = input_stream.tell()
-                                progress = min(100, int((current_pos / input_size) * 100))
-                                progress_callback(progress)
-                            time.sleep(1)  # 每秒更新一次进度
-                        except Exception:
-                            pass
-                
-                import threading
-                progress_thread = threading.Thread(target=monitor_progress, daemon=True)
-                progress_thread.start()
-            
-            # 使用超时控制复制数据
-            start_time = time.time()
-            bytes_copied = 0
-            chunk_size = 1024 * 1024  # 1MB chunks
-            
-            while True:
-                # 检查是否超时
-                if time.time() - start_time > COMPRESSION_TIMEOUT:
-                    process.kill()
-                    raise TimeoutError(f"压缩操作超时（{COMPRESSION_TIMEOUT}秒）")
-                
-                # 读取并写入数据
-                chunk = input_stream.read(chunk_size)
-                if not chunk:
-                    break
-                
-                try:
-                    process.stdin.write(chunk)
-                    bytes_copied += len(chunk)
-                    
-                    # 检查进程是否还活着
-                    if process.poll() is not None:
-                        stderr = process.stderr.read().decode()
-                        raise subprocess.CalledProcessError(
-                            process.returncode,
-                            cmd,
-                            f"压缩进程意外退出: {stderr}"
-                        )
-                except BrokenPipeError:
-                    stderr = process.stderr.read().decode()
-                    raise subprocess.CalledProcessError(
-                        process.returncode,
-                        cmd,
-                        f"压缩进程管道断开: {stderr}"
-                    )
-            
-            # 关闭输入流并等待进程完成
-            process.stdin.close()
-            try:
-                process.wait(timeout=30)  # 给进程30秒完成压缩
-            except subprocess.TimeoutExpired:
-                process.kill()
-                raise TimeoutError("压缩进程未能在30秒内完成")
-            
-            if process.returncode != 0:
-                stderr = process.stderr.read().decode()
-                raise subprocess.CalledProcessError(
-                    process.returncode,
-                    cmd,
-                    f"压缩失败: {stderr}"
-                )
-        
-        # 压缩成功，重命名临时文件
+            for member in source:
+                if member.name in DOCKER_SAVE_DROPPED_MEMBERS:
+                    continue
+                if member.issym() and member.name.endswith("/layer.tar"):
+                    # 旧格式中重复的层以符号链接表示，最后按目标层的新路径改写
+                    target = os.path.normpath(os.path.join(os.path.dirname(member.name), member.linkname))
+                    layer_links.append((member, target))
+                    continue
+                if not member.isfile():
+                    write_tar_member(outfile, member)
+                    continue
+                stream = source.extractfile(member)
+                if member.name == "manifest.json":
+                    deferred.append((member, stream.read()))
+                    continue
+
+                head = stream.read(tarfile.BLOCKSIZE)
+                if not _is_layer_member(member.name, head):
+                    write_tar_member(outfile, member, itertools.chain(
+                        [head], iter(lambda: stream.read(SAVE_CHUNK_SIZE), b"")))
+                    continue
+
+                # 新格式的成员名就是未压缩内容的摘要，可以在压缩前判断是否命中；
+                # 条目在查找或放入缓存之前固定，避免在写入归档前被其他任务触发的淘汰删除
+                known_digest = member.name.rsplit("/", 1)[-1] if member.name.startswith("blobs/sha256/") else None
+                excluded = (known_digest and exclude_diff_ids is not None
+                            and f"sha256:{known_digest}" in exclude_diff_ids)
+                cached_path = None
+                if known_digest and not excluded:
+                    pins.enter_context(layer_cache.pinned([f"{key_prefix}/{known_digest}"]))
+                    cached_path = layer_cache.lookup(f"{key_prefix}/{known_digest}")
+                if excluded or cached_path:
+                    # 增量导出中基础已有的层无需压缩
+                    digest = known_digest
+                else:
+                    hasher = hashlib.sha256()
+
+                    def layer_chunks():
+                        hasher.update(head)
+                        yield head
+                        for chunk in iter(lambda: stream.read(SAVE_CHUNK_SIZE), b""):
+                            hasher.update(chunk)
+                            yield chunk
+
+                    temp_layer = layer_cache.temp_path(f"{key_prefix}/{known_digest or uuid.uuid4().hex}")
+                    compress_stream(layer_chunks(), temp_layer, codec=codec, level=level, threads=threads,
+                                    timings=timings)
+                    digest = hasher.hexdigest()
+                    key = f"{key_prefix}/{digest}"
+                    pins.enter_context(layer_cache.pinned([key]))
+                    # 新格式在压缩前已计过一次未命中；旧格式只能在读完后得知摘要，命中时丢弃本次压缩结果
+                    if not known_digest and layer_cache.lookup(key):
+                        os.unlink(temp_layer)
+                    else:
+                        layer_cache.commit(key, temp_layer)
+
+                new_name = f"{digest}/layer.tar"
+                renamed_layers[member.name] = new_name
+                if exclude_diff_ids is not None and f"sha256:{digest}" in exclude_diff_ids:
+                    omitted_layers[new_name] = f"sha256:{digest}"
+                    continue
+                key = f"{key_prefix}/{digest}"
+                layer_path = layer_cache.path(key)
+                info = tarfile.TarInfo(new_name)
+                info.size = os.path.getsize(layer_path)
+                info.mtime = member.mtime
+                info.mode = 0o644
+                write_tar_member(outfile, info, iter_file_chunks(layer_path))
+
+            for member, target in layer_links:
+                if target in renamed_layers:
+                    renamed_layers[member.name] = renamed_layers[target]
+                else:
+                    write_tar_member(outfile, member)
+
+            for member, data in deferred:
+                manifest = json.loads(data)
+                for entry in manifest:
+                    entry["Layers"] = [renamed_layers.get(layer, layer) for layer in entry.get("Layers", [])]
+                data = json.dumps(manifest).encode()
+                member.size = len(data)
+                write_tar_member(outfile, member, [data])
+            if exclude_diff_ids is not None:
+                data = delta_manifest(delta_base or {}, omitted_layers)
+                info = tarfile.TarInfo(DELTA_MANIFEST)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                info.mode = 0o644
+                write_tar_member(outfile, info, [data])
+            outfile.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+
+        if progress_callback:
+            progress_callback(bytes_read)
         os.rename(temp_output, output_path)
-        
-    except Exception as e:
-        # 清理临时文件
+        return outfile.hexdigests()
+    except Exception:
         if os.path.exists(temp_output):
-            try:
-                os.unlink(temp_output)
-            except:
-                pass
-        raise e
+            os.unlink(temp_output)
+        raise
 
 if __name__ == "__main__":
     # 使用环境变量中的主机和端口
-    logger.info(f"启动服务 - 主机: {API_HOST}, 端口: {API_PORT}")
-    uvicorn.run(app, host=API_HOST, port=API_PORT) 
\ No newline at end of file
+    logger.info(f"启动服务 - 主机: {API_HOST}, 端口: {API_PORT}, worker 数: {API_WORKERS}")
+    if API_WORKERS > 1:
+        # 多进程时 uvicorn 需要以导入字符串加载应用，各 worker 通过任务存储协调
+        uvicorn.run("main:app", host=API_HOST, port=API_PORT, workers=API_WORKERS)
+    else:
+        uvicorn.run(app, host=API_HOST, port=API_PORT) 
\ No newline at end of file
@@ -0,0 +1,281 @@
+"""导出流水线的计时与 Prometheus 指标
+
+每个任务有一个 StageTimings，记录各阶段的忙碌时间与处理字节数：
+- pull：从镜像仓库拉取（墙钟时间，字节为各层大小之和）
+- save：读取 docker save 输出或组装 registry 引擎的 tar
+- compress：向压缩器写入未压缩数据（压缩器跟不上时在此阻塞）
+- write：将归档写入磁盘（不含校验和计算）
+- decompress：导入时等待解压输出（解压器跟不上时在此阻塞）
+- load：导入时解压并载入 Docker daemon（墙钟时间，字节为未压缩的 tar 大小）
+
+save/compress/write 在同一条流水线中并行执行，各阶段的忙碌时间之和可能超过导出的墙钟时间；
+忙碌时间最接近墙钟时间的阶段就是瓶颈。外部压缩进程（pigz/zstd/lz4）的 CPU 时间单独记录。
+
+指标以 Prometheus 文本格式（0.0.4）输出，不依赖 prometheus_client。
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# 各阶段的名称，按流水线顺序
+STAGES = ("pull", "save", "compress", "write", "decompress", "load")
+
+# 阶段耗时（秒）与吞吐量（字节/秒）直方图的桶
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+THROUGHPUT_BUCKETS = tuple(2 ** power * 1024 * 1024 for power in range(-2, 12))
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(_Metric):
+    """抓取时由 collect() 计算当前值，collect 返回 {标签值元组: 数值}"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def samples(self) -> List[str]:
+        values = sorted(self.collect().items()) if self.collect else []
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in values]
+
+
+class CallbackCounter(Gauge):
+    """抓取时由 collect() 给出当前值的计数器，用于其他模块自行维护的累计值（如层缓存命中次数）"""
+    kind = "counter"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 buckets: Iterable[float] = DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[Tuple[str, ...], Dict] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, dict(series, counts=list(series["counts"]))) for key, series in self._values.items())
+        lines = []
+        for key, series in values:
+            for bound, count in zip(self.buckets, series["counts"]):
+                labels = _format_labels(self.label_names, key, (("le", _format_value(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "docker_pull_stage_duration_seconds", "各阶段每个任务的忙碌时间", ["stage"], DURATION_BUCKETS))
+STAGE_THROUGHPUT = REGISTRY.register(Histogram(
+    "docker_pull_stage_throughput_bytes_per_second", "各阶段每个任务的吞吐量", ["stage"], THROUGHPUT_BUCKETS))
+STAGE_SECONDS = REGISTRY.register(Counter(
+    "docker_pull_stage_seconds_total", "各阶段的累计忙碌时间", ["stage"]))
+STAGE_BYTES = REGISTRY.register(Counter(
+    "docker_pull_stage_bytes_total", "各阶段的累计处理字节数", ["stage"]))
+COMPRESSOR_CPU = REGISTRY.register(Counter(
+    "docker_pull_compressor_cpu_seconds_total", "外部压缩进程的累计 CPU 时间（用户态 + 内核态）", ["codec"]))
+JOB_DURATION = REGISTRY.register(Histogram(
+    "docker_pull_job_duration_seconds", "任务从开始执行到结束的墙钟时间", ["status"], DURATION_BUCKETS))
+JOBS_FINISHED = REGISTRY.register(Counter(
+    "docker_pull_jobs_finished_total", "结束的任务数", ["status"]))
+ARCHIVE_REUSE = REGISTRY.register(Counter(
+    "docker_pull_archive_reuse_total", "直接复用已有归档而未导出的任务数"))
+
+
+class StageTimings:
+    """单个任务各阶段的忙碌时间、字节数与压缩进程 CPU 时间，可在多个线程中累加"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._seconds: Dict[str, float] = {}
+        self._bytes: Dict[str, int] = {}
+        self._cpu: Dict[str, float] = {}
+
+    def start(self) -> None:
+        """任务开始执行（结束排队）时调用，墙钟时间从此刻算起"""
+        self.started_at = time.time()
+
+    def add(self, stage: str, seconds: float, nbytes: int = 0) -> None:
+        with self._lock:
+            self._seconds[stage] = self._seconds.get(stage, 0.0) + seconds
+            self._bytes[stage] = self._bytes.get(stage, 0) + nbytes
+
+    def add_bytes(self, stage: str, nbytes: int) -> None:
+        self.add(stage, 0.0, nbytes)
+
+    def add_cpu(self, codec: str, seconds: float) -> None:
+        with self._lock:
+            self._cpu[codec] = self._cpu.get(codec, 0.0) + seconds
+
+    def seconds(self, stage: str) -> float:
+        with self._lock:
+            return self._seconds.get(stage, 0.0)
+
+    @contextmanager
+    def measure(self, stage: str):
+        """记录代码块的墙钟时间"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def iter(self, stage: str, chunks: Iterable[bytes]):
+        """包装字节块迭代器，取下一块所花的时间与块大小计入 stage"""
+        iterator = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                self.add(stage, time.perf_counter() - start)
+                return
+            self.add(stage, time.perf_counter() - start, len(chunk))
+            yield chunk
+
+    def finish(self) -> None:
+        if self.finished_at is None:
+            self.finished_at = time.time()
+
+    def snapshot(self) -> Dict:
+        """结构化的计时明细，写入任务进度与任务存储"""
+        with self._lock:
+            seconds = dict(self._seconds)
+            nbytes = dict(self._bytes)
+            cpu = dict(self._cpu)
+        stages = {}
+        for stage in sorted(seconds, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+            stages[stage] = {
+                "seconds": round(seconds[stage], 3),
+                "bytes": nbytes.get(stage, 0),
+                "bytes_per_second": int(nbytes.get(stage, 0) / seconds[stage]) if seconds[stage] > 0 else None,
+            }
+        end = self.finished_at or time.time()
+        return {
+            "wall_seconds": round(end - self.started_at, 3),
+            "stages": stages,
+            "compressor_cpu_seconds": {codec: round(value, 3) for codec, value in cpu.items()},
+        }
+
+    def observe(self, status: str) -> None:
+        """任务结束时将计时计入全局指标"""
+        self.finish()
+        snapshot = self.snapshot()
+        for stage, values in snapshot["stages"].items():
+            STAGE_DURATION.observe(values["seconds"], stage=stage)
+            STAGE_SECONDS.inc(values["seconds"], stage=stage)
+            STAGE_BYTES.inc(values["bytes"], stage=stage)
+            if values["bytes_per_second"] is not None:
+                STAGE_THROUGHPUT.observe(values["bytes_per_second"], stage=stage)
+        for codec, seconds in snapshot["compressor_cpu_seconds"].items():
+            COMPRESSOR_CPU.inc(seconds, codec=codec)
+        JOB_DURATION.observe(snapshot["wall_seconds"], status=status)
+        JOBS_FINISHED.inc(status=status)
+
+
+class TimedWriter:
+    """包装可写文件对象，写入时间与字节数计入 timings 的 stage"""
+
+    def __init__(self, fileobj, timings: StageTimings, stage: str = "write"):
+        self.fileobj = fileobj
+        self.timings = timings
+        self.stage = stage
+
+    def write(self, data) -> int:
+        start = time.perf_counter()
+        written = self.fileobj.write(data)
+        self.timings.add(self.stage, time.perf_counter() - start, len(data))
+        return written
+
+    def flush(self) -> None:
+        self.fileobj.flush()
+
+
+def timed_writer(fileobj, timings: Optional[StageTimings], stage: str = "write"):
+    """timings 为 None 时原样返回 fileobj"""
+    return TimedWriter(fileobj, timings, stage) if timings is not None else fileobj
@@ -0,0 +1,207 @@
+"""镜像仓库加速地址（mirror）的选择
+
+DOCKER_REGISTRY_MIRROR 可以配置多个加速地址（逗号分隔），与 dockerd 的 registry-mirrors 一样只用于
+Docker Hub 上的镜像。MirrorManager 记录每个地址（包括 Docker Hub 本身）的延迟、吞吐量与健康状况：
+- 探测：GET /v2/ 的响应时间作为延迟，读取一段层数据估算吞吐量，结果缓存 probe_ttl 秒
+- 实际下载：每个层下载完成后按实际吞吐量更新（指数加权平均）
+- 失败：连接失败、摘要校验失败或下载速度低于下限的地址暂时不再优先使用，连续失败时冷却时间加倍
+
+拉取时按预计下载时间（延迟 + 参考大小 / 吞吐量）从快到慢使用健康的地址，冷却中的地址排在最后兜底。
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# 估算下载时间时使用的参考大小，以及尚未测得吞吐量时假设的值（字节/秒）
+REFERENCE_SIZE = 32 * 1024 * 1024
+DEFAULT_THROUGHPUT = 1024 * 1024
+# 实际下载更新吞吐量时的加权系数；小于 MIN_SAMPLE_BYTES 的下载主要反映延迟，不计入吞吐量
+THROUGHPUT_SMOOTHING = 0.3
+MIN_SAMPLE_BYTES = 256 * 1024
+# 吞吐量探测读取的字节数
+PROBE_BYTES = 512 * 1024
+# 连续失败时冷却时间最多放大的倍数
+MAX_COOLDOWN_FACTOR = 8
+
+# 探测函数：参数为地址，返回延迟（秒）或吞吐量（字节/秒），失败时抛出异常
+ProbeFunction = Callable[[str], float]
+
+
+def normalize_endpoint(url: str) -> str:
+    """统一为不带 /v2 与末尾斜杠的地址，没有协议时使用 https"""
+    url = url.strip().rstrip("/")
+    if url.endswith("/v2"):
+        url = url[:-len("/v2")]
+    if "://" not in url:
+        url = f"https://{url}"
+    return url
+
+
+class EndpointStats:
+    """单个地址的测量结果与健康状况"""
+
+    def __init__(self, url: str, upstream: bool = False):
+        self.url = url
+        self.upstream = upstream
+        self.latency: Optional[float] = None
+        self.throughput: Optional[float] = None
+        self.latency_at = 0.0
+        self.throughput_at = 0.0
+        self.failures = 0
+        self.unhealthy_until = 0.0
+        self.last_error: Optional[str] = None
+        self.bytes_downloaded = 0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.unhealthy_until
+
+    def expected_seconds(self) -> float:
+        """下载参考大小的数据预计需要的时间"""
+        latency = self.latency if self.latency is not None else 1.0
+        return latency + REFERENCE_SIZE / (self.throughput or DEFAULT_THROUGHPUT)
+
+    def info(self, now: float) -> Dict:
+        return {
+            "url": self.url,
+            "upstream": self.upstream,
+            "healthy": self.healthy(now),
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "throughput_bytes_per_second": int(self.throughput) if self.throughput else None,
+            "failures": self.failures,
+            "cooldown_seconds": round(max(self.unhealthy_until - now, 0), 1),
+            "last_error": self.last_error,
+            "bytes_downloaded": self.bytes_downloaded,
+        }
+
+
+class MirrorManager:
+    """加速地址的测量与排序，可在多个线程中使用
+
+    registry 为加速地址服务的镜像仓库（如 docker.io），upstream 为该仓库本身的地址。
+    min_throughput 大于 0 时，单个层在任意 stall_window 秒内的下载速度低于该值（字节/秒）即切换到下一个地址。
+    """
+
+    def __init__(self, mirrors: List[str], registry: str, upstream: str, probe_ttl: float = 300,
+                 probe_timeout: float = 5, failure_cooldown: float = 60, min_throughput: float = 0,
+                 stall_window: float = 15, proxies: Optional[Dict] = None):
+        self.registry = registry
+        self.upstream = normalize_endpoint(upstream)
+        self.mirrors = [url for url in dict.fromkeys(normalize_endpoint(url) for url in mirrors) if url != self.upstream]
+        self.probe_ttl = probe_ttl
+        self.probe_timeout = probe_timeout
+        self.failure_cooldown = failure_cooldown
+        self.min_throughput = min_throughput
+        self.stall_window = stall_window
+        self.session = requests.Session()
+        self.session.trust_env = False
+        if proxies:
+            self.session.proxies.update(proxies)
+        self._stats: Dict[str, EndpointStats] = {url: EndpointStats(url) for url in self.mirrors}
+        self._stats[self.upstream] = EndpointStats(self.upstream, upstream=True)
+        self._lock = threading.Lock()
+        # 同一时间只有一个线程执行探测，其他线程等待后直接使用结果
+        self._probe_lock = threading.Lock()
+
+    def applies_to(self, registry: str) -> bool:
+        return bool(self.mirrors) and registry == self.registry
+
+    # 探测
+
+    def probe_latency(self, url: str) -> float:
+        """GET /v2/ 的响应时间；200 与 401（需要认证）都表示服务正常"""
+        start = time.perf_counter()
+        response = self.session.get(f"{url}/v2/", timeout=self.probe_timeout)
+        elapsed = time.perf_counter() - start
+        response.close()
+        if response.status_code not in (200, 401):
+            raise requests.HTTPError(f"HTTP {response.status_code}")
+        return elapsed
+
+    def _refresh(self, kind: str, probe: ProbeFunction, force: bool = False) -> None:
+        def stale() -> List[str]:
+            now = time.monotonic()
+            with self._lock:
+                return [stats.url for stats in self._stats.values()
+                        if force or now - getattr(stats, f"{kind}_at") >= self.probe_ttl]
+
+        if not stale():
+            return
+        with self._probe_lock:
+            urls = stale()
+            if not urls:
+                return
+            with ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="mirror-probe") as executor:
+                futures = {url: executor.submit(probe, url) for url in urls}
+            for url, future in futures.items():
+                try:
+                    value = future.result()
+                except Exception as e:
+                    self.record_failure(url, e)
+                    value = None
+                with self._lock:
+                    stats = self._stats[url]
+                    setattr(stats, f"{kind}_at", time.monotonic())
+                    if value is not None:
+                        setattr(stats, kind, value)
+            summary = ", ".join(f"{info['url']}={'ok' if info['healthy'] else 'down'}" for info in self.stats())
+            logger.info(f"加速地址探测结果（{kind}）: {summary}")
+
+    def refresh_latency(self, force: bool = False) -> None:
+        """探测缓存已过期的地址的延迟"""
+        self._refresh("latency", self.probe_latency, force)
+
+    def refresh_throughput(self, probe: ProbeFunction, force: bool = False) -> None:
+        """用 probe（通常读取当前镜像某个层的前 PROBE_BYTES 字节）探测缓存已过期的地址的吞吐量"""
+        self._refresh("throughput", probe, force)
+
+    # 结果记录
+
+    def record_download(self, url: str, nbytes: int, seconds: float) -> None:
+        """一次成功的下载：清除失败记录，足够大的下载计入吞吐量"""
+        with self._lock:
+            stats = self._stats.get(url)
+            if stats is None:
+                return
+            stats.failures = 0
+            stats.unhealthy_until = 0.0
+            stats.bytes_downloaded += nbytes
+            if nbytes >= MIN_SAMPLE_BYTES and seconds > 0:
+                rate = nbytes / seconds
+                if stats.throughput:
+                    rate = THROUGHPUT_SMOOTHING * rate + (1 - THROUGHPUT_SMOOTHING) * stats.throughput
+                stats.throughput = rate
+                stats.throughput_at = time.monotonic()
+
+    def record_failure(self, url: str, error: Exception) -> None:
+        with self._lock:
+            stats = self._stats.get(url)
+            if stats is None:
+                return
+            stats.failures += 1
+            stats.last_error = str(error)
+            factor = min(2 ** (stats.failures - 1), MAX_COOLDOWN_FACTOR)
+            stats.unhealthy_until = time.monotonic() + self.failure_cooldown * factor
+        logger.warning(f"加速地址 {url} 暂停使用 {self.failure_cooldown * factor:.0f} 秒: {error}")
+
+    # 选择
+
+    def order(self) -> List[str]:
+        """按优先级排列的全部地址：健康的按预计下载时间从快到慢，冷却中的按恢复时间排在最后"""
+        now = time.monotonic()
+        with self._lock:
+            stats = list(self._stats.values())
+        healthy = sorted((s for s in stats if s.healthy(now)), key=lambda s: (s.expected_seconds(), s.upstream))
+        cooling = sorted((s for s in stats if not s.healthy(now)), key=lambda s: s.unhealthy_until)
+        return [s.url for s in healthy + cooling]
+
+    def stats(self) -> List[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            stats = list(self._stats.values())
+        return [s.info(now) for s in stats]
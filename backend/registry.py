@@ -0,0 +1,673 @@
+"""Docker Registry HTTP API v2 客户端
+
+不经过 dockerd，直接从镜像仓库获取清单、配置和层数据，并生成 docker load 兼容的 tar 流。
+层数据并行下载，支持 HTTP Range 断点续传与摘要校验。配置了加速地址时按 MirrorManager 的排序依次尝试，
+单个层下载失败或过慢时从下一个地址续传（层按摘要寻址，不同地址下载的部分可以拼接）。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import tarfile
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from coordination import file_lock
+from delta import DELTA_MANIFEST, delta_manifest
+from layer_cache import LayerCache
+from mirrors import PROBE_BYTES, MirrorManager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REGISTRY = "docker.io"
+DEFAULT_REGISTRY_HOST = "registry-1.docker.io"
+
+MEDIA_TYPE_MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+MEDIA_TYPE_MANIFEST_LIST = "application/vnd.docker.distribution.manifest.list.v2+json"
+MEDIA_TYPE_OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+MEDIA_TYPE_OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+MANIFEST_ACCEPT = ", ".join([
+    MEDIA_TYPE_MANIFEST_V2,
+    MEDIA_TYPE_MANIFEST_LIST,
+    MEDIA_TYPE_OCI_MANIFEST,
+    MEDIA_TYPE_OCI_INDEX,
+])
+
+# 写入 tar 时使用的块大小
+CHUNK_SIZE = 1024 * 1024
+# 下载时每次读取的块大小，连接中断时最多丢失一个块，其余部分可以续传
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+# 超过此时长未更新的任务 blob 目录视为进程中断遗留，启动时删除
+STALE_JOB_BLOBS_SECONDS = 24 * 3600
+
+ProgressCallback = Callable[[Dict], None]
+
+
+class RegistryError(Exception):
+    """镜像仓库访问或数据校验失败"""
+
+
+class MirrorStalled(RegistryError):
+    """下载速度持续低于下限，已下载的部分保留，可以换一个地址续传"""
+
+
+class ImageReference:
+    """解析后的镜像引用，例如 nginx:1.25 -> docker.io/library/nginx:1.25"""
+
+    def __init__(self, registry: str, repository: str, tag: Optional[str] = None, digest: Optional[str] = None):
+        self.registry = registry
+        self.repository = repository
+        self.tag = tag
+        self.digest = digest
+
+    @property
+    def reference(self) -> str:
+        """用于请求清单的 tag 或 digest"""
+        return self.digest or self.tag
+
+    @property
+    def repo_tag(self) -> Optional[str]:
+        """写入 manifest.json RepoTags 的名称，与 docker save 的命名方式一致"""
+        if not self.tag:
+            return None
+        name = self.repository
+        if self.registry == DEFAULT_REGISTRY:
+            if name.startswith("library/"):
+                name = name[len("library/"):]
+        else:
+            name = f"{self.registry}/{name}"
+        return f"{name}:{self.tag}"
+
+    def __str__(self):
+        suffix = f"@{self.digest}" if self.digest else f":{self.tag}"
+        return f"{self.registry}/{self.repository}{suffix}"
+
+
+def parse_image_reference(image_name: str) -> ImageReference:
+    """按 docker 的规则解析镜像名称"""
+    name = image_name.strip()
+    digest = None
+    if "@" in name:
+        name, digest = name.split("@", 1)
+
+    registry = DEFAULT_REGISTRY
+    parts = name.split("/", 1)
+    if len(parts) == 2 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        registry, name = parts
+
+    tag = None
+    last = name.rsplit("/", 1)[-1]
+    if ":" in last:
+        name, tag = name.rsplit(":", 1)
+    if not tag and not digest:
+        tag = "latest"
+
+    if registry == DEFAULT_REGISTRY and "/" not in name:
+        name = f"library/{name}"
+    if not re.fullmatch(r"[a-z0-9]+(?:[._\-/][a-z0-9]+)*", name):
+        raise RegistryError(f"无效的镜像名称: {image_name}")
+    return ImageReference(registry, name, tag, digest)
+
+
+def _digest_hex(digest: str) -> str:
+    algorithm, _, value = digest.partition(":")
+    if algorithm != "sha256" or not re.fullmatch(r"[0-9a-f]{64}", value):
+        raise RegistryError(f"不支持的摘要格式: {digest}")
+    return value
+
+
+class RegistryClient:
+    """Registry v2 API 的最小客户端，处理 Bearer/Basic 认证"""
+
+    def __init__(self, registry: str, insecure: bool = False, proxies: Optional[Dict] = None,
+                 timeout: int = 60, username: Optional[str] = None, password: Optional[str] = None,
+                 endpoint: Optional[str] = None):
+        """endpoint 为加速地址（如 https://mirror.example.com）时请求发往该地址，而不是 registry 本身"""
+        if endpoint:
+            self.base_url = f"{endpoint.rstrip('/')}/v2"
+        else:
+            host = DEFAULT_REGISTRY_HOST if registry == DEFAULT_REGISTRY else registry
+            scheme = "http" if insecure else "https"
+            self.base_url = f"{scheme}://{host}/v2"
+        self.timeout = timeout
+        self.auth = (username, password) if username else None
+        self.session = requests.Session()
+        self.session.trust_env = False
+        if proxies:
+            self.session.proxies.update(proxies)
+        self._tokens: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _fetch_token(self, challenge: str, scope: str) -> Optional[str]:
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm", None)
+        if not realm:
+            raise RegistryError(f"无法解析认证质询: {challenge}")
+        params.setdefault("scope", scope)
+        response = self.session.get(realm, params=params, auth=self.auth, timeout=self.timeout)
+        if response.status_code != 200:
+            raise RegistryError(f"获取仓库访问令牌失败: HTTP {response.status_code}")
+        body = response.json()
+        return body.get("token") or body.get("access_token")
+
+    def request(self, method: str, path: str, scope: str, **kwargs) -> requests.Response:
+        """发送请求，遇到 401 时按质询获取令牌后重试一次"""
+        url = f"{self.base_url}{path}"
+        headers = kwargs.pop("headers", {})
+        timeout = kwargs.pop("timeout", self.timeout)
+        for attempt in range(2):
+            with self._lock:
+                token = self._tokens.get(scope)
+            request_headers = dict(headers)
+            auth = None
+            if token == "basic":
+                auth = self.auth
+            elif token:
+                request_headers["Authorization"] = f"Bearer {token}"
+            response = self.session.request(method, url, headers=request_headers, auth=auth,
+                                            timeout=timeout, **kwargs)
+            if response.status_code != 401 or attempt == 1:
+                return response
+            challenge = response.headers.get("WWW-Authenticate", "")
+            response.close()
+            if challenge.lower().startswith("bearer"):
+                token = self._fetch_token(challenge, scope)
+            elif challenge.lower().startswith("basic") and self.auth:
+                token = "basic"
+            else:
+                return response
+            with self._lock:
+                self._tokens[scope] = token
+        return response
+
+    def get_manifest(self, repository: str, reference: str, platform: str = "linux/amd64") -> Tuple[Dict, str]:
+        """获取镜像清单，遇到多架构清单时按 platform 选择，返回 (manifest, digest)"""
+        scope = f"repository:{repository}:pull"
+        response = self.request("GET", f"/{repository}/manifests/{reference}", scope,
+                                headers={"Accept": MANIFEST_ACCEPT})
+        if response.status_code == 404:
+            raise RegistryError(f"镜像不存在: {repository}:{reference}")
+        if response.status_code != 200:
+            raise RegistryError(f"获取镜像清单失败: HTTP {response.status_code}")
+        manifest = response.json()
+        digest = response.headers.get("Docker-Content-Digest") or "sha256:" + hashlib.sha256(response.content).hexdigest()
+
+        media_type = manifest.get("mediaType") or response.headers.get("Content-Type", "").split(";")[0]
+        if media_type in (MEDIA_TYPE_MANIFEST_LIST, MEDIA_TYPE_OCI_INDEX) or "manifests" in manifest:
+            os_name, _, arch = platform.partition("/")
+            arch, _, variant = arch.partition("/")
+            for entry in manifest.get("manifests", []):
+                entry_platform = entry.get("platform", {})
+                if entry_platform.get("os") != os_name or entry_platform.get("architecture") != arch:
+                    continue
+                if variant and entry_platform.get("variant") != variant:
+                    continue
+                return self.get_manifest(repository, entry["digest"], platform)
+            raise RegistryError(f"镜像不支持平台 {platform}")
+
+        if manifest.get("schemaVersion") != 2 or "config" not in manifest:
+            raise RegistryError(f"不支持的镜像清单格式: {media_type or manifest.get('schemaVersion')}")
+        return manifest, digest
+
+    def get_blob(self, repository: str, digest: str) -> bytes:
+        """读取较小的 blob（如镜像配置）并校验摘要"""
+        response = self.request("GET", f"/{repository}/blobs/{digest}", f"repository:{repository}:pull")
+        if response.status_code != 200:
+            raise RegistryError(f"获取 {digest} 失败: HTTP {response.status_code}")
+        if hashlib.sha256(response.content).hexdigest() != _digest_hex(digest):
+            raise RegistryError(f"{digest} 摘要校验失败")
+        return response.content
+
+    def probe_blob(self, repository: str, digest: str, nbytes: int = PROBE_BYTES) -> float:
+        """读取 blob 的前 nbytes 字节，返回从收到响应头到读完的吞吐量（字节/秒）"""
+        response = self.request("GET", f"/{repository}/blobs/{digest}", f"repository:{repository}:pull",
+                                headers={"Range": f"bytes=0-{nbytes - 1}"}, stream=True)
+        with response:
+            if response.status_code not in (200, 206):
+                raise RegistryError(f"获取 {digest} 失败: HTTP {response.status_code}")
+            start = time.perf_counter()
+            received = 0
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                received += len(chunk)
+                if received >= nbytes:
+                    break
+            elapsed = time.perf_counter() - start
+        return received / max(elapsed, 1e-3)
+
+    def download_blob(self, repository: str, digest: str, partial_path: str,
+                      progress: Optional[Callable[[int], None]] = None,
+                      min_throughput: float = 0, stall_window: float = 15) -> int:
+        """下载 blob 到 partial_path，已有内容通过 Range 请求续传，完成后校验摘要，返回本次下载的字节数
+
+        校验通过后文件保留在 partial_path，由调用方移动到最终位置。
+        min_throughput 大于 0 时，任意 stall_window 秒内的平均速度低于该值（字节/秒）即抛出 MirrorStalled，
+        读超时也缩短为 stall_window 秒，已下载的部分保留用于续传。
+        """
+        expected = _digest_hex(digest)
+        hasher = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial_path):
+            with open(partial_path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+                    offset += len(chunk)
+
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        timeout = (self.timeout, stall_window) if min_throughput else self.timeout
+        response = self.request("GET", f"/{repository}/blobs/{digest}", f"repository:{repository}:pull",
+                                headers=headers, stream=True, timeout=timeout)
+        downloaded = 0
+        with response:
+            if response.status_code == 416 and offset:
+                # 已经下载完整，直接校验
+                pass
+            elif response.status_code == 200 and offset:
+                # 服务端不支持 Range，从头开始
+                hasher = hashlib.sha256()
+                offset = 0
+            elif response.status_code not in (200, 206):
+                raise RegistryError(f"下载 {digest} 失败: HTTP {response.status_code}")
+
+            if response.status_code in (200, 206):
+                if progress:
+                    progress(offset)
+                window_start = time.monotonic()
+                window_bytes = 0
+                with open(partial_path, "ab" if offset else "wb") as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        offset += len(chunk)
+                        downloaded += len(chunk)
+                        if progress:
+                            progress(offset)
+                        if min_throughput:
+                            window_bytes += len(chunk)
+                            elapsed = time.monotonic() - window_start
+                            if elapsed >= stall_window:
+                                if window_bytes / elapsed < min_throughput:
+                                    raise MirrorStalled(f"下载速度 {window_bytes / elapsed / 1024:.0f}KB/s 低于下限")
+                                window_start = time.monotonic()
+                                window_bytes = 0
+
+        if hasher.hexdigest() != expected:
+            os.unlink(partial_path)
+            raise RegistryError(f"{digest} 摘要校验失败")
+        return downloaded
+
+
+def remove_stale_job_blobs(blob_dir: str, max_age: float = STALE_JOB_BLOBS_SECONDS) -> int:
+    """删除中断的任务留下的 blob 硬链接目录，返回删除的目录数"""
+    jobs_dir = os.path.join(blob_dir, "jobs")
+    removed = 0
+    try:
+        names = os.listdir(jobs_dir)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        path = os.path.join(jobs_dir, name)
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+class RegistryPuller:
+    """直接从镜像仓库拉取一个镜像的全部 blob，并生成 docker load 兼容的 tar 流
+
+    进度以 Docker pull 事件的格式回调（id/status/progressDetail），可以直接交给进度跟踪器。
+    提供 cache 时层 blob 保存在共享的层缓存中，已缓存的层不再下载。
+    不使用层缓存时 blob 下载到 blob_dir（多个任务共享，相同的层只下载一次），每个拉取器在
+    blob_dir/jobs/<随机 ID>/ 下为用到的 blob 建立硬链接并从中读取，其他任务删除共享的 blob 不影响本任务。
+    提供 mirrors 且镜像属于其服务的仓库时，清单与层从最快的健康地址获取，失败时依次尝试其他地址。
+    """
+
+    def __init__(self, image_name: str, blob_dir: str, max_workers: int = 4, retries: int = 3,
+                 platform: str = "linux/amd64", insecure_hosts: Optional[List[str]] = None,
+                 proxies: Optional[Dict] = None, timeout: int = 60,
+                 username: Optional[str] = None, password: Optional[str] = None,
+                 cache: Optional[LayerCache] = None, mirrors: Optional[MirrorManager] = None):
+        self.image_name = image_name
+        self.ref = parse_image_reference(image_name)
+        self.blob_dir = blob_dir
+        self.job_blob_dir = os.path.join(blob_dir, "jobs", uuid.uuid4().hex)
+        self.cache = cache
+        self._pins = ExitStack()
+        self.max_workers = max_workers
+        self.retries = retries
+        self.platform = platform
+        host = self.ref.registry.split(":")[0]
+        insecure = host in ("localhost", "127.0.0.1") or self.ref.registry in (insecure_hosts or [])
+        self.client = RegistryClient(self.ref.registry, insecure=insecure, proxies=proxies,
+                                     timeout=timeout, username=username, password=password)
+        self.mirrors = mirrors if mirrors and mirrors.applies_to(self.ref.registry) else None
+        self._proxies = proxies
+        self._timeout = timeout
+        # 各加速地址的客户端（令牌按地址分别缓存），认证信息只发送给镜像仓库本身
+        self._clients: Dict[str, RegistryClient] = {}
+        self._clients_lock = threading.Lock()
+        self.manifest: Optional[Dict] = None
+        self.manifest_digest: Optional[str] = None
+        self.config: Optional[bytes] = None
+        self.layers: List[Dict] = []
+        # 增量导出：基础镜像中已有的层（diff_id）不下载也不写入归档
+        self.delta_base: Optional[Dict] = None
+        self.base_diff_ids: set = set()
+
+    @staticmethod
+    def cache_key(digest: str) -> str:
+        return f"blobs/{_digest_hex(digest)}"
+
+    def blob_path(self, digest: str) -> str:
+        """导出时读取的 blob 路径"""
+        if self.cache:
+            return self.cache.path(self.cache_key(digest))
+        return os.path.join(self.job_blob_dir, _digest_hex(digest))
+
+    def shared_blob_path(self, digest: str) -> str:
+        """不使用层缓存时多个任务共享的 blob 路径"""
+        return os.path.join(self.blob_dir, _digest_hex(digest))
+
+    def _hold(self, digest: str) -> bool:
+        """为共享的 blob 建立本任务的硬链接，共享的 blob 已不存在时返回 False"""
+        try:
+            os.link(self.shared_blob_path(digest), self.blob_path(digest))
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _client_for(self, endpoint: str) -> RegistryClient:
+        if endpoint == self.mirrors.upstream:
+            return self.client
+        with self._clients_lock:
+            if endpoint not in self._clients:
+                self._clients[endpoint] = RegistryClient(self.ref.registry, proxies=self._proxies,
+                                                         timeout=self._timeout, endpoint=endpoint)
+            return self._clients[endpoint]
+
+    def sources(self) -> List[Tuple[Optional[str], RegistryClient]]:
+        """按优先级排列的 (地址, 客户端)；不使用加速地址时只有镜像仓库本身，地址为 None"""
+        if not self.mirrors:
+            return [(None, self.client)]
+        return [(endpoint, self._client_for(endpoint)) for endpoint in self.mirrors.order()]
+
+    def resolve(self) -> None:
+        """获取清单与配置，不下载层；重复调用不会重复请求"""
+        if self.manifest is not None:
+            return
+        if self.mirrors:
+            self.mirrors.refresh_latency()
+        last_error: Optional[Exception] = None
+        for endpoint, client in self.sources():
+            try:
+                manifest, manifest_digest = client.get_manifest(self.ref.repository, self.ref.reference, self.platform)
+                config = client.get_blob(self.ref.repository, manifest["config"]["digest"])
+            except (requests.RequestException, RegistryError) as e:
+                last_error = e
+                if endpoint is None:
+                    raise
+                if isinstance(e, requests.RequestException):
+                    self.mirrors.record_failure(endpoint, e)
+                logger.warning(f"{self.ref}: 从 {endpoint} 获取清单失败，尝试下一个地址: {e}")
+                continue
+            self.manifest, self.manifest_digest, self.config = manifest, manifest_digest, config
+            break
+        else:
+            raise last_error
+        self.layers = self.manifest.get("layers", [])
+        logger.info(f"{self.ref}: 清单 {self.manifest_digest}，共 {len(self.layers)} 层")
+
+    def set_delta_base(self, base: Dict, base_diff_ids) -> None:
+        """设置增量导出的基础镜像身份与其已有的层"""
+        self.delta_base = base
+        self.base_diff_ids = set(base_diff_ids)
+
+    def diff_ids(self) -> List[str]:
+        """与 self.layers 一一对应的未压缩层摘要"""
+        return json.loads(self.config).get("rootfs", {}).get("diff_ids", [])
+
+    def identity(self) -> Dict:
+        """镜像身份：镜像 ID（配置摘要，与 docker image inspect 的 Id 相同）、仓库摘要与层的 diff_id"""
+        self.resolve()
+        return {
+            "image_id": self.manifest["config"]["digest"],
+            "repo_digests": [f"{self.ref.repository}@{self.manifest_digest}"],
+            "layers": self.diff_ids(),
+        }
+
+    def pull(self, progress_callback: Optional[ProgressCallback] = None) -> None:
+        """获取清单与配置，并行下载所有层"""
+        emit = progress_callback or (lambda event: None)
+        if not self.cache:
+            os.makedirs(self.job_blob_dir, exist_ok=True)
+
+        self.resolve()
+
+        layers = [layer for layer, diff_id in zip(self.layers, self.diff_ids()) if diff_id not in self.base_diff_ids]
+        unique_layers = list({layer["digest"]: layer for layer in layers}.values())
+        if self.cache:
+            # 固定本镜像的所有层，直到导出结束，避免被其他任务触发的淘汰删除
+            self._pins.enter_context(self.cache.pinned(self.cache_key(layer["digest"]) for layer in unique_layers))
+        for layer in unique_layers:
+            emit({"id": _digest_hex(layer["digest"])[:12], "status": "Pulling fs layer"})
+        if self.mirrors and unique_layers:
+            # 用最大的层探测各地址的吞吐量（结果缓存，过期前不再探测）
+            sample = max(unique_layers, key=lambda layer: layer.get("size") or 0)
+            if (sample.get("size") or 0) >= PROBE_BYTES:
+                self.mirrors.refresh_throughput(
+                    lambda endpoint: self._client_for(endpoint).probe_blob(self.ref.repository, sample["digest"]))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="registry-blob") as executor:
+            futures = [executor.submit(self._download_layer, layer, emit) for layer in unique_layers]
+            for future in futures:
+                future.result()
+
+    def _download_layer(self, layer: Dict, emit: ProgressCallback) -> None:
+        digest = layer["digest"]
+        layer_id = _digest_hex(digest)[:12]
+        total = layer.get("size") or 0
+        if self.cache:
+            key = self.cache_key(digest)
+            if self.cache.lookup(key):
+                emit({"id": layer_id, "status": "Already exists"})
+                return
+            partial_path = self.cache.partial_path(key)
+        else:
+            dest_path = self.shared_blob_path(digest)
+            if self._hold(digest):
+                emit({"id": layer_id, "status": "Already exists"})
+                return
+            partial_path = dest_path + ".partial"
+
+        last_emit = 0.0
+
+        def progress(current: int):
+            nonlocal last_emit
+            now = time.monotonic()
+            if now - last_emit >= 0.2 or current >= total:
+                last_emit = now
+                emit({"id": layer_id, "status": "Downloading",
+                      "progressDetail": {"current": current, "total": total}})
+
+        # 同一个 blob 只能有一个下载者（包括其他 worker 进程），等待锁期间对方可能已下载完成。
+        # 锁文件不删除：持有锁时删除会让后来者在同一路径上创建新文件并同时获得"排他"锁
+        lock_path = partial_path + ".lock"
+        with file_lock(lock_path):
+            # 锁外已经计过一次未命中，这里只是再次检查
+            if self.cache.lookup(key, record=False) if self.cache else self._hold(digest):
+                emit({"id": layer_id, "status": "Already exists"})
+                return
+
+            self._download_with_failover(digest, layer_id, partial_path, progress)
+
+            emit({"id": layer_id, "status": "Verifying Checksum"})
+            if self.cache:
+                self.cache.commit(key, partial_path)
+            else:
+                os.replace(partial_path, dest_path)
+                if not self._hold(digest):
+                    raise RegistryError(f"层 {layer_id} 下载后被删除")
+        emit({"id": layer_id, "status": "Download complete"})
+        emit({"id": layer_id, "status": "Pull complete"})
+
+    def _download_with_failover(self, digest: str, layer_id: str, partial_path: str,
+                                progress: Callable[[int], None]) -> None:
+        """按地址优先级下载一个层，失败或过慢时从下一个地址续传；每个地址最多尝试 retries 次
+
+        有多个地址时启用速度下限，最后一轮尝试不限速度，避免所有地址都慢时无法完成下载。
+        """
+        sources = self.sources()
+        attempts = self.retries * len(sources)
+        for attempt in range(1, attempts + 1):
+            endpoint, client = sources[(attempt - 1) % len(sources)]
+            final_round = attempt > attempts - len(sources)
+            min_throughput = self.mirrors.min_throughput if self.mirrors and not final_round else 0
+            stall_window = self.mirrors.stall_window if self.mirrors else 0
+            start = time.monotonic()
+            try:
+                downloaded = client.download_blob(self.ref.repository, digest, partial_path, progress,
+                                                  min_throughput=min_throughput, stall_window=stall_window)
+            except (requests.RequestException, RegistryError) as e:
+                if endpoint is not None:
+                    self.mirrors.record_failure(endpoint, e)
+                if attempt == attempts:
+                    raise RegistryError(f"层 {layer_id} 下载失败: {e}")
+                if len(sources) > 1:
+                    next_endpoint = sources[attempt % len(sources)][0]
+                    logger.warning(f"层 {layer_id} 从 {endpoint} 下载失败，切换到 {next_endpoint} 续传: {e}")
+                else:
+                    logger.warning(f"层 {layer_id} 下载中断（第 {attempt} 次），准备续传: {e}")
+                if attempt % len(sources) == 0:
+                    # 所有地址都试过一轮后再退避
+                    time.sleep(min(2 ** (attempt // len(sources)), 10))
+                continue
+            if endpoint is not None:
+                self.mirrors.record_download(endpoint, downloaded, time.monotonic() - start)
+            return
+
+    def _tar_members(self) -> List[Tuple[str, Optional[bytes], Optional[str], int]]:
+        if self.delta_base is not None:
+            return bundle_tar_members([self], exclude_diff_ids=self.base_diff_ids, delta_base=self.delta_base)
+        return bundle_tar_members([self])
+
+    def tar_size(self) -> int:
+        """docker load 兼容 tar 的总字节数"""
+        return tar_members_size(self._tar_members())
+
+    def iter_tar(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """以流的方式生成 docker load 兼容的 tar，层数据按原样（压缩格式）写入"""
+        return iter_tar_members(self._tar_members(), chunk_size)
+
+    def release(self, success: bool = True) -> None:
+        """导出结束后释放层：使用层缓存时解除固定；否则删除本任务的硬链接，
+        导出成功时再删除没有其他任务链接的共享 blob"""
+        self._pins.close()
+        if self.cache:
+            return
+        shutil.rmtree(self.job_blob_dir, ignore_errors=True)
+        if not success:
+            # 失败时保留已下载的层，下次重试可以续传
+            return
+        for layer in self.layers:
+            shared_path = self.shared_blob_path(layer["digest"])
+            try:
+                # 链接数为 1 表示没有其他任务在使用；此后新建链接的任务已持有数据，删除共享路径只会让之后的任务重新下载
+                if os.stat(shared_path).st_nlink == 1:
+                    os.unlink(shared_path)
+            except FileNotFoundError:
+                pass
+
+
+def bundle_tar_members(pullers: List[RegistryPuller], exclude_diff_ids=None,
+                       delta_base: Optional[Dict] = None) -> List[Tuple[str, Optional[bytes], Optional[str], int]]:
+    """多个已拉取镜像组成的 docker load 兼容 tar 的成员列表
+
+    返回 (成员名, 内存数据, 文件路径, 大小) 列表，目录成员的大小为 -1。
+    相同的配置与层只写入一次；同一镜像以多个标签出现时合并为一条 manifest 记录，RepoTags 列出全部标签。
+    指定 exclude_diff_ids 时生成增量归档：这些层只出现在 manifest 中，省略的层记录在 delta.json 里。
+    """
+    members = []
+    entries: Dict[str, Dict] = {}
+    written = set()
+    omitted: Dict[str, str] = {}
+    for puller in pullers:
+        config_name = f"{_digest_hex(puller.manifest['config']['digest'])}.json"
+        repo_tag = puller.ref.repo_tag
+        if config_name in entries:
+            if repo_tag and repo_tag not in entries[config_name]["RepoTags"]:
+                entries[config_name]["RepoTags"].append(repo_tag)
+            continue
+        members.append((config_name, puller.config, None, len(puller.config)))
+        layer_names = []
+        for layer, diff_id in zip(puller.layers, puller.diff_ids()):
+            layer_hex = _digest_hex(layer["digest"])
+            layer_name = f"{layer_hex}/layer.tar"
+            layer_names.append(layer_name)
+            if exclude_diff_ids is not None and diff_id in exclude_diff_ids:
+                omitted[layer_name] = diff_id
+                continue
+            if layer_hex in written:
+                continue
+            written.add(layer_hex)
+            path = puller.blob_path(layer["digest"])
+            members.append((f"{layer_hex}/", None, None, -1))
+            members.append((layer_name, None, path, os.path.getsize(path)))
+        entries[config_name] = {"Config": config_name, "RepoTags": [repo_tag] if repo_tag else [], "Layers": layer_names}
+
+    manifest = json.dumps(list(entries.values())).encode()
+    members.append(("manifest.json", manifest, None, len(manifest)))
+    if exclude_diff_ids is not None:
+        delta = delta_manifest(delta_base or {}, omitted)
+        members.append((DELTA_MANIFEST, delta, None, len(delta)))
+    return members
+
+
+def tar_members_size(members: List[Tuple[str, Optional[bytes], Optional[str], int]]) -> int:
+    """由成员列表生成的 tar 的总字节数"""
+    total = 2 * TAR_BLOCK_SIZE  # 结束标记
+    for _, _, _, size in members:
+        total += TAR_BLOCK_SIZE
+        if size > 0:
+            total += -(-size // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE
+    return total
+
+
+def iter_tar_members(members: List[Tuple[str, Optional[bytes], Optional[str], int]],
+                     chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """按成员列表以流的方式生成 tar"""
+    mtime = int(time.time())
+    for name, data, path, size in members:
+        info = tarfile.TarInfo(name)
+        info.mtime = mtime
+        if size < 0:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            yield info.tobuf(format=tarfile.USTAR_FORMAT)
+            continue
+        info.size = size
+        info.mode = 0o644
+        yield info.tobuf(format=tarfile.USTAR_FORMAT)
+        if data is not None:
+            yield data
+        else:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    yield chunk
+        remainder = size % TAR_BLOCK_SIZE
+        if remainder:
+            yield b"\0" * (TAR_BLOCK_SIZE - remainder)
+    yield b"\0" * (2 * TAR_BLOCK_SIZE)
@@ -0,0 +1,119 @@
+"""有界的任务调度器
+
+提交的任务进入优先级队列（优先级高的先执行，同优先级按提交顺序），由固定数量的工作协程执行。
+任务内部的各阶段（拉取、导出、压缩）再通过 stage 获取各自的并发槽位，
+突发提交时同时运行的 docker save 与压缩进程数量有上限，不会互相争抢磁盘与 CPU。
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class JobScheduler:
+    """任务调度器
+
+    submit 在事件循环中调用；start 必须在事件循环启动后调用，创建工作协程与各阶段的信号量。
+    on_queue_change(positions) 在排队顺序变化时被调用，positions 为 {任务 ID: 从 1 开始的排队位置}。
+    """
+
+    def __init__(self, workers: int, stage_limits: Dict[str, int],
+                 on_queue_change: Optional[Callable[[Dict[str, int]], None]] = None):
+        self.workers = max(1, workers)
+        # 阶段并发上限，0 表示不限制
+        self.stage_limits = dict(stage_limits)
+        self.on_queue_change = on_queue_change
+        self.running: Dict[str, asyncio.Task] = {}
+        self._queue: List[tuple] = []
+        self._counter = itertools.count()
+        self._pending: Optional[asyncio.Semaphore] = None
+        self._stages: Dict[str, asyncio.Semaphore] = {}
+        self._stage_active: Counter = Counter()
+        self._stage_waiting: Counter = Counter()
+        self._worker_tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if self._worker_tasks:
+            return
+        self._pending = asyncio.Semaphore(len(self._queue))
+        self._stages = {name: asyncio.Semaphore(limit) for name, limit in self.stage_limits.items() if limit > 0}
+        self._worker_tasks = [asyncio.create_task(self._worker(index)) for index in range(self.workers)]
+        logger.info(f"任务调度器: {self.workers} 个工作协程，阶段并发上限 {self.stage_limits}")
+
+    def submit(self, job_id: str, run: Callable[[], Awaitable], priority: int = 0) -> int:
+        """提交任务，返回排队位置"""
+        heapq.heappush(self._queue, (-priority, next(self._counter), job_id, run))
+        positions = self._notify_queue_change()
+        if self._pending is not None:
+            self._pending.release()
+        return positions.get(job_id, 0)
+
+    def positions(self) -> Dict[str, int]:
+        return {item[2]: index + 1 for index, item in enumerate(sorted(self._queue))}
+
+    def _notify_queue_change(self) -> Dict[str, int]:
+        positions = self.positions()
+        if self.on_queue_change:
+            try:
+                self.on_queue_change(positions)
+            except Exception as e:
+                logger.error(f"更新排队位置失败: {e}")
+        return positions
+
+    async def _worker(self, index: int):
+        while True:
+            await self._pending.acquire()
+            _, _, job_id, run = heapq.heappop(self._queue)
+            self._notify_queue_change()
+            task = asyncio.create_task(run())
+            self.running[job_id] = task
+            try:
+                # 任务自身的异常或取消不影响工作协程；工作协程被取消时任务一并取消
+                await asyncio.gather(task, return_exceptions=True)
+            finally:
+                self.running.pop(job_id, None)
+
+    @asynccontextmanager
+    async def stage(self, name: str, on_wait: Optional[Callable[[], None]] = None):
+        """获取某个阶段的并发槽位，需要等待时先调用 on_wait"""
+        semaphore = self._stages.get(name)
+        if semaphore is None:
+            yield
+            return
+        if semaphore.locked() and on_wait:
+            on_wait()
+        self._stage_waiting[name] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._stage_waiting[name] -= 1
+        self._stage_active[name] += 1
+        try:
+            yield
+        finally:
+            self._stage_active[name] -= 1
+            semaphore.release()
+
+    def stats(self) -> Dict:
+        queued = sorted(self._queue)
+        return {
+            "workers": self.workers,
+            "running": list(self.running),
+            "queued": [
+                {"job_id": job_id, "position": index + 1, "priority": -priority}
+                for index, (priority, _, job_id, _) in enumerate(queued)
+            ],
+            "stages": {
+                name: {
+                    "limit": limit,
+                    "active": self._stage_active[name],
+                    "waiting": self._stage_waiting[name],
+                }
+                for name, limit in self.stage_limits.items()
+            },
+        }
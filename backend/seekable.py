@@ -0,0 +1,306 @@
+"""可随机访问的分块压缩归档
+
+tar 流按固定大小（SEEKABLE_BLOCK_SIZE）切分为块，各块在线程池中独立压缩后按顺序写出：
+gzip 族输出为多个 gzip member 的拼接，zstd/lz4 输出为多个帧的拼接，仍是标准的压缩流，
+gzip/zstd/docker load 等现有工具可以照常读取。
+
+压缩的同时解析 tar 头，记录每个成员在未压缩 tar 中的位置；块的位置与成员列表保存在
+<归档>.index.json 中。读取单个成员时只需解压与其重叠的块，耗时与归档大小无关。
+
+gzip 族在进程内用 zlib 压缩（zlib 压缩时释放 GIL，线程之间可以并行），其他编解码器对每个块
+调用一次单线程的外部压缩工具。没有索引的未压缩 tar 同样可以列出与读取成员（按 tar 头跳读）。
+"""
+import bisect
+import io
+import json
+import logging
+import os
+import subprocess
+import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from checksum import ChecksumWriter
+from compression import (
+    CODECS, COMPRESSION_THREADS, COMPRESSION_TIMEOUT, DOCKER_SAVE_TIMEOUT, SAVE_CHUNK_SIZE, Codec, detect_codec,
+    iter_with_bounded_buffer
+)
+from metrics import StageTimings, timed_writer
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 1
+# 每个独立压缩块的未压缩大小；块越小随机读取越快，压缩比越低
+SEEKABLE_BLOCK_SIZE = int(os.getenv("SEEKABLE_BLOCK_SIZE", str(4 * 1024 * 1024)))
+# 同时压缩的块数（0 表示使用 COMPRESSION_THREADS）
+SEEKABLE_WORKERS = int(os.getenv("SEEKABLE_WORKERS", "0")) or COMPRESSION_THREADS
+
+MEMBER_TYPES = {
+    tarfile.REGTYPE: "file", tarfile.AREGTYPE: "file", tarfile.DIRTYPE: "dir",
+    tarfile.SYMTYPE: "symlink", tarfile.LNKTYPE: "link",
+}
+
+
+class ArchiveNotSeekable(Exception):
+    """归档是整体压缩的，没有成员索引，无法随机读取"""
+
+
+def index_path(archive_path: str) -> str:
+    return archive_path + INDEX_SUFFIX
+
+
+def remove_index(archive_path: str) -> None:
+    """删除归档的成员索引，覆盖或删除归档前调用"""
+    try:
+        os.remove(index_path(archive_path))
+    except FileNotFoundError:
+        pass
+
+
+def read_index(archive_path: str) -> Optional[Dict]:
+    """读取归档的成员索引，缺失或与归档大小不一致（归档已被覆盖）时返回 None"""
+    try:
+        with open(index_path(archive_path)) as f:
+            index = json.load(f)
+        if index.get("version") != INDEX_VERSION or index.get("archive_size") != os.path.getsize(archive_path):
+            return None
+        return index
+    except (OSError, ValueError):
+        return None
+
+
+# 单个块的压缩与解压
+
+def compress_block(codec: Codec, level: int, data: bytes) -> bytes:
+    if codec.family == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if codec.name == "none":
+        return data
+    result = subprocess.run(codec.build_command(level, 1), input=data, capture_output=True,
+                            check=True, timeout=COMPRESSION_TIMEOUT)
+    return result.stdout
+
+
+def decompress_block(codec: Codec, data: bytes) -> bytes:
+    if codec.family == "gzip":
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if codec.name == "none":
+        return data
+    if not codec.available():
+        raise ValueError(f"解压需要 {codec.name}")
+    result = subprocess.run(codec.decompress, input=data, capture_output=True, check=True,
+                            timeout=COMPRESSION_TIMEOUT)
+    return result.stdout
+
+
+# 写入
+
+class TapReader(io.RawIOBase):
+    """把字节块迭代器包装成只读文件对象，读出的每一块同时交给 tap"""
+
+    def __init__(self, chunks: Iterable[bytes], tap: Callable[[bytes], None]):
+        self._chunks = iter(chunks)
+        self._tap = tap
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._tap(chunk)
+            self._buffer = chunk
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def drain(self) -> None:
+        """读完剩余的数据（tar 结尾的填充块），全部交给 tap"""
+        for chunk in self._chunks:
+            self._tap(chunk)
+
+
+def member_info(member: tarfile.TarInfo) -> Dict:
+    info = {
+        "name": member.name,
+        "type": MEMBER_TYPES.get(member.type, "other"),
+        "size": member.size,
+        "offset": member.offset_data,
+        "mode": member.mode,
+        "mtime": member.mtime,
+    }
+    if member.issym() or member.islnk():
+        info["linkname"] = member.linkname
+    return info
+
+
+def write_seekable_archive(input_chunks, output_path: str, codec: Codec, level: Optional[int] = None,
+                           block_size: Optional[int] = None, workers: Optional[int] = None,
+                           progress_callback=None, checksum_algorithms: Iterable[str] = (),
+                           timings: Optional[StageTimings] = None) -> Dict[str, str]:
+    """将 tar 流分块并行压缩为可随机访问的归档，并写入成员索引，返回归档的校验和
+
+    先写入 output_path + ".tmp"，成功后重命名。最多缓存 2 * workers 个待写出的块。
+    timings 的 compress 阶段记录等待块压缩完成的时间，write 阶段记录写盘时间。
+    """
+    level = codec.resolve_level(level)
+    block_size = block_size or SEEKABLE_BLOCK_SIZE
+    workers = workers or SEEKABLE_WORKERS
+    temp_output = output_path + ".tmp"
+    chunks = iter_with_bounded_buffer(input_chunks, timeout=DOCKER_SAVE_TIMEOUT)
+    start_time = time.time()
+    frames: List[List[int]] = []
+    members: List[Dict] = []
+    pending: deque = deque()
+    buffer = bytearray()
+    position = {"compressed": 0, "uncompressed": 0, "read": 0}
+    last_report = 0.0
+
+    def report(force=False):
+        nonlocal last_report
+        now = time.time()
+        if progress_callback and (force or now - last_report >= 1):
+            last_report = now
+            progress_callback(position["read"])
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="seekable-compress") as pool, \
+                open(temp_output, "wb") as rawfile:
+            outfile = ChecksumWriter(timed_writer(rawfile, timings), checksum_algorithms)
+
+            def write_frame():
+                size, future = pending.popleft()
+                start = time.perf_counter()
+                data = future.result()
+                if timings is not None:
+                    timings.add("compress", time.perf_counter() - start, size)
+                outfile.write(data)
+                frames.append([position["compressed"], len(data), position["uncompressed"], size])
+                position["compressed"] += len(data)
+                position["uncompressed"] += size
+
+            def submit_block(data: bytes):
+                if time.time() - start_time > COMPRESSION_TIMEOUT:
+                    raise TimeoutError(f"压缩操作超时（{COMPRESSION_TIMEOUT}秒）")
+                pending.append((len(data), pool.submit(compress_block, codec, level, data)))
+                while len(pending) > 2 * workers:
+                    write_frame()
+
+            def tap(chunk: bytes):
+                buffer.extend(chunk)
+                position["read"] += len(chunk)
+                while len(buffer) >= block_size:
+                    submit_block(bytes(buffer[:block_size]))
+                    del buffer[:block_size]
+                report()
+
+            reader = TapReader(chunks, tap)
+            for member in tarfile.open(fileobj=io.BufferedReader(reader, buffer_size=SAVE_CHUNK_SIZE), mode="r|"):
+                members.append(member_info(member))
+            reader.drain()
+            if buffer:
+                submit_block(bytes(buffer))
+            while pending:
+                write_frame()
+
+        report(force=True)
+        os.rename(temp_output, output_path)
+        index = {
+            "version": INDEX_VERSION,
+            "codec": codec.name,
+            "block_size": block_size,
+            "archive_size": os.path.getsize(output_path),
+            "tar_size": position["uncompressed"],
+            # [压缩后偏移, 压缩后大小, 未压缩偏移, 未压缩大小]
+            "frames": frames,
+            "members": members,
+        }
+        temp_index = index_path(output_path) + ".tmp"
+        with open(temp_index, "w") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(temp_index, index_path(output_path))
+        logger.info(f"分块压缩完成: {os.path.basename(output_path)}，{len(frames)} 个块，{len(members)} 个成员")
+        return outfile.hexdigests()
+    except Exception:
+        for path in (temp_output, index_path(output_path)):
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+    finally:
+        chunks.close()
+
+
+# 读取
+
+def _scan_plain_tar(archive_path: str) -> List[Dict]:
+    """未压缩的 tar 按 tar 头跳读，不读取成员内容"""
+    with tarfile.open(archive_path, mode="r:") as tar:
+        return [member_info(member) for member in tar]
+
+
+def list_members(archive_path: str) -> Tuple[List[Dict], bool]:
+    """列出归档中的成员，返回 (成员列表, 是否有索引)；整体压缩的归档抛出 ArchiveNotSeekable"""
+    index = read_index(archive_path)
+    if index is not None:
+        return index["members"], True
+    if detect_codec(archive_path).name == "none":
+        try:
+            return _scan_plain_tar(archive_path), False
+        except tarfile.TarError as e:
+            raise ArchiveNotSeekable(f"无法解析归档: {e}")
+    raise ArchiveNotSeekable("归档是整体压缩的，没有成员索引")
+
+
+def iter_member(archive_path: str, name: str, chunk_size: int = SAVE_CHUNK_SIZE) -> Tuple[Dict, Iterator[bytes]]:
+    """定位归档中的成员，返回 (成员信息, 内容迭代器)；成员不存在或不是普通文件时抛出 KeyError"""
+    index = read_index(archive_path)
+    members = index["members"] if index is not None else list_members(archive_path)[0]
+    member = next((item for item in members if item["name"] == name), None)
+    if member is None or member["type"] != "file":
+        raise KeyError(name)
+    if index is None:
+        return member, _iter_plain_range(archive_path, member["offset"], member["size"], chunk_size)
+    return member, _iter_indexed_range(archive_path, index, member["offset"], member["size"])
+
+
+def _iter_plain_range(archive_path: str, offset: int, size: int, chunk_size: int) -> Iterator[bytes]:
+    with open(archive_path, "rb") as f:
+        f.seek(offset)
+        remaining = size
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                raise ValueError("归档被截断")
+            remaining -= len(data)
+            yield data
+
+
+def _iter_indexed_range(archive_path: str, index: Dict, offset: int, size: int) -> Iterator[bytes]:
+    """只解压与未压缩区间 [offset, offset + size) 重叠的块"""
+    codec = CODECS[index["codec"]]
+    frames = index["frames"]
+    starts = [frame[2] for frame in frames]
+    position = bisect.bisect_right(starts, offset) - 1
+    end = offset + size
+    with open(archive_path, "rb") as f:
+        while offset < end and 0 <= position < len(frames):
+            compressed_offset, compressed_size, frame_start, frame_size = frames[position]
+            f.seek(compressed_offset)
+            data = decompress_block(codec, f.read(compressed_size))
+            if len(data) != frame_size:
+                raise ValueError("归档内容与索引不一致")
+            piece = data[offset - frame_start:min(end, frame_start + frame_size) - frame_start]
+            offset += len(piece)
+            position += 1
+            yield piece
+    if offset < end:
+        raise ValueError("归档内容与索引不一致")
@@ -0,0 +1,357 @@
+"""下载目录的容量管理
+
+- 配额：归档总大小上限（不含层缓存，层缓存有自己的上限）
+- 剩余空间水位：剩余空间低于 min_free 时开始淘汰，直到恢复到 target_free
+- TTL：超过 ttl 秒未被下载（从未下载过的按创建时间）的归档被删除
+- LRU：空间不足时按最近一次下载时间从旧到新淘汰
+- 固定：被固定的归档不会被淘汰
+- 准入：新导出开始前按预估大小预留空间，腾不出空间时排队等待或拒绝；
+  即使淘汰全部可淘汰的归档也放不下时直接拒绝，不再排队
+
+正在写入（运行中任务的目标文件）或正在发送的归档不会被淘汰。固定列表与最近下载时间保存在
+下载目录的 .storage.json 中，重启后保留；多个 worker 进程通过文件锁合并各自的修改。
+空间预留只在进程内有效，各 worker 的导出仍共同受剩余空间水位约束。
+预留记录导出的目标文件，已写入 <目标文件>.tmp（或已完成的目标文件）的部分已经反映在剩余空间
+（与归档占用）中，只有尚未写入的部分计入预留。
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from archive_index import ArchiveIndex
+from archive_meta import meta_path
+from checksum import CHECKSUM_SUFFIXES, checksum_path
+from coordination import file_lock
+from seekable import index_path
+
+logger = logging.getLogger(__name__)
+
+
+class StorageFull(Exception):
+    """预估大小超出可用空间，且无法通过淘汰腾出"""
+
+
+def remove_archive(path: str) -> int:
+    """删除归档及其元数据、成员索引与校验和 sidecar，返回释放的字节数"""
+    freed = 0
+    sidecars = [meta_path(path), index_path(path), *(checksum_path(path, algorithm) for algorithm in CHECKSUM_SUFFIXES)]
+    for sidecar in [path, *sidecars]:
+        try:
+            freed += os.path.getsize(sidecar)
+            os.remove(sidecar)
+        except FileNotFoundError:
+            pass
+    return freed
+
+
+class StorageManager:
+    """下载目录的配额、淘汰与准入控制
+
+    quota_bytes/min_free_bytes/ttl_seconds 为 0 表示不限制；busy_paths() 返回正在写入的归档路径；
+    on_evict(path) 在归档被淘汰后调用，用于清理调用方按归档记录的状态。
+    """
+
+    def __init__(self, root: str, index: ArchiveIndex, quota_bytes: int = 0, min_free_bytes: int = 0,
+                 target_free_bytes: int = 0, ttl_seconds: float = 0,
+                 busy_paths: Optional[Callable[[], Iterable[str]]] = None,
+                 on_evict: Optional[Callable[[str], None]] = None):
+        self.root = root
+        self.index = index
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.target_free_bytes = max(target_free_bytes, min_free_bytes)
+        self.ttl_seconds = ttl_seconds
+        self.busy_paths = busy_paths or (lambda: ())
+        self.on_evict = on_evict
+        self.state_path = os.path.join(root, ".storage.json")
+        self._lock = threading.Lock()
+        self._serving: Counter = Counter()
+        # 预留 ID -> (预估大小, 目标文件路径, 预留时间)
+        self._reservations: Dict[int, Tuple[int, Optional[str], float]] = {}
+        self._next_reservation = 0
+        # 空间被释放时唤醒排队中的准入请求，事件属于第一次调用 admission 的事件循环
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._space_released: Optional[asyncio.Event] = None
+        self.evictions = 0
+        self.bytes_evicted = 0
+        self.pinned, self.last_access = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            return set(state.get("pinned", [])), dict(state.get("last_access", {}))
+        except (OSError, ValueError):
+            return set(), {}
+
+    def _sync_state(self, pin: Optional[str] = None, pinned: bool = True):
+        """与状态文件合并后写回：固定列表以文件为准（其他 worker 可能修改过）再应用本次的固定/取消固定，
+        最近下载时间取两者中较新的"""
+        with file_lock(self.state_path + ".lock"):
+            file_pinned, file_access = self._load_state()
+            with self._lock:
+                if pin is not None:
+                    if pinned:
+                        file_pinned.add(pin)
+                    else:
+                        file_pinned.discard(pin)
+                self.pinned = file_pinned
+                for name, ts in file_access.items():
+                    if ts > self.last_access.get(name, 0):
+                        self.last_access[name] = ts
+                self._save_state()
+
+    def _save_state(self):
+        """调用方持有锁；只保存仍然存在的归档"""
+        names = {entry["name"] for entry in self.index.entries()}
+        state = {
+            "pinned": sorted(name for name in self.pinned if name in names),
+            "last_access": {name: ts for name, ts in self.last_access.items() if name in names},
+        }
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_path)
+
+    # 固定与访问记录
+
+    def pin(self, path: str, pinned: bool = True) -> None:
+        self._sync_state(os.path.basename(path), pinned)
+
+    def touch(self, path: str) -> None:
+        """记录一次下载访问"""
+        with self._lock:
+            self.last_access[os.path.basename(path)] = time.time()
+        self._sync_state()
+
+    def lease(self, path: str) -> Callable[[], None]:
+        """标记归档正在发送，返回的函数在发送结束后调用"""
+        name = os.path.basename(path)
+        with self._lock:
+            self._serving[name] += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            with self._lock:
+                self._serving[name] -= 1
+                if self._serving[name] <= 0:
+                    del self._serving[name]
+        return release
+
+    # 空间统计
+
+    def used_bytes(self) -> int:
+        return sum(entry["size"] for entry in self.index.entries())
+
+    def reserved_bytes(self) -> int:
+        with self._lock:
+            return sum(size for size, _, _ in self._reservations.values())
+
+    @staticmethod
+    def _written(path: Optional[str], since: float) -> Tuple[int, int]:
+        """导出已写入的字节数：(<目标文件>.tmp 的大小, 预留之后完成的目标文件的大小)"""
+        if not path:
+            return 0, 0
+        try:
+            temp = os.path.getsize(path + ".tmp")
+        except OSError:
+            temp = 0
+        try:
+            stat = os.stat(path)
+            final = stat.st_size if stat.st_mtime >= since else 0
+        except OSError:
+            final = 0
+        return temp, final
+
+    def outstanding_bytes(self, include_temp: bool = True) -> int:
+        """各预留中尚未写入的字节数；include_temp 为 False 时 .tmp 不算已写入（归档占用不含 .tmp）"""
+        with self._lock:
+            reservations = list(self._reservations.values())
+        outstanding = 0
+        for size, path, since in reservations:
+            temp, final = self._written(path, since)
+            outstanding += max(0, size - final - (temp if include_temp else 0))
+        return outstanding
+
+    def free_bytes(self) -> int:
+        return shutil.disk_usage(self.root).free
+
+    def _policy_enabled(self) -> bool:
+        """是否配置了配额或剩余空间水位；未配置时空间不足只会让导出等待，不会淘汰归档"""
+        return bool(self.quota_bytes or self.min_free_bytes)
+
+    def _shortfall(self, needed: int) -> int:
+        """还需腾出多少字节才能再容纳 needed 字节（同时满足配额、剩余空间水位与实际剩余空间）"""
+        shortfall = 0
+        if self.quota_bytes:
+            shortfall = max(shortfall, self.used_bytes() + self.outstanding_bytes(include_temp=False) + needed
+                            - self.quota_bytes)
+        return max(shortfall, self.min_free_bytes + self.outstanding_bytes() + needed - self.free_bytes())
+
+    def capacity(self) -> int:
+        """其他导出结束、且淘汰全部可淘汰的归档后最多能容纳的字节数
+
+        固定、正在写入或发送的归档不可淘汰，其他导出完成后的归档可以淘汰；没有配置配额或水位时不淘汰归档，
+        只计入剩余空间与其他导出尚未写入的部分。
+        """
+        policy = self._policy_enabled()
+        evictable = sum(entry["size"] for entry in self._candidates()) if policy else 0
+        exporting = self.reserved_bytes() if policy else 0
+        limits = [self.free_bytes() - self.outstanding_bytes() + evictable + exporting - self.min_free_bytes]
+        if self.quota_bytes:
+            limits.append(self.quota_bytes - (self.used_bytes() - evictable))
+        return max(0, min(limits))
+
+    async def check_capacity(self, size: int) -> None:
+        """size 超过 capacity() 时抛出 StorageFull"""
+        capacity = await asyncio.get_running_loop().run_in_executor(None, self.capacity)
+        if size > capacity:
+            raise StorageFull(f"预计需要 {size / (1024 ** 3):.2f}GB，超过下载目录最多可腾出的 "
+                              f"{capacity / (1024 ** 3):.2f}GB")
+
+    def stats(self) -> Dict:
+        entries = self.index.entries()
+        with self._lock:
+            pinned = [entry["name"] for entry in entries if entry["name"] in self.pinned]
+            serving = dict(self._serving)
+            reserved = sum(size for size, _, _ in self._reservations.values())
+        return {
+            "used_bytes": sum(entry["size"] for entry in entries),
+            "archives": len(entries),
+            "quota_bytes": self.quota_bytes,
+            "free_bytes": self.free_bytes(),
+            "min_free_bytes": self.min_free_bytes,
+            "target_free_bytes": self.target_free_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "reserved_bytes": reserved,
+            "outstanding_bytes": self.outstanding_bytes(),
+            "capacity_bytes": self.capacity(),
+            "pending_exports": len(self._reservations),
+            "pinned": pinned,
+            "serving": serving,
+            "evictions": self.evictions,
+            "bytes_evicted": self.bytes_evicted,
+        }
+
+    # 淘汰
+
+    def _candidates(self) -> List[Dict]:
+        """可淘汰的归档，按最近访问时间从旧到新排列；固定、正在写入或发送的归档除外"""
+        busy = {os.path.basename(path) for path in self.busy_paths() if path}
+        with self._lock:
+            excluded = busy | self.pinned | set(self._serving)
+            candidates = [
+                dict(entry, last_used=max(self.last_access.get(entry["name"], 0), entry["created_at"]))
+                for entry in self.index.entries() if entry["name"] not in excluded
+            ]
+        return sorted(candidates, key=lambda entry: entry["last_used"])
+
+    def _evict(self, entry: Dict, reason: str) -> int:
+        freed = remove_archive(entry["path"])
+        self.index.remove(entry["path"])
+        if self.on_evict:
+            self.on_evict(entry["path"])
+        with self._lock:
+            self.last_access.pop(entry["name"], None)
+            self.evictions += 1
+            self.bytes_evicted += freed
+        logger.info(f"已淘汰归档（{reason}）: {entry['name']}，释放 {freed / (1024 * 1024):.1f}MB")
+        return freed
+
+    def sweep(self, needed: int = 0) -> List[str]:
+        """删除过期归档，再按 LRU 淘汰直到满足配额与水位（并能容纳 needed 字节），返回被删除的文件名"""
+        self.index.revalidate()
+        self._sync_state()
+        evicted = []
+        candidates = self._candidates()
+        if self.ttl_seconds:
+            expire_before = time.time() - self.ttl_seconds
+            for entry in [entry for entry in candidates if entry["last_used"] < expire_before]:
+                self._evict(entry, "超过保留期")
+                evicted.append(entry["name"])
+                candidates.remove(entry)
+
+        shortfall = self._shortfall(needed) if self._policy_enabled() else 0
+        if self.min_free_bytes and self.free_bytes() < self.min_free_bytes:
+            # 低于低水位时一直清理到高水位，避免每次导出都触发淘汰
+            shortfall = max(shortfall, self.target_free_bytes + self.outstanding_bytes() + needed - self.free_bytes())
+        for entry in candidates:
+            if shortfall <= 0:
+                break
+            shortfall -= self._evict(entry, "空间不足")
+            evicted.append(entry["name"])
+        if evicted:
+            self._sync_state()
+            self._notify_released()
+        return evicted
+
+    # 准入
+
+    def _notify_released(self):
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._space_released.set)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+
+    def try_reserve(self, size: int, path: Optional[str] = None) -> Optional[int]:
+        """按需淘汰后为写入 path 的导出预留 size 字节，空间不足时返回 None"""
+        if self._shortfall(size) > 0:
+            self.sweep(needed=size)
+            if self._shortfall(size) > 0:
+                return None
+        with self._lock:
+            self._next_reservation += 1
+            self._reservations[self._next_reservation] = (size, path, time.time())
+            return self._next_reservation
+
+    def release(self, reservation: int) -> None:
+        with self._lock:
+            self._reservations.pop(reservation, None)
+        self._notify_released()
+
+    @asynccontextmanager
+    async def admission(self, size: int, path: Optional[str] = None, wait: bool = True, timeout: float = 0,
+                        poll_interval: float = 10, on_wait: Optional[Callable[[], None]] = None):
+        """导出前预留预估大小的空间，导出结束后释放；path 为导出的目标文件，已写入的部分不再计入预留
+
+        腾不出空间时：wait 为 False 立即抛出 StorageFull；否则等待其他导出结束或空间被释放，
+        timeout 秒（0 表示不限）后仍无空间时抛出 StorageFull。size 超过 capacity() 时等待也不会有结果，直接抛出。
+        """
+        loop = asyncio.get_running_loop()
+        await self.check_capacity(size)
+        if self._loop is None:
+            self._loop = loop
+            self._space_released = asyncio.Event()
+        deadline = time.monotonic() + timeout if timeout else None
+        waited = False
+        while True:
+            reservation = await loop.run_in_executor(None, self.try_reserve, size, path)
+            if reservation is not None:
+                break
+            if not wait or (deadline and time.monotonic() >= deadline):
+                raise StorageFull(f"预计需要 {size / (1024 ** 3):.2f}GB，下载目录空间不足")
+            if not waited and on_wait:
+                on_wait()
+            waited = True
+            self._space_released.clear()
+            try:
+                await asyncio.wait_for(self._space_released.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+        try:
+            yield reservation
+        finally:
+            self.release(reservation)
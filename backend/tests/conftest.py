@@ -0,0 +1,187 @@
+"""测试公共部分：进程内的镜像仓库替身
+
+RegistryStub 用 http.server 在后台线程中实现 Registry v2 API 的一个子集：
+GET /v2/、清单（按标签或摘要）、blob（支持 Range）。可以按摘要注入故障（返回错误状态、
+内容被篡改、中途断开），并记录收到的请求，用于检查续传与地址切换。
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MEDIA_TYPE_MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+MEDIA_TYPE_MANIFEST_LIST = "application/vnd.docker.distribution.manifest.list.v2+json"
+
+
+def digest_of(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def make_layer(files: Dict[str, bytes]) -> Tuple[bytes, str]:
+    """生成 gzip 压缩的层，返回 (blob, diff_id)"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    raw = buffer.getvalue()
+    return gzip.compress(raw, mtime=0), digest_of(raw)
+
+
+class RegistryStub:
+    """进程内的镜像仓库替身"""
+
+    def __init__(self):
+        self.manifests: Dict[str, Tuple[bytes, str]] = {}
+        self.blobs: Dict[str, bytes] = {}
+        # 注入的故障：摘要 -> HTTP 状态码、"corrupt"（返回被篡改的内容）或 "truncate"（发送一半后断开连接）
+        self.faults: Dict[str, object] = {}
+        self.requests: List[Tuple[str, Optional[str]]] = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests.append((self.path, self.headers.get("Range")))
+                if self.path == "/v2/":
+                    return self._send(200, b"{}", "application/json")
+                parts = self.path.split("/")
+                if len(parts) >= 5 and parts[-2] == "manifests":
+                    repository = "/".join(parts[2:-2])
+                    manifest = stub.manifests.get(f"{repository}:{parts[-1]}") or stub.manifests.get(parts[-1])
+                    if manifest is None:
+                        return self._send(404, b"{}", "application/json")
+                    body, media_type = manifest
+                    return self._send(200, body, media_type, {"Docker-Content-Digest": digest_of(body)})
+                if len(parts) >= 5 and parts[-2] == "blobs":
+                    return self._blob(parts[-1])
+                self._send(404, b"", "text/plain")
+
+            def _blob(self, digest: str):
+                data = stub.blobs.get(digest)
+                fault = stub.faults.get(digest)
+                if data is None:
+                    return self._send(404, b"", "text/plain")
+                if isinstance(fault, int):
+                    return self._send(fault, b"", "text/plain")
+                if fault == "corrupt":
+                    data = bytes(reversed(data))
+                range_header = self.headers.get("Range")
+                if range_header:
+                    start, _, end = range_header[len("bytes="):].partition("-")
+                    start = int(start)
+                    end = int(end) if end else len(data) - 1
+                    if start >= len(data):
+                        return self._send(416, b"", "text/plain")
+                    return self._send(206, data[start:end + 1], "application/octet-stream",
+                                      {"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+                if fault == "truncate":
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data[:len(data) // 2])
+                    self.close_connection = True
+                    return
+                self._send(200, data, "application/octet-stream")
+
+            def _send(self, status: int, body: bytes, content_type: str, headers: Optional[Dict] = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    @property
+    def host(self) -> str:
+        return f"localhost:{self.server.server_address[1]}"
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}"
+
+    def add_image(self, repository: str, tag: str, layers: List[Dict[str, bytes]]) -> Dict:
+        """添加一个镜像（层为 {文件名: 内容}），返回其清单、配置与层信息"""
+        blobs = [make_layer(files) for files in layers]
+        config = json.dumps({
+            "architecture": "amd64", "os": "linux",
+            "rootfs": {"type": "layers", "diff_ids": [diff_id for _, diff_id in blobs]},
+        }).encode()
+        self.blobs[digest_of(config)] = config
+        for blob, _ in blobs:
+            self.blobs[digest_of(blob)] = blob
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": MEDIA_TYPE_MANIFEST_V2,
+            "config": {"mediaType": "application/vnd.docker.container.image.v1+json",
+                       "digest": digest_of(config), "size": len(config)},
+            "layers": [{"mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+                        "digest": digest_of(blob), "size": len(blob)} for blob, _ in blobs],
+        }
+        body = json.dumps(manifest).encode()
+        self.manifests[f"{repository}:{tag}"] = (body, MEDIA_TYPE_MANIFEST_V2)
+        self.manifests[digest_of(body)] = (body, MEDIA_TYPE_MANIFEST_V2)
+        return {"manifest": manifest, "manifest_digest": digest_of(body), "config": config,
+                "layers": [blob for blob, _ in blobs], "diff_ids": [diff_id for _, diff_id in blobs]}
+
+    def add_index(self, repository: str, tag: str, platforms: Dict[str, str]) -> None:
+        """添加多架构清单，platforms 为 {"os/arch": 清单摘要}"""
+        entries = []
+        for platform, digest in platforms.items():
+            os_name, _, arch = platform.partition("/")
+            entries.append({"mediaType": MEDIA_TYPE_MANIFEST_V2, "digest": digest,
+                            "platform": {"os": os_name, "architecture": arch}})
+        body = json.dumps({"schemaVersion": 2, "mediaType": MEDIA_TYPE_MANIFEST_LIST, "manifests": entries}).encode()
+        self.manifests[f"{repository}:{tag}"] = (body, MEDIA_TYPE_MANIFEST_LIST)
+
+    def blob_requests(self, digest: str) -> List[Optional[str]]:
+        """某个 blob 收到的请求的 Range 头"""
+        with self._lock:
+            return [range_header for path, range_header in self.requests if path.endswith(f"/blobs/{digest}")]
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def registry_stub():
+    stub = RegistryStub()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def make_stub():
+    """创建多个仓库替身（用作加速地址），测试结束后全部关闭"""
+    stubs = []
+
+    def factory() -> RegistryStub:
+        stub = RegistryStub()
+        stubs.append(stub)
+        return stub
+
+    yield factory
+    for stub in stubs:
+        stub.close()
@@ -0,0 +1,98 @@
+"""导出准入：历史压缩率与压缩线程分配"""
+import asyncio
+
+from admission import CompressionRatios, CpuBudget
+
+
+def meta(ratio: float, created_at: int, **kwargs) -> dict:
+    return dict({"engine": "docker", "codec_family": "gzip", "layer_cache": False, "tar_size": 1000,
+                 "size": int(1000 * ratio), "created_at": created_at}, **kwargs)
+
+
+def test_ratio_uses_default_until_enough_samples():
+    ratios = CompressionRatios(0.5)
+    ratios.record("gzip", False, 1000, 300)
+    ratios.record("gzip", False, 1000, 300)
+    assert ratios.ratio("gzip", False) == 0.5
+    ratios.record("gzip", False, 1000, 300)
+    assert ratios.ratio("gzip", False) == 0.3
+    assert ratios.ratio("gzip", True) == 0.5
+
+
+def test_ratio_takes_high_quantile():
+    ratios = CompressionRatios(0.5)
+    for index in range(10):
+        ratios.record("zstd", False, 1000, 100 + index * 10)
+    assert ratios.ratio("zstd", False) == 0.18
+
+
+def test_load_skips_registry_and_delta_archives():
+    ratios = CompressionRatios(0.5)
+    ratios.load([meta(0.2, 1), meta(0.2, 2), meta(0.2, 3), None,
+                 meta(0.9, 4, engine="registry"), meta(0.9, 5, delta_base={"image": "base"}),
+                 meta(0.9, 6, tar_size=None)])
+    assert ratios.stats() == {"gzip/stream": {"samples": 3, "ratio": 0.2}}
+
+
+def test_single_compression_gets_all_cores():
+    budget = CpuBudget(8, load_aware=False)
+
+    async def run():
+        async with budget.allocate() as threads:
+            return threads
+
+    assert asyncio.run(run()) == 8
+
+
+def test_threads_never_exceed_cores():
+    budget = CpuBudget(4, load_aware=False, poll_interval=0.01)
+    granted = []
+    peak = 0
+
+    async def compress(multithreaded=True):
+        nonlocal peak
+        async with budget.allocate(multithreaded) as threads:
+            granted.append(threads)
+            peak = max(peak, budget.allocated)
+            await asyncio.sleep(0.02)
+
+    async def run():
+        await asyncio.gather(*(compress() for _ in range(6)), compress(multithreaded=False))
+
+    asyncio.run(run())
+    assert peak <= 4
+    assert len(granted) == 7 and all(threads >= 1 for threads in granted)
+    assert budget.allocated == 0 and budget.compressions == 0 and budget.waiting == 0
+
+
+def test_share_follows_running_compressions():
+    budget = CpuBudget(8, load_aware=False)
+
+    async def run():
+        async with budget.allocate(multithreaded=False) as first:
+            async with budget.allocate() as second:
+                return first, second
+
+    # 已有一个压缩在运行时，新压缩分到一半的核心
+    assert asyncio.run(run()) == (1, 4)
+
+
+def test_waiter_is_notified_and_waits_instead_of_oversubscribing():
+    budget = CpuBudget(2, load_aware=False, poll_interval=0.01)
+    notified = []
+
+    async def run():
+        async with budget.allocate() as first:
+            assert first == 2
+            waiter = asyncio.create_task(_allocate(budget, notified))
+            await asyncio.sleep(0.05)
+            assert not waiter.done() and budget.waiting == 1
+        return await waiter
+
+    assert asyncio.run(run()) == 2
+    assert notified == [True]
+
+
+async def _allocate(budget, notified):
+    async with budget.allocate(on_wait=lambda: notified.append(True)) as threads:
+        return threads
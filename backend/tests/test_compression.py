@@ -0,0 +1,57 @@
+"""外部压缩进程：输出正确性与 CPU 时间记录（包括提前退出的进程）"""
+import os
+import subprocess
+import time
+
+import pytest
+
+from compression import CODECS, Codec, compress_stream, process_exited, wait_with_rusage
+from metrics import StageTimings
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "wait4"), reason="需要 wait4 取得子进程的 CPU 时间")
+
+
+def failing_codec(script: str) -> Codec:
+    return Codec("failing", ".tar.fail", "fail", 1, (1, 1), command=lambda level, threads: ["sh", "-c", script])
+
+
+def test_process_exited_does_not_reap():
+    process = subprocess.Popen(["sh", "-c", "exit 0"])
+    while not process_exited(process):
+        time.sleep(0.01)
+    assert process.returncode is None
+    assert wait_with_rusage(process, 5) is not None
+    assert process.returncode == 0
+
+
+@pytest.mark.skipif(not CODECS["zstd"].available(), reason="需要 zstd")
+def test_cpu_seconds_recorded_for_successful_compression(tmp_path):
+    timings = StageTimings()
+    data = [os.urandom(1024 * 1024) for _ in range(4)]
+    output = str(tmp_path / "out.tar.zst")
+    compress_stream(iter(data), output, codec=CODECS["zstd"], timings=timings)
+    assert "zstd" in timings.snapshot()["compressor_cpu_seconds"]
+    restored = subprocess.run(["zstd", "-dc", output], capture_output=True, check=True).stdout
+    assert restored == b"".join(data)
+
+
+def test_cpu_seconds_recorded_when_compressor_exits_early(tmp_path):
+    timings = StageTimings()
+    # 进程读取一点输入后以非零状态退出，写入循环在下一块时发现
+    codec = failing_codec("head -c 1 >/dev/null; exit 3")
+    chunks = (b"x" * 65536 for _ in range(64))
+    output = str(tmp_path / "out.tar.fail")
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        compress_stream(chunks, output, codec=codec, timings=timings)
+    assert error.value.returncode == 3
+    assert "failing" in timings.snapshot()["compressor_cpu_seconds"]
+    assert not os.path.exists(output + ".tmp")
+
+
+def test_cpu_seconds_recorded_when_compression_fails_at_exit(tmp_path):
+    timings = StageTimings()
+    codec = failing_codec("cat >/dev/null; exit 4")
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        compress_stream(iter([b"x" * 1024]), str(tmp_path / "out.tar.fail"), codec=codec, timings=timings)
+    assert error.value.returncode == 4
+    assert "failing" in timings.snapshot()["compressor_cpu_seconds"]
@@ -0,0 +1,50 @@
+"""Range 请求头解析与 If-Range 判断"""
+import os
+from email.utils import formatdate
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from file_transfer import RangeNotSatisfiable, _if_range_matches, file_etag, parse_range_header
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", [(0, 99)]),
+    ("bytes=100-", [(100, 999)]),
+    ("bytes=-100", [(900, 999)]),
+    ("bytes=-5000", [(0, 999)]),
+    ("bytes=900-5000", [(900, 999)]),
+    # 重叠与相邻的区间合并
+    ("bytes=0-99, 50-199, 200-299", [(0, 299)]),
+    ("bytes=500-599,0-99", [(0, 99), (500, 599)]),
+    # 越界的区间忽略，其余照常返回
+    ("bytes=0-9,2000-", [(0, 9)]),
+])
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["items=0-9", "bytes=", "bytes=abc-", "bytes=9-0", "bytes=5"])
+def test_parse_range_header_ignores_malformed(header):
+    assert parse_range_header(header, 1000) is None
+
+
+@pytest.mark.parametrize("header, size", [("bytes=1000-", 1000), ("bytes=-0", 1000), ("bytes=-5", 0), ("bytes=0-", 0)])
+def test_parse_range_header_unsatisfiable(header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header(header, size)
+
+
+def test_if_range_matches(tmp_path):
+    path = tmp_path / "a.tar.gz"
+    path.write_bytes(b"data")
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    assert _if_range_matches(etag, etag, stat)
+    # ETag 只做强比较
+    assert not _if_range_matches(f"W/{etag}", etag, stat)
+    assert not _if_range_matches('"other"', etag, stat)
+    assert _if_range_matches(formatdate(stat.st_mtime, usegmt=True), etag, stat)
+    assert not _if_range_matches(formatdate(stat.st_mtime - 60, usegmt=True), etag, stat)
+    assert not _if_range_matches("not a date", etag, stat)
@@ -0,0 +1,40 @@
+"""层缓存：命中统计与固定条目的淘汰保护"""
+import os
+
+import layer_cache
+from layer_cache import LayerCache
+
+
+def put(cache: LayerCache, key: str, size: int) -> str:
+    temp = cache.temp_path(key)
+    with open(temp, "wb") as f:
+        f.write(b"\0" * size)
+    return cache.commit(key, temp)
+
+
+def test_lookup_without_record_leaves_stats(tmp_path):
+    cache = LayerCache(str(tmp_path), 1024)
+    assert cache.lookup("layers/gzip/a", record=False) is None
+    put(cache, "layers/gzip/a", 10)
+    assert cache.lookup("layers/gzip/a", record=False)
+    assert (cache.hits, cache.misses, cache.bytes_reused) == (0, 0, 0)
+    assert cache.lookup("layers/gzip/a")
+    assert cache.lookup("layers/gzip/b") is None
+    assert (cache.hits, cache.misses, cache.bytes_reused) == (1, 1, 10)
+
+
+def test_entry_pinned_before_commit_survives_eviction(tmp_path, monkeypatch):
+    monkeypatch.setattr(layer_cache, "EVICTION_GRACE_SECONDS", 0)
+    cache = LayerCache(str(tmp_path), 100)
+    old = put(cache, "layers/gzip/old", 60)
+    os.utime(old, (0, 0))
+    with cache.pinned(["layers/gzip/new"]):
+        # 放入新条目触发淘汰：超出上限，但新条目已被固定，只能淘汰旧条目
+        new = put(cache, "layers/gzip/new", 60)
+        assert os.path.exists(new)
+        assert not os.path.exists(old)
+        os.utime(new, (0, 0))
+        cache.evict(reserve_bytes=1000)
+        assert os.path.exists(new)
+    cache.evict(reserve_bytes=1000)
+    assert not os.path.exists(new)
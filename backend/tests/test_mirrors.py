@@ -0,0 +1,149 @@
+"""加速地址：排序、失败冷却，以及拉取时的地址切换与跨地址续传"""
+import os
+import time
+
+import pytest
+
+from conftest import digest_of
+from mirrors import MirrorManager, normalize_endpoint
+from registry import RegistryPuller
+
+
+def mirror_manager(upstream, mirrors, **kwargs) -> MirrorManager:
+    return MirrorManager([mirror.url for mirror in mirrors], upstream.host, upstream.url, **kwargs)
+
+
+def set_latency(manager: MirrorManager, latencies) -> None:
+    """直接设定各地址的延迟，并标记为刚探测过，拉取时不再探测"""
+    for url, latency in latencies.items():
+        stats = manager._stats[normalize_endpoint(url)]
+        stats.latency = latency
+        stats.latency_at = time.monotonic()
+
+
+def test_normalize_endpoint():
+    assert normalize_endpoint("mirror.example.com/v2/") == "https://mirror.example.com"
+    assert normalize_endpoint("http://127.0.0.1:5000/") == "http://127.0.0.1:5000"
+
+
+def test_applies_only_to_configured_registry(registry_stub, make_stub):
+    manager = mirror_manager(registry_stub, [make_stub()])
+    assert manager.applies_to(registry_stub.host)
+    assert not manager.applies_to("ghcr.io")
+    assert not MirrorManager([], "docker.io", "https://registry-1.docker.io").applies_to("docker.io")
+
+
+def test_order_by_expected_download_time(registry_stub, make_stub):
+    fast, slow = make_stub(), make_stub()
+    manager = mirror_manager(registry_stub, [slow, fast])
+    set_latency(manager, {fast.url: 0.01, slow.url: 0.5, registry_stub.url: 0.2})
+    assert manager.order() == [fast.url, registry_stub.url, slow.url]
+
+    manager.record_download(slow.url, 64 * 1024 * 1024, 1)
+    assert manager.order()[0] == slow.url
+
+
+def test_failure_cooldown_doubles_and_recovers(registry_stub, make_stub):
+    mirror = make_stub()
+    manager = mirror_manager(registry_stub, [mirror], failure_cooldown=0.2)
+    set_latency(manager, {mirror.url: 0.01, registry_stub.url: 0.5})
+
+    manager.record_failure(mirror.url, RuntimeError("boom"))
+    info = next(item for item in manager.stats() if item["url"] == mirror.url)
+    assert not info["healthy"] and info["cooldown_seconds"] == pytest.approx(0.2, abs=0.05)
+    assert manager.order() == [registry_stub.url, mirror.url]
+
+    manager.record_failure(mirror.url, RuntimeError("boom"))
+    info = next(item for item in manager.stats() if item["url"] == mirror.url)
+    assert info["failures"] == 2 and info["cooldown_seconds"] == pytest.approx(0.4, abs=0.05)
+
+    manager.record_download(mirror.url, 1024, 0.01)
+    assert manager.order()[0] == mirror.url
+
+
+def test_cooldown_expires(registry_stub, make_stub):
+    mirror = make_stub()
+    manager = mirror_manager(registry_stub, [mirror], failure_cooldown=0.05)
+    set_latency(manager, {mirror.url: 0.01, registry_stub.url: 0.5})
+    manager.record_failure(mirror.url, RuntimeError("boom"))
+    assert manager.order()[0] == registry_stub.url
+    time.sleep(0.1)
+    assert manager.order()[0] == mirror.url
+
+
+def test_latency_probe_marks_unreachable_mirror(registry_stub, make_stub):
+    mirror = make_stub()
+    mirror.close()
+    manager = mirror_manager(registry_stub, [mirror], probe_timeout=1)
+    manager.refresh_latency()
+    info = {item["url"]: item for item in manager.stats()}
+    assert info[registry_stub.url]["healthy"] and info[registry_stub.url]["latency_ms"] is not None
+    assert not info[mirror.url]["healthy"]
+    assert manager.order() == [registry_stub.url, mirror.url]
+
+
+def test_resolve_falls_back_when_mirror_lacks_manifest(registry_stub, make_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}])
+    mirror = make_stub()
+    manager = mirror_manager(registry_stub, [mirror])
+    set_latency(manager, {mirror.url: 0.01, registry_stub.url: 0.5})
+
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1, mirrors=manager)
+    assert puller.identity()["image_id"] == image["manifest"]["config"]["digest"]
+    assert any("/manifests/" in path for path, _ in mirror.requests)
+
+
+def test_pull_fails_over_on_corrupt_layer(registry_stub, make_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a" * 4096}])
+    mirror = make_stub()
+    mirror.add_image("app", "1.0", [{"a.txt": b"a" * 4096}])
+    digest = digest_of(image["layers"][0])
+    mirror.faults[digest] = "corrupt"
+    manager = mirror_manager(registry_stub, [mirror], failure_cooldown=60)
+    set_latency(manager, {mirror.url: 0.01, registry_stub.url: 0.5})
+
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1, mirrors=manager)
+    puller.pull()
+
+    with open(puller.blob_path(digest), "rb") as f:
+        assert f.read() == image["layers"][0]
+    assert len(mirror.blob_requests(digest)) == 1
+    assert len(registry_stub.blob_requests(digest)) == 1
+    # 出错的加速地址进入冷却，之后排在最后
+    assert manager.order() == [registry_stub.url, mirror.url]
+
+
+def test_pull_resumes_on_next_endpoint(registry_stub, make_stub, tmp_path):
+    layer = {"big.bin": os.urandom(512 * 1024)}
+    image = registry_stub.add_image("app", "1.0", [layer])
+    mirror = make_stub()
+    mirror.add_image("app", "1.0", [layer])
+    digest = digest_of(image["layers"][0])
+    mirror.faults[digest] = "truncate"
+    manager = mirror_manager(registry_stub, [mirror])
+    set_latency(manager, {mirror.url: 0.01, registry_stub.url: 0.5})
+
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1, mirrors=manager)
+    puller.pull()
+
+    with open(puller.blob_path(digest), "rb") as f:
+        assert f.read() == image["layers"][0]
+    # 加速地址断开前已写入的部分保留，从镜像仓库本身续传剩余部分（之前的请求是吞吐量探测）
+    resume = registry_stub.blob_requests(digest)[-1]
+    assert resume.startswith("bytes=") and resume.endswith("-") and resume != "bytes=0-"
+
+
+def test_pull_uses_upstream_when_all_mirrors_fail(registry_stub, make_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}])
+    mirror = make_stub()
+    mirror.add_image("app", "1.0", [{"a.txt": b"a"}])
+    digest = digest_of(image["layers"][0])
+    mirror.faults[digest] = 500
+    manager = mirror_manager(registry_stub, [mirror])
+    set_latency(manager, {mirror.url: 0.01, registry_stub.url: 0.5})
+
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1, mirrors=manager)
+    puller.pull()
+    info = {item["url"]: item for item in manager.stats()}
+    assert info[mirror.url]["failures"] == 1 and "500" in info[mirror.url]["last_error"]
+    assert info[registry_stub.url]["failures"] == 0
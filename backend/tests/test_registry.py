@@ -0,0 +1,202 @@
+"""registry 引擎：清单与配置获取、Range 续传、摘要校验与共享 blob 的释放"""
+import io
+import json
+import os
+import tarfile
+
+import pytest
+
+from conftest import digest_of
+from layer_cache import LayerCache
+from registry import RegistryClient, RegistryError, RegistryPuller, iter_tar_members, parse_image_reference
+
+
+def read_tar(chunks) -> dict:
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks)), mode="r:") as tar:
+        return {member.name: tar.extractfile(member).read() if member.isfile() else None for member in tar}
+
+
+def client_for(stub) -> RegistryClient:
+    return RegistryClient(stub.host, insecure=True, timeout=5)
+
+
+def test_parse_image_reference():
+    ref = parse_image_reference("nginx")
+    assert (ref.registry, ref.repository, ref.tag) == ("docker.io", "library/nginx", "latest")
+    ref = parse_image_reference("localhost:5000/team/app:1.0")
+    assert (ref.registry, ref.repository, ref.tag) == ("localhost:5000", "team/app", "1.0")
+    assert ref.repo_tag == "localhost:5000/team/app:1.0"
+    with pytest.raises(RegistryError):
+        parse_image_reference("Invalid/Name")
+
+
+def test_get_manifest_and_config(registry_stub):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}])
+    client = client_for(registry_stub)
+    manifest, digest = client.get_manifest("app", "1.0")
+    assert manifest == image["manifest"]
+    assert digest == image["manifest_digest"]
+    assert client.get_blob("app", manifest["config"]["digest"]) == image["config"]
+
+
+def test_get_manifest_selects_platform(registry_stub):
+    amd64 = registry_stub.add_image("app", "amd64", [{"a.txt": b"amd64"}])
+    arm64 = registry_stub.add_image("app", "arm64", [{"a.txt": b"arm64"}])
+    registry_stub.add_index("app", "multi", {"linux/amd64": amd64["manifest_digest"],
+                                             "linux/arm64": arm64["manifest_digest"]})
+    client = client_for(registry_stub)
+    assert client.get_manifest("app", "multi", "linux/arm64")[1] == arm64["manifest_digest"]
+    with pytest.raises(RegistryError):
+        client.get_manifest("app", "multi", "linux/s390x")
+
+
+def test_missing_image(registry_stub):
+    with pytest.raises(RegistryError, match="镜像不存在"):
+        client_for(registry_stub).get_manifest("app", "missing")
+
+
+def test_get_blob_rejects_digest_mismatch(registry_stub):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}])
+    config_digest = image["manifest"]["config"]["digest"]
+    registry_stub.faults[config_digest] = "corrupt"
+    with pytest.raises(RegistryError, match="摘要校验失败"):
+        client_for(registry_stub).get_blob("app", config_digest)
+
+
+def test_download_blob_resumes_with_range(registry_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"big.bin": os.urandom(200 * 1024)}])
+    blob = image["layers"][0]
+    digest = digest_of(blob)
+    partial = tmp_path / "layer.partial"
+    partial.write_bytes(blob[:1000])
+
+    downloaded = client_for(registry_stub).download_blob("app", digest, str(partial))
+
+    assert downloaded == len(blob) - 1000
+    assert registry_stub.blob_requests(digest) == ["bytes=1000-"]
+    assert partial.read_bytes() == blob
+
+
+def test_download_blob_already_complete(registry_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}])
+    blob = image["layers"][0]
+    partial = tmp_path / "layer.partial"
+    partial.write_bytes(blob)
+    assert client_for(registry_stub).download_blob("app", digest_of(blob), str(partial)) == 0
+    assert partial.read_bytes() == blob
+
+
+def test_download_blob_rejects_digest_mismatch(registry_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a" * 4096}])
+    digest = digest_of(image["layers"][0])
+    registry_stub.faults[digest] = "corrupt"
+    partial = tmp_path / "layer.partial"
+    with pytest.raises(RegistryError, match="摘要校验失败"):
+        client_for(registry_stub).download_blob("app", digest, str(partial))
+    # 损坏的数据不能留下来被续传
+    assert not partial.exists()
+
+
+def test_pull_builds_loadable_tar(registry_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}, {"b.txt": b"b"}])
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1)
+    events = []
+    puller.pull(events.append)
+
+    assert puller.identity()["layers"] == image["diff_ids"]
+    members = read_tar(puller.iter_tar())
+    manifest = json.loads(members["manifest.json"])
+    assert manifest[0]["RepoTags"] == [f"{registry_stub.host}/app:1.0"]
+    assert [members[name] for name in manifest[0]["Layers"]] == image["layers"]
+    assert members[manifest[0]["Config"]] == image["config"]
+    assert sum(len(chunk) for chunk in puller.iter_tar()) == puller.tar_size()
+    assert sum(event["status"] == "Pull complete" for event in events) == 2
+
+
+def test_pull_fails_on_corrupt_layer(registry_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}])
+    registry_stub.faults[digest_of(image["layers"][0])] = "corrupt"
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1)
+    with pytest.raises(RegistryError, match="下载失败"):
+        puller.pull()
+
+
+def test_release_keeps_blobs_used_by_other_jobs(registry_stub, tmp_path):
+    registry_stub.add_image("app", "1.0", [{"shared.txt": b"shared"}, {"one.txt": b"one"}])
+    registry_stub.add_image("app", "2.0", [{"shared.txt": b"shared"}, {"two.txt": b"two"}])
+    blob_dir = str(tmp_path / "blobs")
+    first = RegistryPuller(f"{registry_stub.host}/app:1.0", blob_dir, retries=1)
+    second = RegistryPuller(f"{registry_stub.host}/app:2.0", blob_dir, retries=1)
+    first.pull()
+    second_events = []
+    second.pull(second_events.append)
+    assert any(event["status"] == "Already exists" for event in second_events)
+
+    first.release(success=True)
+    # 第二个任务仍能读取共享的层
+    read_tar(second.iter_tar())
+    second.release(success=True)
+    # 两个任务都结束后共享的 blob 才被删除（锁文件保留）
+    assert [name for name in os.listdir(blob_dir) if not name.endswith(".lock")] == ["jobs"]
+    assert os.listdir(os.path.join(blob_dir, "jobs")) == []
+
+
+def test_release_after_failure_keeps_blobs_for_retry(registry_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}])
+    blob_dir = str(tmp_path / "blobs")
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", blob_dir, retries=1)
+    puller.pull()
+    puller.release(success=False)
+    digest = digest_of(image["layers"][0])
+    assert os.path.exists(puller.shared_blob_path(digest))
+
+    retry = RegistryPuller(f"{registry_stub.host}/app:1.0", blob_dir, retries=1)
+    retry.pull()
+    assert len(registry_stub.blob_requests(digest)) == 1
+
+
+def test_pull_uses_layer_cache(registry_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}])
+    cache = LayerCache(str(tmp_path / "cache"), 1024 ** 3)
+    digest = digest_of(image["layers"][0])
+    for _ in range(2):
+        puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1, cache=cache)
+        puller.pull()
+        members = read_tar(puller.iter_tar())
+        assert image["layers"][0] in members.values()
+        puller.release(success=True)
+    assert len(registry_stub.blob_requests(digest)) == 1
+    assert os.path.exists(cache.path(RegistryPuller.cache_key(digest)))
+
+
+def test_iter_tar_members_pads_to_blocks():
+    members = [("a.txt", b"abc", None, 3), ("dir/", None, None, -1)]
+    data = b"".join(iter_tar_members(members))
+    assert len(data) % tarfile.BLOCKSIZE == 0
+    assert read_tar([data])["a.txt"] == b"abc"
+
+
+def test_layer_cache_counts_each_layer_once(registry_stub, tmp_path):
+    registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}, {"b.txt": b"b"}])
+    cache = LayerCache(str(tmp_path / "cache"), 1024 ** 3)
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1, cache=cache)
+    puller.pull()
+    assert (cache.hits, cache.misses) == (0, 2)
+    puller.release()
+
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1, cache=cache)
+    puller.pull()
+    assert (cache.hits, cache.misses) == (2, 2)
+    puller.release()
+
+
+def test_release_after_failed_pull_unpins_layers(registry_stub, tmp_path):
+    image = registry_stub.add_image("app", "1.0", [{"a.txt": b"a"}, {"b.txt": b"b"}])
+    registry_stub.faults[digest_of(image["layers"][1])] = 500
+    cache = LayerCache(str(tmp_path / "cache"), 1024 ** 3)
+    puller = RegistryPuller(f"{registry_stub.host}/app:1.0", str(tmp_path / "blobs"), retries=1, cache=cache)
+    with pytest.raises(RegistryError):
+        puller.pull()
+    assert cache.stats()["pinned"] == 2
+    puller.release(success=False)
+    assert cache.stats()["pinned"] == 0
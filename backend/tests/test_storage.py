@@ -0,0 +1,100 @@
+"""下载目录的空间预留与淘汰：已写入的部分不重复计入，淘汰后通知调用方"""
+import asyncio
+import os
+
+import pytest
+
+from archive_index import ArchiveIndex
+from storage import StorageFull, StorageManager
+
+GB = 1024 ** 3
+
+
+class FakeDisk:
+    """按导出写入的文件大小模拟剩余空间（状态文件等以 . 开头的文件不计）"""
+
+    def __init__(self, root: str, total: int):
+        self.root = root
+        self.total = total
+
+    def free(self) -> int:
+        used = sum(os.path.getsize(os.path.join(dirpath, name))
+                   for dirpath, _, names in os.walk(self.root) for name in names if not name.startswith("."))
+        return self.total - used
+
+
+@pytest.fixture
+def manager(tmp_path):
+    def factory(total: int, **kwargs) -> StorageManager:
+        root = str(tmp_path)
+        storage = StorageManager(root, ArchiveIndex(root, (".tar.gz",)), **kwargs)
+        storage.free_bytes = FakeDisk(root, total).free
+        return storage
+    return factory
+
+
+def write(path, size: int) -> None:
+    with open(path, "ab") as f:
+        f.write(b"\0" * size)
+
+
+def test_written_bytes_are_not_counted_twice(manager, tmp_path):
+    storage = manager(1000)
+    first = str(tmp_path / "first.tar.gz")
+    assert storage.try_reserve(600, first) is not None
+    assert storage.outstanding_bytes() == 600
+    # 第一个导出写入一半后，剩余空间（700）只需再容纳其未写入的 300 字节
+    write(first + ".tmp", 300)
+    assert storage.outstanding_bytes() == 300
+    assert storage.reserved_bytes() == 600
+    assert storage.try_reserve(400, str(tmp_path / "second.tar.gz")) is not None
+    assert storage.try_reserve(1, str(tmp_path / "third.tar.gz")) is None
+    assert storage.capacity() == 0
+
+
+def test_finished_archive_counts_as_written(manager, tmp_path):
+    storage = manager(10 * 1024)
+    path = str(tmp_path / "done.tar.gz")
+    reservation = storage.try_reserve(4096, path)
+    write(path + ".tmp", 4096)
+    os.rename(path + ".tmp", path)
+    assert storage.outstanding_bytes() == 0
+    assert storage.outstanding_bytes(include_temp=False) == 0
+    storage.release(reservation)
+    assert storage.reserved_bytes() == 0
+
+
+def test_quota_ignores_temp_files(manager, tmp_path):
+    storage = manager(100 * GB, quota_bytes=1000)
+    path = str(tmp_path / "first.tar.gz")
+    storage.try_reserve(800, path)
+    write(path + ".tmp", 500)
+    # .tmp 不计入归档占用，配额仍按完整的预留计算
+    assert storage.outstanding_bytes(include_temp=False) == 800
+    assert storage.try_reserve(300, str(tmp_path / "second.tar.gz")) is None
+    assert storage.try_reserve(200, str(tmp_path / "second.tar.gz")) is not None
+
+
+def test_admission_rejects_what_can_never_fit(manager, tmp_path):
+    storage = manager(10 * 1024, quota_bytes=4096)
+
+    async def admit(size):
+        async with storage.admission(size, str(tmp_path / "a.tar.gz"), wait=True):
+            return storage.reserved_bytes()
+
+    assert asyncio.run(admit(4096)) == 4096
+    with pytest.raises(StorageFull):
+        asyncio.run(admit(4097))
+
+
+def test_eviction_notifies_callback(manager, tmp_path):
+    evicted = []
+    storage = manager(100 * GB, quota_bytes=1000, on_evict=evicted.append)
+    old, new = str(tmp_path / "old.tar.gz"), str(tmp_path / "new.tar.gz")
+    write(old, 600)
+    write(new, 600)
+    os.utime(old, (1, 1))
+    storage.index.rescan(full=True)
+    assert storage.sweep() == ["old.tar.gz"]
+    assert evicted == [old]
+    assert os.path.exists(new)
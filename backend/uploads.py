@@ -0,0 +1,155 @@
+"""可续传的分块上传，用于导入归档
+
+每个上传在 root 下有数据文件 <id>.part 与元数据 <id>.json（文件名、总大小、可选的 SHA-256、时间）。
+客户端按顺序提交分块并带上起始偏移；偏移与已接收的字节数不一致时拒绝，客户端查询当前偏移后从那里继续。
+连接中断时已写入的部分保留，已接收的字节数即数据文件的大小。超过 ttl 秒没有新数据的上传被清理。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+class UploadError(Exception):
+    """上传不存在、已被占用或超出声明的大小"""
+
+
+class UploadOffsetMismatch(UploadError):
+    """分块的起始偏移与已接收的字节数不一致"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"偏移不一致，已接收 {offset} 字节")
+        self.offset = offset
+
+
+class UploadStore:
+    """上传的登记、追加写入与清理，可在多个线程中使用
+
+    max_size 为单个上传的大小上限（字节，0 表示不限制）。
+    """
+
+    def __init__(self, root: str, max_size: int = 0, ttl_seconds: float = 86400):
+        self.root = root
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        # 正在写入的上传，同一上传同时只接受一个写入请求
+        self._writing = set()
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self.root, f"{upload_id}.json")
+
+    def path(self, upload_id: str) -> str:
+        return os.path.join(self.root, f"{upload_id}.part")
+
+    def create(self, filename: str, size: int, sha256: Optional[str] = None) -> Dict:
+        if size <= 0:
+            raise UploadError("上传大小必须大于 0")
+        if self.max_size and size > self.max_size:
+            raise UploadError(f"上传大小超过上限 {self.max_size / (1024 ** 3):.1f}GB")
+        upload_id = uuid.uuid4().hex
+        meta = {
+            "upload_id": upload_id,
+            "filename": os.path.basename(filename),
+            "size": size,
+            "sha256": sha256.lower() if sha256 else None,
+            "created_at": time.time(),
+        }
+        open(self.path(upload_id), "wb").close()
+        with open(self._meta_path(upload_id), "w") as f:
+            json.dump(meta, f)
+        return self.get(upload_id)
+
+    def get(self, upload_id: str) -> Optional[Dict]:
+        """上传的元数据与当前进度（offset 为已接收的字节数），不存在时返回 None"""
+        if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+            return None
+        try:
+            with open(self._meta_path(upload_id)) as f:
+                meta = json.load(f)
+            stat = os.stat(self.path(upload_id))
+        except (OSError, ValueError):
+            return None
+        return dict(meta, offset=stat.st_size, updated_at=stat.st_mtime, complete=stat.st_size == meta["size"])
+
+    @contextmanager
+    def writer(self, upload_id: str, offset: int):
+        """从 offset 处追加写入，yield 的 write(data) 写入一个数据块并返回新的偏移"""
+        upload = self.get(upload_id)
+        if upload is None:
+            raise UploadError("上传不存在")
+        with self._lock:
+            if upload_id in self._writing:
+                raise UploadError("另一个请求正在写入该上传")
+            self._writing.add(upload_id)
+        try:
+            # 占用后重新读取偏移，前一个写入请求可能刚刚结束
+            upload = self.get(upload_id)
+            if offset != upload["offset"]:
+                raise UploadOffsetMismatch(upload["offset"])
+            with open(self.path(upload_id), "ab") as f:
+                position = offset
+
+                def write(data: bytes) -> int:
+                    nonlocal position
+                    if position + len(data) > upload["size"]:
+                        raise UploadError(f"数据超出声明的大小 {upload['size']} 字节")
+                    f.write(data)
+                    position += len(data)
+                    return position
+
+                yield write
+        finally:
+            with self._lock:
+                self._writing.discard(upload_id)
+
+    def verify(self, upload_id: str) -> Dict:
+        """确认上传已完整接收，声明了 SHA-256 时校验摘要，返回上传信息"""
+        upload = self.get(upload_id)
+        if upload is None:
+            raise UploadError("上传不存在")
+        if not upload["complete"]:
+            raise UploadError(f"上传未完成，已接收 {upload['offset']}/{upload['size']} 字节")
+        if upload["sha256"]:
+            hasher = hashlib.sha256()
+            with open(self.path(upload_id), "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+            if hasher.hexdigest() != upload["sha256"]:
+                raise UploadError("上传内容的 SHA-256 与声明的不一致")
+        return upload
+
+    def remove(self, upload_id: str) -> None:
+        for path in (self.path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def cleanup(self, keep=()) -> List[str]:
+        """删除超过 ttl 秒没有新数据的上传（keep 中的除外，如正在导入的上传），返回被删除的 ID"""
+        if not self.ttl_seconds:
+            return []
+        removed = []
+        expire_before = time.time() - self.ttl_seconds
+        for filename in os.listdir(self.root):
+            upload_id, ext = os.path.splitext(filename)
+            if ext != ".json" or upload_id in keep or upload_id in self._writing:
+                continue
+            upload = self.get(upload_id)
+            if upload is None or upload["updated_at"] < expire_before:
+                self.remove(upload_id)
+                removed.append(upload_id)
+                logger.info(f"已清理过期的上传: {upload_id}")
+        return removed
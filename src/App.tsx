@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 
 // 使用环境变量或默认值，单端口模式下使用相对路径
@@ -11,6 +11,7 @@ interface DownloadedFile {
   size: number;
   created_at: string;
   path: string;
+  sha256?: string | null;
 }
 
 function App() {
@@ -52,8 +53,11 @@ function App() {
   // 获取已下载文件列表
   const fetchDownloadedFiles = async () => {
     try {
-      const response = await axios.get(`${API_BASE_URL}/downloaded-files`);
-      setDownloadedFiles(response.data);
+      // 接口带 ETag，列表未变化时浏览器以 304 复用缓存
+      const response = await axios.get(`${API_BASE_URL}/downloaded-files`, {
+        params: { sort: 'created_at', order: 'desc', limit: 1000 },
+      });
+      setDownloadedFiles(response.data.items);
     } catch (error) {
       console.error('获取文件列表失败:', error);
     }
@@ -66,25 +70,73 @@ function App() {
     }
   }, [isAuthenticated]);
 
-  // 检查下载进度
-  const checkProgress = async () => {
-    try {
-      const response = await axios.get(`${API_BASE_URL}/pull-progress?image_name=${imageName}`);
-      const { status, progress, detail, output } = response.data;
-      setStatus(status);
-      setProgress(progress);
-      setDetail(detail);
-      setOutput(output);
-      
-      // 如果状态是 complete 或 error，停止轮询
-      if (status === 'complete' || status === 'error') {
+  // 保存当前的进度事件流，便于在新任务或组件卸载时关闭
+  const progressStreamRef = useRef<EventSource | null>(null);
+
+  const closeProgressStream = () => {
+    if (progressStreamRef.current) {
+      progressStreamRef.current.close();
+      progressStreamRef.current = null;
+    }
+  };
+
+  useEffect(() => closeProgressStream, []);
+
+  // 订阅服务端推送的增量进度（SSE），浏览器断线重连时会自动携带 Last-Event-ID 续传
+  const subscribeProgress = (jobId: string) => {
+    closeProgressStream();
+    const source = new EventSource(
+      `${API_BASE_URL}/pull-progress/stream?job_id=${encodeURIComponent(jobId)}`
+    );
+    progressStreamRef.current = source;
+
+    const applyState = (data: any) => {
+      if (data.status !== undefined) setStatus(data.status);
+      if (data.progress !== undefined) setProgress(data.progress);
+      if (data.detail !== undefined) setDetail(data.detail);
+    };
+
+    // 完整快照：首次连接或续传序号已失效时
+    source.addEventListener('snapshot', (e) => {
+      const data = JSON.parse((e as MessageEvent).data);
+      applyState(data);
+      setOutput(data.output || []);
+    });
+
+    // 状态、进度或详情变化
+    source.addEventListener('state', (e) => {
+      applyState(JSON.parse((e as MessageEvent).data));
+    });
+
+    // 新日志行，前端同样只保留最近200条
+    source.addEventListener('log', (e) => {
+      const { line } = JSON.parse((e as MessageEvent).data);
+      setOutput((prev) => [...prev, line].slice(-200));
+    });
+
+    // 任务结束
+    source.addEventListener('end', (e) => {
+      const { status } = JSON.parse((e as MessageEvent).data);
+      console.log('下载结束，关闭进度流:', status);
+      closeProgressStream();
+      setLoading(false);
+      if (status === 'complete') {
+        // 下载完成后刷新文件列表
+        fetchDownloadedFiles();
+      } else if (status === 'not_found') {
+        setStatus('error');
+      }
+    });
+
+    source.onerror = () => {
+      // 连接断开时 EventSource 会自动重连，只在彻底关闭时报错
+      if (source.readyState === EventSource.CLOSED) {
+        console.error('进度流已关闭');
+        closeProgressStream();
+        setStatus('error');
         setLoading(false);
       }
-    } catch (error) {
-      console.error('获取进度失败:', error);
-      setStatus('error');
-      setLoading(false);
-    }
+    };
   };
 
   // 处理表单提交
@@ -97,73 +149,20 @@ function App() {
     setOutput([]);
     setShowOutput(false);
 
-    let progressInterval: NodeJS.Timeout | null = null;
-
     try {
       // 先启动下载进程
       console.log('开始下载镜像:', imageName);
-      await axios.post(`${API_BASE_URL}/pull-image`, {
+      const response = await axios.post(`${API_BASE_URL}/pull-image`, {
         image_name: imageName
       });
 
-      // 立即获取一次进度
-      try {
-        const response = await axios.get(`${API_BASE_URL}/pull-progress?image_name=${imageName}`);
-        const { status, progress, detail, output } = response.data;
-        console.log('初始进度:', { status, progress, detail, output });
-        setStatus(status);
-        setProgress(progress);
-        setDetail(detail);
-        setOutput(output || []);
-      } catch (error) {
-        console.error('获取初始进度失败:', error);
-      }
-
-      // 开始更频繁的轮询进度（每500毫秒）
-      progressInterval = setInterval(async () => {
-        try {
-          const response = await axios.get(`${API_BASE_URL}/pull-progress?image_name=${imageName}`);
-          const { status, progress, detail, output } = response.data;
-          console.log('轮询进度:', { status, progress, detail, outputLength: output?.length });
-          
-          setStatus(status);
-          setProgress(progress);
-          setDetail(detail);
-          setOutput(output || []);
-          
-          // 如果状态是 complete 或 error，停止轮询
-          if (status === 'complete' || status === 'error') {
-            console.log('下载完成，停止轮询');
-            if (progressInterval) {
-              clearInterval(progressInterval);
-              progressInterval = null;
-            }
-            if (status === 'complete') {
-              setLoading(false);
-              // 下载完成后刷新文件列表
-              fetchDownloadedFiles();
-            } else {
-              setLoading(false);
-            }
-          }
-        } catch (error) {
-          console.error('获取进度失败:', error);
-          if (progressInterval) {
-            clearInterval(progressInterval);
-            progressInterval = null;
-          }
-          setStatus('error');
-          setLoading(false);
-        }
-      }, 500); // 改为每500毫秒轮询一次
-
+      // 按任务 ID 订阅进度推送，替代轮询
+      subscribeProgress(response.data.job_id);
     } catch (error) {
       console.error('下载失败:', error);
       setStatus('error');
       setLoading(false);
-      if (progressInterval) {
-        clearInterval(progressInterval);
-      }
+      closeProgressStream();
     }
   };
 
@@ -303,13 +302,14 @@ function App() {
                       </div>
                       <div className="flex justify-between items-center">
                         <p className="text-sm text-gray-600">
+                          {status === 'queued' && '排队等待中...'}
                           {status === 'starting' && '正在开始下载...'}
                           {status === 'downloading' && '正在下载...'}
                           {status === 'saving' && '正在保存镜像...'}
                           {status === 'verifying' && '正在验证...'}
                           {status === 'complete' && '下载完成'}
                           {status === 'error' && '下载出错'}
-                          {!['starting', 'downloading', 'saving', 'verifying', 'complete', 'error'].includes(status) && '处理中...'}
+                          {!['queued', 'starting', 'downloading', 'saving', 'verifying', 'complete', 'error'].includes(status) && '处理中...'}
                         </p>
                         <div className="flex items-center space-x-2">
                           <span className="text-xs text-gray-500">{progress}%</span>
@@ -415,6 +415,11 @@ function App() {
                               <p className="text-xs text-gray-500">
                                 {formatFileSize(file.size)} - {file.created_at}
                               </p>
+                              {file.sha256 && (
+                                <p className="text-xs text-gray-400 font-mono truncate" title={file.sha256}>
+                                  SHA-256: {file.sha256}
+                                </p>
+                              )}
                             </div>
                             <button
                               onClick={() => downloadFile(file.path, file.name)}